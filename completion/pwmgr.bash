@@ -0,0 +1,29 @@
+# Bash completion for pwmgr. Source this file, e.g. from ~/.bashrc:
+#	source /path/to/pwmgr/completion/pwmgr.bash
+# Application names are completed after pwmgr, -u and --get by pwmgr --complete, which only reads the encrypted copy of
+# the names kept beside the archive (or asks a running agent), so it never prompts for a password. If pwmgr is an
+# alias rather than a command on the path, set PWMGR_COMMAND to the command it stands for, e.g.
+#	PWMGR_COMMAND='python3 /path/to/pwmgr/pwmgr.py'
+
+_pwmgr() {
+	local cur=${COMP_WORDS[COMP_CWORD]} prev=${COMP_WORDS[COMP_CWORD-1]} word
+	local options='-h --help -v --version -a --all -aa --all-archives -s --search -f --fuzzy --limit -u --update
+		-ub --update-batch --get -sa --set-archive -n --new-archive --migrate --agent --lock --unlock --stop-agent
+		--shell --profile --complete'
+	if [[ $cur == -* ]]; then
+		COMPREPLY=($(compgen -W "$options" -- "$cur"))
+		return
+	fi
+	# Application names are only wanted as the first argument and after -u or --get.
+	if ((COMP_CWORD > 1)) && [[ $prev != -u && $prev != --update ]]; then
+		for word in "${COMP_WORDS[@]:1:COMP_CWORD-1}"; do
+			[[ $word == -* ]] && local last_option=$word
+		done
+		[[ $last_option == --get ]] || return
+	fi
+	local -a command=(${PWMGR_COMMAND:-pwmgr})
+	local IFS=$'\n'
+	COMPREPLY=($("${command[@]}" --complete "$cur" 2>/dev/null))
+}
+
+complete -F _pwmgr pwmgr
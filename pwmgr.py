@@ -1,61 +1,3305 @@
 # ~~~ Version 1.4 (Linux with xclip usage) ~~~
-import getpass, secrets, string, subprocess
-import logging, os, re, sys
+# Only modules needed by every run are imported here. Those used by a single feature (e.g. fnmatch for password
+# rules, socket for the agent, concurrent.futures for --all-archives) are imported where they are used, to keep
+# start-up fast (see tools/check_startup.py).
+import contextlib, getpass, string, subprocess
+import bisect, json, logging, os, re, sys, threading, time
 logging.basicConfig(level=logging.WARNING, format='%(asctime)s:%(levelname)s: %(message)s',
 	datefmt='%Y-%m-%d %H:%M:%S')
 logger = logging.getLogger(__name__)
 
+class Profiler:
+	"""Times the phases of a run of pwmgr, including every subprocess it starts, and counts the lines parsed and bytes
+	moved. The breakdown is printed by the --profile option and appended to the file given by the metrics_file setting.
+	Nothing secret is recorded: passwords are removed from the arguments of subprocesses and only counts are kept.
+
+	Phases may be nested and may run in several threads at once. Each is recorded as (name, start, duration, depth),
+	with times in seconds since the profiler was reset.
+	"""
+	def __init__(self):
+		self.lock = threading.Lock()
+		# Current depth of nested phases in each thread.
+		self.local = threading.local()
+		# Set by PassManager from the --profile option and the metrics_file setting.
+		self.enabled = False
+		self.metrics_file = ''
+		self.reset()
+
+	def reset(self):
+		"""Forget all phases and counts and start timing from now."""
+		self.start_time = time.perf_counter()
+		self.phases = []
+		self.counters = {}
+
+	@contextlib.contextmanager
+	def phase(self, name):
+		"""Context manager timing the phase name."""
+		depth = getattr(self.local, 'depth', 0)
+		self.local.depth = depth + 1
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.local.depth = depth
+			with self.lock:
+				self.phases.append((name, start - self.start_time, time.perf_counter() - start, depth))
+
+	def subprocess_phase(self, process_args):
+		"""Context manager timing the subprocess process_args, named by its arguments without any password (the 7z
+		-p switch)."""
+		redacted_args = ['-p***' if arg.startswith('-p') else arg for arg in process_args]
+		return self.phase('subprocess: ' + ' '.join(redacted_args))
+
+	def count(self, name, amount=1):
+		"""Add amount to the counter name."""
+		with self.lock:
+			self.counters[name] = self.counters.get(name, 0) + amount
+
+	def report(self):
+		"""Return the breakdown printed by the --profile option (times in milliseconds)."""
+		lines = ['{:>10} {:>10}  {}'.format('start (ms)', 'time (ms)', 'phase')]
+		for name, start, duration, depth in sorted(self.phases, key=lambda phase: phase[1]):
+			lines.append('{:>10.1f} {:>10.1f}  {}{}'.format(1000 * start, 1000 * duration, '  ' * depth, name))
+		lines.append('{:>10} {:>10.1f}  total'.format('', 1000 * (time.perf_counter() - self.start_time)))
+		lines.extend('{}: {}'.format(name, value) for name, value in sorted(self.counters.items()))
+		return '\n'.join(lines)
+
+	def record(self, options):
+		"""Return a dictionary describing the run, for the metrics file. Of the command line options (the dictionary
+		options), only the names of those used are included."""
+		return {'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'options': sorted(name for name, value in options.items()
+			if value not in (None, False)), 'total': time.perf_counter() - self.start_time,
+			'phases': [{'name': name, 'start': start, 'duration': duration, 'depth': depth}
+				for name, start, duration, depth in sorted(self.phases, key=lambda phase: phase[1])],
+			'counters': dict(self.counters)}
+
+	def finish(self, options):
+		"""Print the report if enabled and append a JSON record of the run to the metrics file, if there is one."""
+		if self.enabled:
+			print(self.report(), file=sys.stderr)
+		if self.metrics_file:
+			try:
+				with open(self.metrics_file, 'a') as metrics_file:
+					metrics_file.write(json.dumps(self.record(options)) + '\n')
+			except OSError as err:
+				logger.warning('Could not write to metrics file {} ({}).'.format(self.metrics_file, err))
+
+profiler = Profiler()
+
+class PasswordFile:
+	"""Parsed contents of a password file, indexed by application name.
+
+	The contents are kept in a single string, self.text, exactly as they were read (so any formatting the user has
+	in the file is preserved when it is written back). Entries are located by their offsets into self.text.
+
+	Class Variables
+	---------------
+	ENTRY_PATTERN : compiled regular expression
+		Matches a line holding an entry, i.e. an application name followed by whitespace and a password. Group 1 is
+		the application name and group 2 the password (without any leading or trailing whitespace).
+	MALFORMED_PATTERN : compiled regular expression
+		Matches a non-blank line without a password.
+
+	Instance Variables
+	------------------
+	index : dictionary
+		Maps each application name (lower case) to a list of (line_start, pword_start, pword_end) offsets, one for each
+		entry of the application in the order they appear in the file.
+	"""
+	ENTRY_PATTERN = re.compile(r'^[^\S\n]*(\S+)[^\S\n]+(\S(?:[^\n]*\S)?)[^\S\n]*$', re.MULTILINE)
+	MALFORMED_PATTERN = re.compile(r'^[^\S\n]*\S+[^\S\n]*$', re.MULTILINE)
+
+	def __init__(self, text):
+		self.text = text
+		self.index = {}
+		# Single pass over the text. The name of each entry is lowercased exactly once.
+		for match in self.ENTRY_PATTERN.finditer(text):
+			self.index.setdefault(match.group(1).lower(), []).append((match.start(), match.start(2), match.end(2)))
+		# Sorted list of the keys of self.index, only built if needed (see self.sorted_names).
+		self._sorted_names = None
+
+	def __len__(self):
+		return sum(len(offsets) for offsets in self.index.values())
+
+	@property
+	def sorted_names(self):
+		"""Alphabetically ordered list of all application names (lower case)."""
+		if self._sorted_names is None:
+			self._sorted_names = sorted(self.index)
+		return self._sorted_names
+
+	def passwords(self, name):
+		"""Return a list of the passwords for the application name (case insensitive), in file order."""
+		return [self.text[pword_start:pword_end] for _, pword_start, pword_end in self.index.get(name.lower(), [])]
+
+	def names_with_prefix(self, prefix):
+		"""Return an alphabetically ordered list of the application names (lower case) beginning with prefix."""
+		prefix = prefix.lower()
+		names = self.sorted_names
+		start = bisect.bisect_left(names, prefix)
+		end = start
+		while end < len(names) and names[end].startswith(prefix):
+			end += 1
+		return names[start:end]
+
+	def entries(self):
+		"""Yield (name, list of passwords) for every application in alphabetical order. name is as it appears in the
+		first entry for the application."""
+		for lower_name in self.sorted_names:
+			line_start, pword_start, _ = self.index[lower_name][0]
+			yield self.text[line_start:pword_start].split()[0], self.passwords(lower_name)
+
+	def malformed_line_numbers(self):
+		"""Return the line numbers of the lines which are neither blank nor an entry."""
+		return [self.text.count('\n', 0, match.start()) + 1 for match in self.MALFORMED_PATTERN.finditer(self.text)]
+
+	def with_entries(self, new_pwords):
+		"""Return the text of the password file with entries for the applications and passwords in the dictionary
+		new_pwords, together with a dictionary mapping each name in new_pwords to 'added' or 'replaced'. self is
+		not modified.
+
+		If an application already has an entry, its first entry is replaced. Otherwise the new entry is added on the
+		line above the first entry of the application which follows it alphabetically (found by bisection), or
+		appended if there is none. The text is rebuilt from a slice between each pair of consecutive edits, so
+		everything else in the file is copied exactly.
+		"""
+		actions = {}
+		# Each edit is (offset of the start of the text replaced, offset of its end, name, new text).
+		edits = []
+		appended = []
+		names = self.sorted_names
+		# If the same name appears with different case, the last one given wins.
+		latest = {name.lower(): name for name in new_pwords}
+		for name in latest.values():
+			new_entry = name + ' ' + new_pwords[name]
+			if name.lower() in self.index:
+				line_start, _, pword_end = self.index[name.lower()][0]
+				# Replace the whole line, including any trailing whitespace (but not the newline).
+				line_end = self.text.find('\n', pword_end)
+				if line_end == -1:
+					line_end = len(self.text)
+				edits.append((line_start, line_end, name.lower(), new_entry))
+				actions[name] = 'replaced'
+				continue
+			actions[name] = 'added'
+			position = bisect.bisect_left(names, name.lower())
+			if position == len(names):
+				appended.append((name.lower(), new_entry))
+			else:
+				line_start = self.index[names[position]][0][0]
+				edits.append((line_start, line_start, name.lower(), new_entry + '\n'))
+		edits.sort()
+		pieces = []
+		previous_end = 0
+		for start, end, _, new_text in edits:
+			pieces.append(self.text[previous_end:start])
+			pieces.append(new_text)
+			previous_end = end
+		pieces.append(self.text[previous_end:])
+		if appended:
+			# Make sure the new entries do not end up on the same line as the last entry of the file.
+			if self.text and not self.text.endswith('\n'):
+				pieces.append('\n')
+			pieces.extend(new_entry + '\n' for _, new_entry in sorted(appended))
+		return ''.join(pieces), actions
+
+	def without_entries(self, names):
+		"""Return the text of the password file with every entry of the applications in names (case insensitive)
+		removed, together with its newline. self is not modified."""
+		line_starts = sorted(line_start for name in {name.lower() for name in names}
+			for line_start, _, _ in self.index.get(name, []))
+		pieces = []
+		previous_end = 0
+		for line_start in line_starts:
+			pieces.append(self.text[previous_end:line_start])
+			line_end = self.text.find('\n', line_start)
+			previous_end = len(self.text) if line_end == -1 else line_end + 1
+		pieces.append(self.text[previous_end:])
+		return ''.join(pieces)
+
+	@staticmethod
+	def merge_passwords(existing, imported, conflict):
+		"""Return (action, passwords): the passwords an application with the list of passwords existing should have
+		once the list imported is merged into it following the conflict policy ('keep', 'overwrite' or 'append', see
+		Vault.import_entries). action is 'added', 'kept', 'replaced', 'appended' or 'unchanged'."""
+		if not existing:
+			return 'added', imported
+		if conflict == 'keep':
+			return 'kept', existing
+		if conflict == 'overwrite':
+			return ('unchanged' if imported == existing else 'replaced'), imported
+		known = set(existing)
+		new_pwords = [pword for pword in imported if pword not in known]
+		return ('appended' if new_pwords else 'unchanged'), existing + new_pwords
+
+	def merged_with(self, entries, conflict):
+		"""Return the text of the password file with entries, an iterable of (name, list of passwords) pairs sorted
+		by lower case name with no name repeated, merged into it following the conflict policy (see
+		self.merge_passwords), together with a dictionary mapping each name to the action taken. self is not modified.
+
+		The entries and self.sorted_names are walked through together in a single pass, so each new application is
+		placed (as in self.with_entries) above the first entry of the application which follows it alphabetically
+		without a search. Appended passwords go below the last entry of the application, and replaced passwords take
+		the place of its first entry (its other entries are removed).
+		"""
+		actions = {}
+		# Each edit is (offset of the start of the text replaced, offset of its end, new text).
+		edits = []
+		appended = []
+		names = self.sorted_names
+		position = 0
+		for name, passwords in entries:
+			lower_name = name.lower()
+			while position < len(names) and names[position] < lower_name:
+				position += 1
+			offsets = self.index[lower_name] if position < len(names) and names[position] == lower_name else []
+			existing = [self.text[pword_start:pword_end] for _, pword_start, pword_end in offsets]
+			action, passwords = self.merge_passwords(existing, passwords, conflict)
+			actions[name] = action
+			if action == 'added':
+				new_lines = ''.join(name + ' ' + pword + '\n' for pword in passwords)
+				if position == len(names):
+					appended.append(new_lines)
+				else:
+					line_start = self.index[names[position]][0][0]
+					edits.append((line_start, line_start, new_lines))
+			elif action == 'appended':
+				# Insert the new lines before the newline ending the last entry of the application.
+				line_end = self.text.find('\n', offsets[-1][2])
+				line_end = len(self.text) if line_end == -1 else line_end
+				edits.append((line_end, line_end, ''.join('\n' + name + ' ' + pword
+					for pword in passwords[len(existing):])))
+			elif action == 'replaced':
+				line_start, _, pword_end = offsets[0]
+				line_end = self.text.find('\n', pword_end)
+				line_end = len(self.text) if line_end == -1 else line_end
+				edits.append((line_start, line_end, '\n'.join(name + ' ' + pword for pword in passwords)))
+				for line_start, _, pword_end in offsets[1:]:
+					line_end = self.text.find('\n', pword_end)
+					edits.append((line_start, len(self.text) if line_end == -1 else line_end + 1, ''))
+		# Insertions sort before a replacement starting at the same offset and otherwise stay in alphabetical order.
+		edits.sort(key=lambda edit: edit[:2])
+		pieces = []
+		previous_end = 0
+		for start, end, new_text in edits:
+			pieces.append(self.text[previous_end:start])
+			pieces.append(new_text)
+			previous_end = end
+		pieces.append(self.text[previous_end:])
+		if appended:
+			if self.text and not self.text.endswith('\n'):
+				pieces.append('\n')
+			pieces.extend(appended)
+		return ''.join(pieces), actions
+
+class PasswordJournal:
+	"""Changes to a password file which have not yet been merged into it. An update of a 7z archive adds records to the
+	journal instead of sorting and serialising the whole password file again, and the journal is replayed on top of
+	the password file whenever the archive is read (see Vault.commit and Vault.compact). 7z still rewrites the whole
+	archive on every update, so the time an update takes grows with the size of the archive all the same; only
+	native vaults are written in time proportional to the change.
+
+	Each line of the journal is a JSON object recording one change, in the order the changes were made:
+		{"op": "upsert", "name": "application_name", "password": "pword"}
+		{"op": "delete", "name": "application_name"}
+	An upsert replaces the first password of the application, or adds the application if it has none (see
+	PasswordFile.with_entries). A delete removes all passwords of the application (see PasswordFile.without_entries).
+	"""
+	def __init__(self, text=''):
+		self.text = text
+		self.records = []
+		for line_num, line in enumerate(text.splitlines(), 1):
+			if not line.strip():
+				continue
+			try:
+				record = json.loads(line)
+			except ValueError:
+				record = None
+			if not (isinstance(record, dict) and record.get('op') in {'upsert', 'delete'}
+					and isinstance(record.get('name'), str)
+					and (record['op'] == 'delete' or isinstance(record.get('password'), str))):
+				logger.warning('Invalid record on line {} of the journal ignored.'.format(line_num))
+				continue
+			self.records.append(record)
+
+	def __len__(self):
+		return len(self.records)
+
+	def size(self):
+		"""Size of the journal in bytes."""
+		return len(self.text.encode())
+
+	def with_records(self, records):
+		"""Return a new journal holding the records of self followed by records. self is not modified."""
+		return PasswordJournal(self.text + ''.join(json.dumps(record) + '\n' for record in records))
+
+	def with_upserts(self, new_pwords):
+		"""Return a new journal which also sets the passwords of the applications in the dictionary new_pwords."""
+		return self.with_records({'op': 'upsert', 'name': name, 'password': new_pword}
+			for name, new_pword in new_pwords.items())
+
+	def with_deletion(self, name):
+		"""Return a new journal which also deletes the application name."""
+		return self.with_records([{'op': 'delete', 'name': name}])
+
+	def changes(self):
+		"""Return (set of deleted names (lower case), dictionary of new passwords keyed by name) with the same effect
+		as replaying every record in order: the deleted applications are removed first, then the new passwords set."""
+		deleted = set()
+		# (name, password) of the latest upsert of each application since it was last deleted, keyed by lower case name.
+		upserts = {}
+		for record in self.records:
+			lower_name = record['name'].lower()
+			if record['op'] == 'delete':
+				deleted.add(lower_name)
+				upserts.pop(lower_name, None)
+			else:
+				upserts[lower_name] = (record['name'], record['password'])
+		return deleted, dict(upserts.values())
+
+	def apply(self, text):
+		"""Return text, the contents of a password file, with the changes in the journal made to it."""
+		if not self.records:
+			return text
+		deleted, new_pwords = self.changes()
+		password_file = PasswordFile(text)
+		if deleted:
+			password_file = PasswordFile(password_file.without_entries(deleted))
+		if not new_pwords:
+			return password_file.text
+		return password_file.with_entries(new_pwords)[0]
+
+class PwmgrError(Exception):
+	"""Base class of the exceptions raised when an archive cannot be read or written (see Vault)."""
+
+class VaultError(PwmgrError):
+	"""Raised when a native vault cannot be read or written, e.g. due to an incorrect password or a corrupt file, and
+	when a Vault is used before it is opened."""
+
+class NativeVault:
+	"""Password vault in pwmgr's own file format, in which the entry of every application is encrypted separately.
+	A lookup only decrypts the name index and one entry, and an update only appends one entry to the file.
+
+	File format
+	-----------
+	MAGIC (8 bytes) | index offset (8) | parameters length (4) | parameters (JSON) | record | record | ...
+
+	The parameters give the salt and cost of the scrypt key derivation (memory-hard) used to obtain the key from the
+	vault password, and the cipher. Each record is
+		length of the rest of the record (4) | kind (1) | nonce (12) | ciphertext and tag
+	sealed with ChaCha20-Poly1305. Its associated data are the parameters, the kind and the offset of the record,
+	so records cannot be moved within or between vaults undetected. Entry records (kind b'E') hold a JSON object
+	with the application's name and its list of passwords (an empty list deletes the application). Index records
+	(kind b'I') hold a JSON object with keys offsets, mapping each application name (lower case) to the offset of its
+	latest entry record, and garbage, the number of bytes taken up by records which have been superseded (index
+	records written before garbage was recorded hold only the mapping). The index offset in the header points to the
+	latest index record. Entry records after it are replayed on top of it when the vault is unlocked, and a new index
+	record is appended once there are INDEX_INTERVAL of them. All integers are unsigned and big endian.
+
+	Superseded records are only removed when the vault is compacted (see compact), which rewrites it.
+
+	Encryption uses the cryptography package, which is only imported when a vault is used.
+
+	Class Variables
+	---------------
+	FILE_EXTENSION : string
+		Extension of vault files (used to list and create vaults).
+	INDEX_INTERVAL : int
+		Number of entry records appended after the latest index record before a new index record is written.
+	KDF_PARAMETERS : dictionary
+		scrypt cost parameters for new vaults (memory used is 128 * n * r bytes).
+	MAGIC : bytes
+		First bytes of every vault file.
+	"""
+	FILE_EXTENSION = '.pwv'
+	INDEX_INTERVAL = 64
+	KDF_PARAMETERS = {'n': 2 ** 15, 'r': 8, 'p': 1}
+	MAGIC = b'PWMGRV1\n'
+
+	def __init__(self, path):
+		self.path = path
+		self.read_header()
+		# Set by self.unlock. self.offsets maps each application name (lower case) to the offset of its entry record.
+		self.cipher = None
+		self.offsets = {}
+		# Offset just after the last complete record and number of entry records after the latest index record.
+		self.end_offset = self.records_offset
+		self.tail_records = 0
+		# Number of bytes taken up by superseded records (see self.compact).
+		self.garbage = 0
+
+	def read_header(self):
+		"""Read the offset of the latest index record and the parameters from the header of the vault."""
+		with open(self.path, 'rb') as vault_file:
+			header = vault_file.read(20)
+			if len(header) < 20 or header[:8] != self.MAGIC:
+				raise VaultError('{} is not a pwmgr vault.'.format(self.path))
+			self.index_offset = int.from_bytes(header[8:16], 'big')
+			self.parameters_bytes = vault_file.read(int.from_bytes(header[16:20], 'big'))
+		self.parameters = json.loads(self.parameters_bytes.decode())
+		# Offset of the first record.
+		self.records_offset = 20 + len(self.parameters_bytes)
+
+	@classmethod
+	def is_vault(cls, path):
+		"""Return True if the file at path is a vault (rather than, e.g., a 7z archive)."""
+		try:
+			with open(path, 'rb') as vault_file:
+				return vault_file.read(len(cls.MAGIC)) == cls.MAGIC
+		except OSError:
+			return False
+
+	@classmethod
+	def create(cls, path, password, entries=()):
+		"""Create a new vault at path (which must not exist) protected by password and holding entries, an iterable
+		of (name, list of passwords) pairs. Return the (unlocked) vault.
+
+		The vault is written to a temporary file which is renamed to path once complete.
+		"""
+		return cls.write_new(path, cls.new_parameters_bytes(), entries, lambda vault: vault.derive_cipher(password))
+
+	@classmethod
+	def new_parameters_bytes(cls):
+		"""Return the parameters (encoded JSON, see the class docstring) of a new vault, with a new random salt."""
+		parameters = dict(cls.KDF_PARAMETERS, kdf='scrypt', salt=os.urandom(16).hex(), cipher='chacha20poly1305')
+		return json.dumps(parameters, sort_keys=True).encode()
+
+	@classmethod
+	def write_new(cls, path, parameters_bytes, entries, make_cipher):
+		"""Write a vault with the given parameters holding entries to a temporary file and rename it to path. The
+		cipher is obtained by calling make_cipher with the new vault. Return the (unlocked) vault."""
+		path_temp = '{}.{}.tmp'.format(path, os.getpid())
+		with open(path_temp, 'xb') as vault_file:
+			vault_file.write(cls.MAGIC + bytes(8) + len(parameters_bytes).to_bytes(4, 'big') + parameters_bytes)
+		try:
+			vault = cls(path_temp)
+			vault.cipher = make_cipher(vault)
+			vault.append_entries(entries)
+			if vault.tail_records or not vault.index_offset:
+				vault.write_index()
+			NativeVault.fsync_and_replace(path_temp, path)
+		finally:
+			if os.path.exists(path_temp):
+				os.remove(path_temp)
+		vault.path = path
+		return vault
+
+	@staticmethod
+	def fsync_and_replace(path_source, path_destination):
+		"""Flush the file path_source to disk and atomically rename it to path_destination."""
+		with open(path_source, 'rb') as source_file:
+			os.fsync(source_file.fileno())
+		os.replace(path_source, path_destination)
+
+	def derive_cipher(self, password):
+		"""Derive the vault key from password and return a cipher object using it."""
+		try:
+			from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+		except ImportError:
+			raise VaultError('Native vaults require the cryptography package (pip install cryptography).')
+		if self.parameters.get('kdf') != 'scrypt' or self.parameters.get('cipher') != 'chacha20poly1305':
+			raise VaultError('{} uses an unsupported key derivation function or cipher.'.format(self.path))
+		import hashlib
+		n, r, p = self.parameters['n'], self.parameters['r'], self.parameters['p']
+		with profiler.phase('key derivation'):
+			key = hashlib.scrypt(password.encode(), salt=bytes.fromhex(self.parameters['salt']), n=n, r=r, p=p,
+				maxmem=256 * n * r, dklen=32)
+		return ChaCha20Poly1305(key)
+
+	def associated_data(self, kind, offset):
+		return self.parameters_bytes + kind + offset.to_bytes(8, 'big')
+
+	def read_record(self, vault_file, offset):
+		"""Read and decrypt the record at offset in the open vault_file. Return (kind, plaintext, offset of the next
+		record), or None if there is no complete record at offset (end of file or an interrupted append)."""
+		from cryptography.exceptions import InvalidTag
+		vault_file.seek(offset)
+		head = vault_file.read(17)
+		if len(head) < 17:
+			return None
+		length = int.from_bytes(head[:4], 'big')
+		kind, nonce = head[4:5], head[5:17]
+		sealed = vault_file.read(length - 13)
+		if len(sealed) < length - 13:
+			return None
+		try:
+			plaintext = self.cipher.decrypt(nonce, sealed, self.associated_data(kind, offset))
+		except InvalidTag:
+			raise IncorrectPasswordError('Could not decrypt {} (incorrect password or corrupt vault).'.format(self.path))
+		return kind, plaintext, offset + 4 + length
+
+	@staticmethod
+	def record_size(vault_file, offset):
+		"""Return the size in bytes of the record at offset in the open vault_file, without decrypting it."""
+		vault_file.seek(offset)
+		return 4 + int.from_bytes(vault_file.read(4), 'big')
+
+	def append_records(self, records):
+		"""Encrypt and append records, a list of (kind, plaintext) pairs, to the vault and flush it to disk. Return the
+		list of their offsets."""
+		offsets = []
+		with open(self.path, 'r+b') as vault_file:
+			# Drop anything left by an interrupted append.
+			vault_file.truncate(self.end_offset)
+			vault_file.seek(self.end_offset)
+			for kind, plaintext in records:
+				offset = vault_file.tell()
+				nonce = os.urandom(12)
+				sealed = self.cipher.encrypt(nonce, plaintext, self.associated_data(kind, offset))
+				vault_file.write((13 + len(sealed)).to_bytes(4, 'big') + kind + nonce + sealed)
+				offsets.append(offset)
+			vault_file.flush()
+			os.fsync(vault_file.fileno())
+			profiler.count('bytes written', vault_file.tell() - self.end_offset)
+			self.end_offset = vault_file.tell()
+		return offsets
+
+	def append_entries(self, entries):
+		"""Append an entry record for each (name, list of passwords) pair in entries and update self.offsets. If the
+		list of passwords is empty, the application is deleted."""
+		entries = list(entries)
+		# The records of applications which already have one are superseded.
+		with open(self.path, 'rb') as vault_file:
+			self.garbage += sum(self.record_size(vault_file, self.offsets[name.lower()]) for name, _ in entries
+				if name.lower() in self.offsets)
+		records = [(b'E', json.dumps({'name': name, 'passwords': passwords}).encode()) for name, passwords in entries]
+		offsets = self.append_records(records)
+		for (name, passwords), offset, next_offset in zip(entries, offsets, offsets[1:] + [self.end_offset]):
+			if passwords:
+				self.offsets[name.lower()] = offset
+			else:
+				# Nothing refers to a deletion once it has been replayed.
+				self.offsets.pop(name.lower(), None)
+				self.garbage += next_offset - offset
+		self.tail_records += len(entries)
+		if self.tail_records >= self.INDEX_INTERVAL:
+			self.write_index()
+
+	def write_index(self):
+		"""Append an index record holding self.offsets and point the header at it."""
+		if self.index_offset:
+			with open(self.path, 'rb') as vault_file:
+				self.garbage += self.record_size(vault_file, self.index_offset)
+		offset, = self.append_records([(b'I', json.dumps({'offsets': self.offsets, 'garbage': self.garbage}).encode())])
+		with open(self.path, 'r+b') as vault_file:
+			vault_file.seek(len(self.MAGIC))
+			vault_file.write(offset.to_bytes(8, 'big'))
+			vault_file.flush()
+			os.fsync(vault_file.fileno())
+		self.index_offset = offset
+		self.tail_records = 0
+
+	def unlock(self, password):
+		"""Derive the key from password, decrypt the latest index and replay the entry records appended after it.
+		Raise VaultError if the password is incorrect."""
+		self.set_key(password)
+		self.read_index()
+
+	def set_key(self, password):
+		"""Derive the key from password, without reading any record (see self.reload)."""
+		self.read_header()
+		self.cipher = self.derive_cipher(password)
+
+	def reload(self):
+		"""Read the (unlocked) vault again with the same key, e.g. after another process has appended to or compacted
+		it. Raise VaultError if its key has been changed (see self.rekey)."""
+		parameters_bytes = self.parameters_bytes
+		self.read_header()
+		if self.parameters_bytes != parameters_bytes:
+			raise VaultError('The password of {} has been changed.'.format(self.path))
+		self.read_index()
+
+	def read_index(self):
+		"""Decrypt the latest index and replay the entry records appended after it."""
+		with open(self.path, 'rb') as vault_file:
+			record = self.read_record(vault_file, self.index_offset) if self.index_offset else None
+			if record is None or record[0] != b'I':
+				raise VaultError('{} has no index (corrupt vault).'.format(self.path))
+			_, plaintext, offset = record
+			index = json.loads(plaintext.decode())
+			if isinstance(index.get('offsets'), dict):
+				self.offsets, self.garbage = index['offsets'], index['garbage']
+			else:
+				self.offsets, self.garbage = index, 0
+			self.tail_records = 0
+			while True:
+				record = self.read_record(vault_file, offset)
+				if record is None:
+					break
+				kind, plaintext, next_offset = record
+				if kind == b'E':
+					entry = json.loads(plaintext.decode())
+					if entry['name'].lower() in self.offsets:
+						self.garbage += self.record_size(vault_file, self.offsets[entry['name'].lower()])
+					if entry['passwords']:
+						self.offsets[entry['name'].lower()] = offset
+					else:
+						self.offsets.pop(entry['name'].lower(), None)
+						self.garbage += next_offset - offset
+					self.tail_records += 1
+				offset = next_offset
+			self.end_offset = offset
+
+	def lock(self):
+		"""Forget the key and the index."""
+		self.cipher = None
+		self.offsets = {}
+
+	def names(self):
+		"""Return an alphabetically ordered list of all application names (lower case)."""
+		return sorted(self.offsets)
+
+	def entry(self, name, vault_file=None):
+		"""Return (name as stored, list of passwords) for the application name (case insensitive), or None if the
+		vault has no entry for it. Only this entry's record is read and decrypted."""
+		if name.lower() not in self.offsets:
+			return None
+		if vault_file is None:
+			with open(self.path, 'rb') as vault_file:
+				return self.entry(name, vault_file)
+		_, plaintext, _ = self.read_record(vault_file, self.offsets[name.lower()])
+		entry = json.loads(plaintext.decode())
+		return entry['name'], entry['passwords']
+
+	def get(self, name):
+		"""Return the list of passwords for the application name (case insensitive), empty if there are none."""
+		entry = self.entry(name)
+		return entry[1] if entry else []
+
+	def entries(self):
+		"""Yield (name, list of passwords) for every application, in alphabetical order."""
+		with open(self.path, 'rb') as vault_file:
+			for name in self.names():
+				yield self.entry(name, vault_file)
+
+	def upsert_many(self, new_pwords):
+		"""Set the (first) password of each application in the dictionary new_pwords, appending a single entry record
+		per application. Return a dictionary mapping each name to 'added' or 'replaced'."""
+		# If the same name appears with different case, the last one given wins.
+		latest = {name.lower(): name for name in new_pwords}
+		actions = {}
+		entries = []
+		for name in latest.values():
+			existing = self.get(name)
+			actions[name] = 'replaced' if existing else 'added'
+			entries.append((name, [new_pwords[name]] + existing[1:]))
+		self.append_entries(entries)
+		return actions
+
+	def delete(self, name):
+		"""Delete all passwords for the application name. Return False if there were none."""
+		if name.lower() not in self.offsets:
+			return False
+		self.append_entries([(name, [])])
+		return True
+
+	def live_size(self):
+		"""Return the number of bytes taken up by records which have not been superseded."""
+		return self.end_offset - self.records_offset - self.garbage
+
+	def compact(self):
+		"""Rewrite the vault with only the latest entry of every application and a single index record, dropping
+		all superseded records. The key is unchanged. As for a new vault, the compacted vault is written to a temporary
+		file which is renamed over the vault once complete."""
+		compacted = self.write_new(self.path, self.parameters_bytes, list(self.entries()), lambda vault: self.cipher)
+		self.index_offset, self.offsets = compacted.index_offset, compacted.offsets
+		self.end_offset, self.tail_records, self.garbage = compacted.end_offset, 0, compacted.garbage
+
+	def rekey(self, new_password):
+		"""Rewrite the (unlocked) vault with a new salt and a key derived from new_password, holding the latest entry of
+		every application as self.compact does. The entries are decrypted one at a time as they are written to the
+		new vault, which is renamed over the vault once complete."""
+		rekeyed = self.write_new(self.path, self.new_parameters_bytes(), self.entries(),
+			lambda vault: vault.derive_cipher(new_password))
+		self.parameters_bytes, self.parameters, self.records_offset = (rekeyed.parameters_bytes, rekeyed.parameters,
+			rekeyed.records_offset)
+		self.cipher, self.index_offset, self.offsets = rekeyed.cipher, rekeyed.index_offset, rekeyed.offsets
+		self.end_offset, self.tail_records, self.garbage = rekeyed.end_offset, 0, rekeyed.garbage
+
+	def to_text(self):
+		"""Return the contents of the vault in the format of the password file of a 7z archive."""
+		return ''.join('{} {}\n'.format(name, pword) for name, passwords in self.entries() for pword in passwords)
+
+class ArchiveError(PwmgrError):
+	"""Raised by an archive backend when an archive cannot be read or written, e.g. due to an incorrect password or
+	a failure of the 7z program."""
+
+class IncorrectPasswordError(ArchiveError, VaultError):
+	"""Raised when an archive or native vault cannot be decrypted with the password given. A corrupt file may fail
+	in the same way, so this only means that the password is most likely incorrect."""
+
+class ArchiveBackend:
+	"""Interface to an encrypted 7z archive, opened with its password. The backend used is chosen by the
+	archive_backend setting (see Vault.ARCHIVE_BACKENDS); subclasses implement read_member_at, write_copy,
+	write_rekeyed_copy and create.
+
+	Members are read with read_member (or iter_member_lines, which yields lines as they are decrypted). Members
+	written with write_member are only staged until commit writes them to the archive (or fails). A commit never
+	modifies the archive in place: the staged members are written to a copy of the archive in the same directory
+	(keeping any other files in the archive), read back and checked, and the copy is flushed to disk and renamed over
+	the original. If anything fails the original archive is untouched. rekey replaces the archive in the same way.
+	All methods raise ArchiveError on failure.
+	"""
+	def __init__(self, path_archive, password):
+		self.path_archive = path_archive
+		self.password = password
+		# Contents of members to be written by the next commit, keyed by member name.
+		self.staged_members = {}
+
+	def read_member(self, name):
+		"""Return the contents (string) of the member name of the archive, or '' if there is no such member."""
+		text = self.read_member_at(self.path_archive, name)
+		profiler.count('bytes read', len(text))
+		return text
+
+	def read_members(self, names):
+		"""Return a dictionary mapping each member name in names to its contents ('' if there is no such member)."""
+		return {name: self.read_member(name) for name in names}
+
+	def iter_member_lines(self, name):
+		"""Yield the lines of the member name (keeping line endings). Closing the generator stops the extraction."""
+		yield from self.read_member(name).splitlines(keepends=True)
+
+	def write_member(self, name, text):
+		"""Stage text as the new contents of the member name."""
+		self.staged_members[name] = text
+
+	def commit(self):
+		"""Write all staged members to the archive atomically (see the class docstring)."""
+		profiler.count('bytes written', sum(len(text) for text in self.staged_members.values()))
+		try:
+			self.replace_archive(self.write_checked_copy)
+		finally:
+			# Whether or not the commit succeeded, the next one starts afresh.
+			self.staged_members = {}
+
+	def write_checked_copy(self, path_temp_archive):
+		"""Write the archive with the staged members to path_temp_archive (see write_copy), and check it can be read
+		with the archive password and holds exactly the staged members."""
+		self.write_copy(path_temp_archive)
+		for name, text in self.staged_members.items():
+			if self.read_member_at(path_temp_archive, name) != text:
+				raise ArchiveError('Verification of the updated archive failed. {} was not modified.'.format(
+					os.path.basename(self.path_archive)))
+
+	def rekey(self, new_password):
+		"""Encrypt every member of the archive with new_password instead of the archive password, replacing the archive
+		atomically as commit does (see write_rekeyed_copy). The backend then uses new_password."""
+		self.replace_archive(lambda path_temp_archive: self.write_rekeyed_copy(path_temp_archive, new_password))
+		self.password = new_password
+
+	def replace_archive(self, write_copy):
+		"""Call write_copy with the path of a new file in the directory of the archive, where it must write and check
+		the new archive, then flush that file to disk and rename it over the archive. If anything fails, the new file
+		(and any temporary file a 7z process writing it left behind) is removed and the archive is untouched."""
+		# Hidden, unique name in the same directory (os.replace is only atomic within a file system). Ending in .7z
+		# avoids the 7z quirk of appending the extension (see note in PassManager.make_new_archive()). The thread is
+		# included as archives may be replaced by several threads at once (see PassManager.rekey_archives).
+		path_temp_archive = os.path.join(os.path.dirname(self.path_archive), '.{}.{}.{}.tmp.7z'.format(
+			os.path.basename(self.path_archive), os.getpid(), threading.get_ident()))
+		try:
+			write_copy(path_temp_archive)
+			self.fsync_path(path_temp_archive)
+			os.replace(path_temp_archive, self.path_archive)
+			# Make the rename itself durable.
+			self.fsync_path(os.path.dirname(self.path_archive) or os.curdir)
+		except OSError as err:
+			raise ArchiveError('Could not write {} ({}).'.format(os.path.basename(self.path_archive), err))
+		finally:
+			self.remove_temp_files(path_temp_archive)
+
+	@staticmethod
+	def remove_temp_files(path_temp_archive):
+		"""Remove the file path_temp_archive and every file in its directory whose name begins with its name, such as
+		the temporary file 7z writes beside an archive it updates (which a killed process leaves behind)."""
+		directory, temp_name = os.path.split(path_temp_archive)
+		for filename in os.listdir(directory or os.curdir):
+			if filename.startswith(temp_name):
+				with contextlib.suppress(FileNotFoundError):
+					os.remove(os.path.join(directory, filename))
+
+	@staticmethod
+	def fsync_path(path):
+		"""Flush the file or directory at path to disk."""
+		fd = os.open(path, os.O_RDONLY)
+		try:
+			os.fsync(fd)
+		finally:
+			os.close(fd)
+
+class ThroughputStats:
+	"""How fast the 7z program reads and writes archives on this machine, kept in a small JSON file, so that the
+	timeout of a 7z process can follow the size of the archive it works on (see SevenZipBackend.timeout_for) rather
+	than being the same for every archive.
+
+	The rate (bytes of archive per second) of each kind of process, 'read' (extraction and listing) or 'write'
+	(update), is a moving average of the rates measured, weighted towards the latest. A process killed for taking too
+	long sets the rate to the most it can have been, so a timeout which proved too short is lengthened next time.
+	Archives smaller than MIN_SAMPLE_BYTES are not measured, as the start-up of 7z takes most of their time.
+
+	Class Variables
+	---------------
+	DEFAULT_BYTES_PER_SECOND : dictionary
+		Rate of each kind of process assumed until it has been measured (that of a slow disk).
+	MIN_SAMPLE_BYTES : int
+		Size of the smallest archive whose processes are measured.
+	SAFETY_FACTOR : float
+		How many times longer than expected a process may take before it is killed.
+	SMOOTHING : float
+		Weight of the latest measurement in the moving average.
+	"""
+	DEFAULT_BYTES_PER_SECOND = {'read': 4 * 2 ** 20, 'write': 2 ** 19}
+	MIN_SAMPLE_BYTES = 2 ** 20
+	SAFETY_FACTOR = 4
+	SMOOTHING = 0.3
+
+	def __init__(self, path):
+		self.path = path
+		# Read from self.path when first needed (see self.rates). Processes may be timed by several threads at once.
+		self.bytes_per_second = None
+		self.lock = threading.Lock()
+
+	def rates(self):
+		"""Return the dictionary of the rate of each kind of process, reading it from self.path the first time."""
+		if self.bytes_per_second is None:
+			self.bytes_per_second = dict(self.DEFAULT_BYTES_PER_SECOND)
+			try:
+				with open(self.path, 'r') as stats_file:
+					stats = json.load(stats_file)
+				for kind in self.DEFAULT_BYTES_PER_SECOND:
+					if float(stats.get(kind, 0)) > 0:
+						self.bytes_per_second[kind] = float(stats[kind])
+			except FileNotFoundError:
+				pass
+			except (OSError, ValueError, TypeError, AttributeError) as err:
+				logger.debug('Ignoring 7z throughput file {} ({}).'.format(self.path, err))
+		return self.bytes_per_second
+
+	def expected_seconds(self, kind, size):
+		"""Return the number of seconds a process of kind is expected to take for an archive of size bytes."""
+		return size / self.rates()[kind]
+
+	def timeout(self, kind, size, minimum):
+		"""Return the number of seconds after which a process of kind, for an archive of size bytes, is killed: minimum
+		(for the start-up of 7z) plus SAFETY_FACTOR times the time expected."""
+		return minimum + self.SAFETY_FACTOR * self.expected_seconds(kind, size)
+
+	def record(self, kind, size, seconds, timed_out=False):
+		"""Record that a process of kind took seconds for an archive of size bytes (or was killed after seconds if
+		timed_out), and save the rates."""
+		if size < self.MIN_SAMPLE_BYTES or seconds <= 0:
+			return
+		with self.lock:
+			rates = self.rates()
+			if timed_out:
+				rates[kind] = min(rates[kind], size / seconds)
+			else:
+				rates[kind] += self.SMOOTHING * (size / seconds - rates[kind])
+			self.save()
+
+	def save(self):
+		"""Write the rates to self.path (replacing it atomically). Failing to is not an error, only logged."""
+		path_temp = '{}.{}.tmp'.format(self.path, os.getpid())
+		try:
+			os.makedirs(os.path.dirname(self.path) or os.curdir, exist_ok=True)
+			with open(path_temp, 'w') as stats_file:
+				json.dump(self.bytes_per_second, stats_file)
+			os.replace(path_temp, self.path)
+		except OSError as err:
+			logger.debug('Could not write 7z throughput file {} ({}).'.format(self.path, err))
+
+class ProgressIndicator:
+	"""Shows on a terminal how long a slow 7z process has been running, and roughly how much longer it should take,
+	so that the extraction or update of a large archive is not mistaken for a hang. Nothing is shown for a process
+	which finishes within DELAY seconds, and only one process is shown at a time (the first of those started at once,
+	e.g. by --rekey -aa).
+
+	Class Variables
+	---------------
+	DELAY : float
+		Number of seconds a process runs before it is shown.
+	INTERVAL : float
+		Number of seconds between updates of the line shown.
+	"""
+	DELAY = 1.0
+	INTERVAL = 0.5
+
+	def __init__(self, out_file=None):
+		self.out_file = out_file or sys.stderr
+		self.lock = threading.Lock()
+		self.active = False
+
+	@contextlib.contextmanager
+	def track(self, description, expected_seconds=None):
+		"""Context manager showing description and the time elapsed (and left, if expected_seconds is given) on a line
+		of its own, rewritten every INTERVAL seconds from DELAY seconds after the context is entered. The line is
+		erased when the context is left."""
+		with self.lock:
+			busy, self.active = self.active, True
+		if busy:
+			yield
+			return
+		stopped = threading.Event()
+		thread = threading.Thread(target=self.show, args=(description, expected_seconds, stopped), daemon=True)
+		thread.start()
+		try:
+			yield
+		finally:
+			stopped.set()
+			thread.join()
+			with self.lock:
+				self.active = False
+
+	def show(self, description, expected_seconds, stopped):
+		"""Show the progress of description until stopped is set (run in a thread of its own by self.track)."""
+		start_time = time.perf_counter()
+		if stopped.wait(self.DELAY):
+			return
+		try:
+			while True:
+				elapsed = time.perf_counter() - start_time
+				status = '{:.0f} s'.format(elapsed)
+				if expected_seconds and expected_seconds > elapsed:
+					status += ', about {:.0f} s left'.format(expected_seconds - elapsed)
+				# Return to the start of the line and erase what was there.
+				self.out_file.write('\r{} ({})\u001b[K'.format(description, status))
+				self.out_file.flush()
+				if stopped.wait(self.INTERVAL):
+					break
+			self.out_file.write('\r\u001b[K')
+			self.out_file.flush()
+		except (OSError, ValueError):
+			# The terminal has gone (or standard error was closed).
+			pass
+
+class SevenZipBackend(ArchiveBackend):
+	"""Archive backend running the 7z program (7z_application setting) in a subprocess for every read and write.
+
+	For the command line usage of the 7z program, see https://sevenzip.osdn.jp/chm/cmdline/
+
+	A 7z process is killed if it has not finished after timeout seconds (never if timeout is None) or, if throughput
+	(a ThroughputStats) is given, after timeout seconds plus a multiple of the time it is expected to take for the size
+	of the archive (see self.timeout_for). If progress (a ProgressIndicator) is given, it shows the processes which
+	take more than a moment. A process is never left running (or unwaited for) when a method returns or raises.
+
+	Class Variables
+	---------------
+	STOP_GRACE : float
+		Number of seconds a 7z process writing an archive is given to exit, removing its temporary files, after it is
+		asked to stop (with SIGTERM), before it is killed.
+	"""
+	STOP_GRACE = 2
+
+	def __init__(self, path_archive, password, path_7z='7z', timeout=5, throughput=None, progress=None):
+		super().__init__(path_archive, password)
+		self.path_7z = path_7z
+		self.timeout = timeout
+		self.throughput = throughput
+		self.progress = progress
+
+	def read_members(self, names):
+		"""As ArchiveBackend.read_members, but the 7z processes extracting each member run at the same time."""
+		import concurrent.futures
+		with concurrent.futures.ThreadPoolExecutor(max_workers=len(names) or 1) as executor:
+			futures = {name: executor.submit(self.read_member, name) for name in names}
+			return {name: future.result() for name, future in futures.items()}
+
+	def run(self, process_args, process_input=None, process_name='', kind='read', size=0):
+		"""Run a process described by process_args. Use process_input, if provided, capture any output and return 
+		to caller. kind ('read' or 'write') and size (bytes) describe the archive the process works on, from which its
+		timeout is found (see self.timed). If there are errors or the process times out, raise ArchiveError.
+
+		For subprocess usage, see the official python docs and my subprocess_test.py testing script.
+		"""
+		with self.timed('{} of {}'.format(process_name, os.path.basename(self.path_archive)), kind, size) as timeout:
+			try:
+				# Run a command described by process_args and capture both stdout and stderr (not captured by
+				# default). universal_newlines=True -> stdout and stderr will be text rather than bytes (this uses the
+				# io.TextIOWrapper default encoding).
+				with profiler.subprocess_phase(process_args):
+					process = subprocess.Popen(process_args, stdin=None if process_input is None else subprocess.PIPE,
+						stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+					try:
+						# Waits for the process to finish, raising subprocess.TimeoutExpired after timeout seconds.
+						stdout, stderr = process.communicate(process_input, timeout=timeout)
+					except subprocess.TimeoutExpired:
+						# Stop the process, then collect what it wrote (which also waits for it, leaving no zombie).
+						self.stop(process, graceful=kind == 'write')
+						stdout, stderr = process.communicate()
+						# Notify user of any error.
+						error_message = '{} process failed to complete after {:.0f} seconds.'.format(process_name,
+							timeout)
+						if stderr:
+							error_message += ' There were the following errors: {}'.format(stderr.strip())
+						raise ArchiveError(error_message)
+					finally:
+						# E.g. if interrupted by the user.
+						self.stop(process)
+			except OSError as err:
+				raise ArchiveError('Could not run {} ({}).'.format(self.path_7z, err))
+		# The password is not logged.
+		logger.debug('{} process {} {} completed with return code {}.'.format(
+			process_name, process_args[0], process_args[1], process.returncode))
+		# 7z will give error if password is incorrect.
+		if stderr != '':
+			raise self.error(stderr.strip())
+		return stdout
+
+	def timeout_for(self, kind, size):
+		"""Return the number of seconds a 7z process of kind ('read' or 'write') working on an archive of size bytes
+		may run: self.timeout, plus the time allowed by self.throughput for the size (see ThroughputStats.timeout) if
+		that is set. None means no limit."""
+		if self.timeout is None or self.throughput is None:
+			return self.timeout
+		return self.throughput.timeout(kind, size, self.timeout)
+
+	@contextlib.contextmanager
+	def timed(self, description, kind, size):
+		"""Context manager around a 7z process of kind ('read' or 'write') working on an archive of size bytes, which
+		yields its timeout (see self.timeout_for). While it runs, self.progress shows the process as description, and
+		once it has succeeded, or raised ArchiveError by timing out, self.throughput records how long it took."""
+		timeout = self.timeout_for(kind, size)
+		expected_seconds = self.throughput.expected_seconds(kind, size) if self.throughput else None
+		start_time = time.perf_counter()
+		with self.progress.track(description, expected_seconds) if self.progress else contextlib.ExitStack():
+			try:
+				yield timeout
+			except ArchiveError:
+				elapsed = time.perf_counter() - start_time
+				if self.throughput and timeout is not None and elapsed >= timeout:
+					self.throughput.record(kind, size, elapsed, timed_out=True)
+				raise
+		if self.throughput:
+			self.throughput.record(kind, size, time.perf_counter() - start_time)
+
+	@classmethod
+	def stop(cls, process, graceful=False):
+		"""Stop process, if it is still running, and wait for it. If graceful, it is first asked to stop (so that 7z
+		may remove any temporary file it is writing) and only killed if it has not exited after STOP_GRACE seconds."""
+		if process.poll() is not None:
+			return
+		if graceful:
+			process.terminate()
+			try:
+				process.wait(timeout=cls.STOP_GRACE)
+				return
+			except subprocess.TimeoutExpired:
+				pass
+		process.kill()
+		process.wait()
+
+	@staticmethod
+	def archive_size(path_archive):
+		"""Return the size in bytes of the archive at path_archive (0 if it cannot be found)."""
+		try:
+			return os.path.getsize(path_archive)
+		except OSError:
+			return 0
+
+	@staticmethod
+	def error(message):
+		"""Return the exception for message, the errors written by 7z: IncorrectPasswordError if 7z blames the password
+		(e.g. 'Can not open encrypted archive. Wrong password?'), otherwise ArchiveError."""
+		return (IncorrectPasswordError if 'Wrong password' in message else ArchiveError)(message)
+
+	def read_member_at(self, path_archive, name):
+		# Note, it is fine for self.password to be an empty string (archive not password protected).
+		extract_args = [self.path_7z, 'e', path_archive, name, '-so', '-p' + self.password]
+		return self.run(extract_args, process_name='Extraction', size=self.archive_size(path_archive))
+
+	def iter_member_lines(self, name):
+		"""Yield the lines of the member name as 7z outputs them, rather than buffering its whole output first. If the
+		generator is closed early, 7z is killed, so nothing after the last line read is decrypted."""
+		extract_args = [self.path_7z, 'e', self.path_archive, name, '-so', '-p' + self.password]
+		with self.timed('Extraction of {}'.format(os.path.basename(self.path_archive)), 'read',
+				self.archive_size(self.path_archive)) as timeout:
+			try:
+				process = subprocess.Popen(extract_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+					universal_newlines=True)
+			except OSError as err:
+				raise ArchiveError('Could not run {} ({}).'.format(self.path_7z, err))
+			# Kill the process if it has not finished after timeout seconds (a blocked read cannot time out itself).
+			timed_out = threading.Event()
+			def kill_on_timeout():
+				timed_out.set()
+				process.kill()
+			timer = threading.Timer(timeout, kill_on_timeout) if timeout is not None else None
+			if timer:
+				timer.daemon = True
+				timer.start()
+			bytes_read = 0
+			try:
+				with profiler.subprocess_phase(extract_args):
+					for line in process.stdout:
+						bytes_read += len(line)
+						yield line
+					errors = process.stderr.read()
+					process.wait()
+			finally:
+				if timer:
+					timer.cancel()
+				# Nothing is written by the extraction, so it is killed at once.
+				self.stop(process)
+				process.stdout.close()
+				process.stderr.close()
+				profiler.count('bytes read', bytes_read)
+			if timed_out.is_set():
+				raise ArchiveError('Extraction process failed to complete after {:.0f} seconds.'.format(timeout))
+		# 7z will give error if password is incorrect.
+		if errors:
+			raise self.error(errors.strip())
+
+	def member_names(self):
+		"""Return the names of all members of the archive, as listed by 7z."""
+		list_args = [self.path_7z, 'l', self.path_archive, '-slt', '-p' + self.password]
+		# Only the headers are read, so the size of the archive does not matter.
+		listing = self.run(list_args, process_name='Listing')
+		# The properties of the archive itself come before the line of dashes, and those of its members after it.
+		members = listing.partition('\n----------\n')[2]
+		return [line[len('Path = '):] for line in members.splitlines() if line.startswith('Path = ')]
+
+	def pipe_member(self, name, path_destination=None, new_password=''):
+		"""Extract the member name with 7z and return the SHA-256 digest of its contents. If path_destination is given,
+		the contents are added to the archive at path_destination, encrypted with new_password, by a second 7z process
+		as they are extracted. They only pass through pipes and the memory of this process, a chunk at a time, and are
+		never written to disk unencrypted. Both processes are killed if they have not finished after the timeout for
+		the size of the archive (see self.timed)."""
+		import hashlib
+		commands = [[self.path_7z, 'e', self.path_archive, name, '-so', '-p' + self.password]]
+		if path_destination:
+			commands.append([self.path_7z, 'a', path_destination, '-si' + name, '-mhe', '-p' + new_password])
+		processes = []
+		try:
+			processes.append(subprocess.Popen(commands[0], stdout=subprocess.PIPE, stderr=subprocess.PIPE))
+			if path_destination:
+				processes.append(subprocess.Popen(commands[1], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+					stderr=subprocess.PIPE))
+		except OSError as err:
+			for process in processes:
+				process.kill()
+				process.wait()
+			raise ArchiveError('Could not run {} ({}).'.format(self.path_7z, err))
+		description = '{} of {} in {}'.format('Re-encryption' if path_destination else 'Verification', name,
+			os.path.basename(self.path_archive))
+		with self.timed(description, 'write' if path_destination else 'read',
+				self.archive_size(self.path_archive)) as timeout:
+			timed_out = threading.Event()
+			def kill_on_timeout():
+				timed_out.set()
+				for process in processes:
+					process.kill()
+			timer = threading.Timer(timeout, kill_on_timeout) if timeout is not None else None
+			if timer:
+				timer.daemon = True
+				timer.start()
+			digest = hashlib.sha256()
+			errors = []
+			try:
+				with profiler.subprocess_phase(commands[-1]):
+					try:
+						for chunk in iter(lambda: processes[0].stdout.read(65536), b''):
+							digest.update(chunk)
+							if path_destination:
+								processes[1].stdin.write(chunk)
+						if path_destination:
+							processes[1].stdin.close()
+					except BrokenPipeError:
+						# The 7z process adding the member has failed, and its errors are reported below.
+						processes[0].kill()
+					errors = [process.stderr.read().decode(errors='replace').strip() for process in processes]
+					for process in processes:
+						process.wait()
+			finally:
+				if timer:
+					timer.cancel()
+				for process in processes:
+					# Anything the 7z process adding the member leaves behind is removed with the new archive (see
+					# ArchiveBackend.replace_archive).
+					self.stop(process)
+					for stream in (process.stdin, process.stdout, process.stderr):
+						if stream:
+							stream.close()
+			if timed_out.is_set():
+				raise ArchiveError('Copying {} failed to complete after {:.0f} seconds.'.format(name, timeout))
+		if any(errors) or any(process.returncode for process in processes):
+			raise ArchiveError(' '.join(error for error in errors if error) or 'Copying {} failed.'.format(name))
+		return digest.hexdigest()
+
+	def write_rekeyed_copy(self, path_temp_archive, new_password):
+		"""Write a copy of the archive encrypted with new_password to path_temp_archive, streaming each member from one
+		7z process to another (see self.pipe_member), and check every member of the copy can be extracted with
+		new_password and is the same as in the archive."""
+		import shutil
+		new_archive = SevenZipBackend(path_temp_archive, new_password, self.path_7z, self.timeout, self.throughput,
+			self.progress)
+		for name in self.member_names():
+			digest = self.pipe_member(name, path_temp_archive, new_password)
+			if new_archive.pipe_member(name) != digest:
+				raise ArchiveError('Verification of the re-encrypted archive failed. {} was not modified.'.format(
+					os.path.basename(self.path_archive)))
+		shutil.copymode(self.path_archive, path_temp_archive)
+
+	def write_copy(self, path_temp_archive):
+		"""Copy the archive to path_temp_archive and update the staged members in the copy with 7z. Note that the 7z
+		-u switch does not appear to accommodate stdin (this can be used to update a file in the archive if it is
+		found to be older than file to be added, for example) (note the -ao overwrite switch applies during
+		extraction [to file] only)."""
+		import shutil
+		shutil.copyfile(self.path_archive, path_temp_archive)
+		shutil.copymode(self.path_archive, path_temp_archive)
+		for name, text in self.staged_members.items():
+			# Note -mhe encrypts file headers (i.e. name of files).
+			update_args = [self.path_7z, 'u', path_temp_archive, '-si' + name, '-mhe', '-p' + self.password]
+			# We don't need the output - there shouldn't be any. 7z rewrites the whole archive.
+			self.run(update_args, process_input=text, process_name='Update', kind='write',
+				size=self.archive_size(path_temp_archive) + len(text))
+
+	@classmethod
+	def create(cls, path_archive, password, member_name, path_7z='7z', timeout=5, **settings):
+		"""Create a new archive at path_archive holding an empty member member_name. If this fails, nothing is left at
+		path_archive (unless something already was)."""
+		existed = os.path.exists(path_archive)
+		# 7z quirk - if archive name does not end in .7z this extension will be added.
+		# End with . to ensure this does not occur.
+		creation_path = path_archive if path_archive.endswith('.7z') else path_archive + '.'
+		creation_args = [path_7z, 'a', creation_path, '-si' + member_name, '-mhe', '-p' + password]
+		try:
+			cls(path_archive, password, path_7z, timeout, **settings).run(creation_args, process_input='',
+				process_name='Archive creation', kind='write')
+		except ArchiveError:
+			# E.g. a process killed on timing out may leave an incomplete archive.
+			if not existed and os.path.exists(path_archive):
+				os.remove(path_archive)
+			raise
+
+class Py7zrBackend(ArchiveBackend):
+	"""Archive backend reading and writing AES-256 encrypted 7z archives in this process using the py7zr package, so
+	no 7z process is started and no timeout applies. The package is only imported when this backend is used.
+
+	py7zr cannot update an archive, so a commit writes a new archive holding the staged members and all other
+	members of the original.
+	"""
+	def __init__(self, path_archive, password, **settings):
+		super().__init__(path_archive, password)
+		try:
+			import py7zr
+		except ImportError:
+			raise ArchiveError('The py7zr archive backend requires the py7zr package (pip install py7zr).')
+		self.py7zr = py7zr
+
+	def read_members_at(self, path_archive, names=None):
+		"""Return a dictionary mapping the names of members of the archive at path_archive to their contents (bytes).
+		Only the members in names are read, unless names is None."""
+		try:
+			with profiler.phase('py7zr read'), self.py7zr.SevenZipFile(path_archive, 'r',
+					password=self.password or None) as archive:
+				if names is not None:
+					names = [name for name in names if name in archive.getnames()]
+				if hasattr(archive, 'read'):
+					# py7zr < 1.0
+					products = archive.read(names) if names is not None else archive.readall()
+				else:
+					from py7zr.io import BytesIOFactory
+					factory = BytesIOFactory(2 ** 40)
+					archive.extract(targets=names, factory=factory)
+					products = factory.products
+				return {name: product.read() for name, product in products.items()}
+		except (OSError, self.py7zr.exceptions.Bad7zFile) as err:
+			raise ArchiveError('Could not read {} ({}).'.format(os.path.basename(path_archive), err))
+		except Exception as err:
+			# py7zr raises various exception types for incorrect passwords (and corrupt archives), as whatever the
+			# wrong key decrypts the header to is parsed.
+			raise IncorrectPasswordError('Could not read {} (incorrect password?): {}'.format(
+				os.path.basename(path_archive), err))
+
+	def read_member_at(self, path_archive, name):
+		return self.read_members_at(path_archive, [name]).get(name, b'').decode()
+
+	def read_members(self, names):
+		"""As ArchiveBackend.read_members, but the archive is only opened and decrypted once."""
+		members = self.read_members_at(self.path_archive, names)
+		profiler.count('bytes read', sum(len(data) for data in members.values()))
+		return {name: members.get(name, b'').decode() for name in names}
+
+	def write_copy(self, path_temp_archive):
+		members = self.read_members_at(self.path_archive)
+		members.update((name, text.encode()) for name, text in self.staged_members.items())
+		self.write_archive(path_temp_archive, self.password, members)
+		import shutil
+		shutil.copymode(self.path_archive, path_temp_archive)
+
+	def write_rekeyed_copy(self, path_temp_archive, new_password):
+		"""Write a copy of the archive encrypted with new_password to path_temp_archive and check it can be read with
+		new_password and holds the same members. The members are only held in memory in between."""
+		members = self.read_members_at(self.path_archive)
+		self.write_archive(path_temp_archive, new_password, members)
+		if Py7zrBackend(path_temp_archive, new_password).read_members_at(path_temp_archive) != members:
+			raise ArchiveError('Verification of the re-encrypted archive failed. {} was not modified.'.format(
+				os.path.basename(self.path_archive)))
+		import shutil
+		shutil.copymode(self.path_archive, path_temp_archive)
+
+	def write_archive(self, path_archive, password, members):
+		"""Write a new archive at path_archive, with encrypted headers, holding members (name: bytes)."""
+		try:
+			with profiler.phase('py7zr write'), self.py7zr.SevenZipFile(path_archive, 'w', password=password or None,
+					header_encryption=bool(password)) as archive:
+				for name, data in members.items():
+					archive.writestr(data, name)
+		except Exception as err:
+			raise ArchiveError('Could not write {}: {}'.format(os.path.basename(path_archive), err))
+
+	@classmethod
+	def create(cls, path_archive, password, member_name, **settings):
+		"""Create a new archive at path_archive holding an empty member member_name."""
+		cls(path_archive, password).write_archive(path_archive, password, {member_name: b''})
+
+class NameCache:
+	"""The application names of an archive, kept encrypted in a file beside it (see FILENAME_TEMPLATE) so that they
+	can be listed without the archive password or any 7z process, e.g. to complete application names in the shell (see
+	PassManager.complete).
+
+	The file begins with a line of JSON describing the archive as it was when the names were written (its size,
+	modification time and BLAKE2b hash) and the nonce, followed by the lower case names (one per line) encrypted with
+	ChaCha20-Poly1305, which also authenticates the first line. The names are ignored once the archive has changed.
+
+	The key is random and kept in a file (see KEY_FILENAME) in a directory which should only last as long as the
+	user's session, normally the runtime directory (see PassManager.runtime_directory), which is removed at log out.
+	The names can then no longer be decrypted, and the next run which opens the archive writes them again under a new
+	key. The cryptography package is needed (as for native vaults); without it no names are cached.
+
+	Class Variables
+	---------------
+	FILENAME_TEMPLATE : string
+		Name of the file holding the names of the archive {archive_name}, in the same directory.
+	KEY_FILENAME : string
+		Name of the file holding the key.
+	"""
+	FILENAME_TEMPLATE = '.{archive_name}.names'
+	KEY_FILENAME = 'pwmgr-name-cache.key'
+
+	def __init__(self, path_archive, key_dir):
+		self.path_archive = path_archive
+		self.path = os.path.join(os.path.dirname(path_archive),
+			self.FILENAME_TEMPLATE.format(archive_name=os.path.basename(path_archive)))
+		self.key_dir = key_dir
+		self.path_key = os.path.join(key_dir, self.KEY_FILENAME)
+
+	def archive_state(self):
+		"""Return a dictionary of the size, modification time and hash of the archive."""
+		import hashlib
+		status = os.stat(self.path_archive)
+		archive_hash = hashlib.blake2b(digest_size=16)
+		with open(self.path_archive, 'rb') as archive_file:
+			for chunk in iter(lambda: archive_file.read(1 << 20), b''):
+				archive_hash.update(chunk)
+		return {'size': status.st_size, 'mtime_ns': status.st_mtime_ns, 'blake2b': archive_hash.hexdigest()}
+
+	def key(self, create=False):
+		"""Return the key, or None if there is none. If create is True, make one if there is none."""
+		try:
+			with open(self.path_key, 'rb') as key_file:
+				return key_file.read()
+		except FileNotFoundError:
+			if not create:
+				return None
+		os.makedirs(self.key_dir, mode=0o700, exist_ok=True)
+		key = os.urandom(32)
+		try:
+			file_descriptor = os.open(self.path_key, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+		except FileExistsError:
+			# Made by another process in the meantime.
+			return self.key()
+		with open(file_descriptor, 'wb') as key_file:
+			key_file.write(key)
+		return key
+
+	def write(self, names):
+		"""Encrypt and store names, the ordered list of all application names (lower case) of the archive as it is
+		now. Failures are logged (at debug level) and otherwise ignored, as the cache is only an aid."""
+		try:
+			from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+		except ImportError:
+			logger.debug('Application names not cached (the cryptography package is not installed).')
+			return
+		temp_path = self.path + '.tmp'
+		try:
+			with profiler.phase('name cache'):
+				key = self.key(create=True)
+				nonce = os.urandom(12)
+				header = (json.dumps(dict(self.archive_state(), nonce=nonce.hex())) + '\n').encode()
+				sealed = ChaCha20Poly1305(key).encrypt(nonce, '\n'.join(names).encode(), header)
+				file_descriptor = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+				with open(file_descriptor, 'wb') as cache_file:
+					cache_file.write(header + sealed)
+				os.replace(temp_path, self.path)
+		except (OSError, ValueError) as err:
+			logger.debug('Could not cache application names in {} ({}).'.format(self.path, err))
+
+	def read(self):
+		"""Return the ordered list of application names (lower case) of the archive, or None if they are not cached,
+		the archive has changed since or the key is gone."""
+		try:
+			from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+			from cryptography.exceptions import InvalidTag
+		except ImportError:
+			return None
+		try:
+			with open(self.path, 'rb') as cache_file:
+				header, _, sealed = cache_file.read().partition(b'\n')
+			state = json.loads(header.decode())
+			key = self.key()
+			# The size and modification time are compared first, since they need not read the archive.
+			status = os.stat(self.path_archive)
+			if not key or (state['size'], state['mtime_ns']) != (status.st_size, status.st_mtime_ns):
+				return None
+			if dict(self.archive_state(), nonce=state['nonce']) != state:
+				return None
+			text = ChaCha20Poly1305(key).decrypt(bytes.fromhex(state['nonce']), sealed, header + b'\n').decode()
+		except (OSError, ValueError, KeyError, TypeError, InvalidTag) as err:
+			logger.debug('Cached application names of {} not used ({}).'.format(self.path_archive, err or 'invalid'))
+			return None
+		return text.split('\n') if text else []
+
+class Vault:
+	"""A password archive (7z archive or native vault) opened once and then read and updated any number of times, for
+	use of pwmgr as a library. The command line interface (PassManager) is a layer on top of it.
+
+	Example
+	-------
+		vault = Vault('/path/to/pvault/archive.7z', archive_backend='py7zr')
+		vault.open(password)
+		vault.get('github')             # First password, or None.
+		vault.search('^git')            # ['github', 'gitlab']
+		vault.fuzzy_search('gthub')     # ['github', 'gitlab'] (best first)
+		vault.upsert('gitlab', 'pword') # 'added' or 'replaced'
+		vault.commit()
+		vault.close()
+
+	open decrypts the index of a native vault, or reads and parses the whole password file and journal of a 7z
+	archive, and the decrypted state is kept until close. After that, lookups and searches start no processes and
+	decrypt nothing, except the entry needed from a native vault. upsert and delete are only staged. Lookups see staged
+	changes at once. commit writes them all with one update of the archive (see PasswordJournal and
+	NativeVault.append_entries), and rollback discards them.
+
+	Nothing is printed (unless progress, a ProgressIndicator, is given to show slow 7z processes) or prompted for and
+	the process never exits. Failures raise ArchiveError or VaultError (both PwmgrError, and IncorrectPasswordError, a
+	subclass of both, if the password is wrong), and invalid application names or passwords raise ValueError. After a
+	failed commit the archive is untouched and the changes stay staged.
+
+	Each 7z process is killed after timeout seconds (None for never) or, if throughput (a ThroughputStats) is given, a
+	longer time following the size of the archive (see SevenZipBackend).
+
+	If name_cache_dir is given, the application names are stored in a NameCache, with its key in name_cache_dir,
+	whenever all of them have been read and after every change to the archive.
+
+	Several processes may use the same archive at once. Writers (commit, compact, import_entries and rekey) hold an
+	exclusive lock (see write_lock), and before writing read the archive again if another process has changed it since
+	it was read (see refresh), so that the staged changes are merged with the latest contents rather than overwriting
+	them. Readers take no lock. As a 7z archive is only ever replaced by a new file (see ArchiveBackend), and a native
+	vault only appended to or replaced, a read which the archive did not change under is a consistent snapshot, and a
+	read which it did change under is repeated (see read_snapshot).
+
+	Class Variables
+	---------------
+	ARCHIVE_BACKENDS : dictionary
+		Each key is a possible value of the archive_backend argument (and setting) and its value the ArchiveBackend
+		subclass used to read and write 7z archives.
+	CONFLICT_POLICIES : list
+		Possible values of the conflict argument of import_entries.
+	JOURNAL_FILENAME : string
+		Name of the journal in a 7z archive, which records changes not yet merged into PASSWORD_FILENAME.
+	LOCK_FILENAME_TEMPLATE : string
+		Name of the lock file of the archive {archive_name}, in the same directory (see write_lock).
+	PASSWORD_CHARACTERS : frozenset
+		Characters a password may contain: printable characters other than line breaks.
+	PASSWORD_FILENAME : string
+		Name of the password file in a 7z archive.
+	SNAPSHOT_ATTEMPTS : int
+		Number of times a read is tried without a lock before taking the write lock, if the archive changes during
+		every one (see read_snapshot).
+	"""
+	ARCHIVE_BACKENDS = {'7z':SevenZipBackend, 'py7zr':Py7zrBackend}
+	CONFLICT_POLICIES = ['keep', 'overwrite', 'append']
+	JOURNAL_FILENAME = 'passes.journal'
+	LOCK_FILENAME_TEMPLATE = '.{archive_name}.lock'
+	PASSWORD_CHARACTERS = frozenset(string.printable).difference('\n\r\x0b\x0c')
+	PASSWORD_FILENAME = 'passes'
+	SNAPSHOT_ATTEMPTS = 5
+
+	def __init__(self, path, archive_backend='7z', path_7z='7z', timeout=5, journal_max_size=16384,
+			name_cache_dir=None, lock_timeout=10, throughput=None, progress=None):
+		if archive_backend not in self.ARCHIVE_BACKENDS:
+			raise ArchiveError('{} is not an archive backend (use one of {}).'.format(archive_backend,
+				', '.join(self.ARCHIVE_BACKENDS)))
+		self.path = os.path.abspath(path)
+		self.backend_class = self.ARCHIVE_BACKENDS[archive_backend]
+		self.path_7z = path_7z
+		# How long 7z processes may run, and how they are shown (see SevenZipBackend).
+		self.timeout = timeout
+		self.throughput = throughput
+		self.progress = progress
+		# Once the journal would grow beyond this many bytes, commit merges it into the password file.
+		self.journal_max_size = journal_max_size
+		# The file at path is either a native vault or a 7z archive.
+		self.native_vault = NativeVault(self.path) if NativeVault.is_vault(self.path) else None
+		self.is_open = False
+		# Set by self.open for a 7z archive: the archive backend, the password file with the journal replayed on top
+		# of it and the journal itself.
+		self.archive = None
+		self.password_file = PasswordFile('')
+		self.journal = PasswordJournal()
+		# Changes staged by self.upsert and self.delete, keyed by lower case name: (name, password) of each upsert and
+		# name of each deletion. As in PasswordJournal.changes, the deletions are made first.
+		self.staged_upserts = {}
+		self.staged_deletions = {}
+		# Built by self.fuzzy_search when first needed, and dropped whenever the application names may change.
+		self.trigram_index = None
+		self.name_cache = NameCache(self.path, name_cache_dir) if name_cache_dir else None
+		# Number of seconds write_lock waits for another process to release the lock, and number of write_lock
+		# contexts entered (the lock is only taken by the outermost one).
+		self.lock_timeout = lock_timeout
+		self.lock_depth = 0
+		# The archive file as last read (kept open, so that its inode number is not reused by another file) and its
+		# inode number, size and modification time then (see self.mark_snapshot).
+		self.snapshot_file = None
+		self.snapshot_state = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+	@classmethod
+	def create(cls, path, password, archive_backend='7z', path_7z='7z', timeout=5, throughput=None, progress=None):
+		"""Create a new, empty archive at path protected by password: a native vault if path ends with
+		NativeVault.FILE_EXTENSION and a 7z archive (written by archive_backend) otherwise."""
+		if path.endswith(NativeVault.FILE_EXTENSION):
+			try:
+				NativeVault.create(path, password)
+			except OSError as err:
+				raise VaultError('Could not create {} ({}).'.format(path, err))
+			return
+		if archive_backend not in cls.ARCHIVE_BACKENDS:
+			raise ArchiveError('{} is not an archive backend.'.format(archive_backend))
+		cls.ARCHIVE_BACKENDS[archive_backend].create(path, password, cls.PASSWORD_FILENAME, path_7z=path_7z,
+			timeout=timeout, throughput=throughput, progress=progress)
+
+	def open_archive(self, password):
+		"""Return the archive backend for the 7z archive self.path, opened with password."""
+		return self.backend_class(self.path, password, path_7z=self.path_7z, timeout=self.timeout,
+			throughput=self.throughput, progress=self.progress)
+
+	def open(self, password):
+		"""Decrypt the vault with password and keep its contents until self.close. Raise ArchiveError or VaultError if
+		it cannot be read, e.g. because password is incorrect."""
+		self.close()
+		try:
+			if self.native_vault:
+				# The key is only derived once, however many times the index is read.
+				self.native_vault.set_key(password)
+				self.read_snapshot(self.native_vault.reload)
+			else:
+				archive = self.open_archive(password)
+				self.load_members(archive, self.read_snapshot(lambda: self.read_members(archive)))
+		except OSError as err:
+			raise VaultError('Could not read {} ({}).'.format(self.path, err))
+		self.is_open = True
+		self.cache_names()
+
+	def read_members(self, archive):
+		"""Return the password file and journal of the 7z archive, read with the archive backend archive."""
+		return archive.read_members([self.PASSWORD_FILENAME, self.JOURNAL_FILENAME])
+
+	def load_members(self, archive, members):
+		"""Keep the archive backend archive and load members, as returned by self.read_members (see self.load)."""
+		self.archive = archive
+		self.load(members[self.PASSWORD_FILENAME], PasswordJournal(members[self.JOURNAL_FILENAME]))
+
+	def load(self, text, journal):
+		"""Replay journal on top of text, the password file of the 7z archive, and parse the result into
+		self.password_file."""
+		self.journal = journal
+		logger.debug('{} changes replayed from {}.'.format(len(journal), self.JOURNAL_FILENAME))
+		text = journal.apply(text)
+		# If it is empty, then self.PASSWORD_FILENAME did not exist or was empty.
+		if not text:
+			logger.warning('{} was empty or missing from {}.'.format(self.PASSWORD_FILENAME, os.path.basename(self.path)))
+		with profiler.phase('parse'):
+			self.password_file = PasswordFile(text)
+			profiler.count('lines parsed', text.count('\n'))
+		logger.debug('{} entries parsed.'.format(len(self.password_file)))
+		for line_num in self.password_file.malformed_line_numbers():
+			rel_path = os.path.join(os.path.basename(self.path), self.PASSWORD_FILENAME)
+			logger.warning('Formatting error in {}, line {}.'.format(rel_path, line_num))
+
+	@staticmethod
+	def file_state(status):
+		"""Return the inode number, size and modification time from status, an os.stat_result."""
+		return status.st_ino, status.st_size, status.st_mtime_ns
+
+	def archive_changed(self):
+		"""Return True if the archive file has been replaced or changed since it was last read (see
+		self.mark_snapshot)."""
+		try:
+			state = self.file_state(os.stat(self.path))
+		except FileNotFoundError:
+			state = None
+		return state != self.snapshot_state
+
+	def mark_snapshot(self):
+		"""Record the state of the archive file before it is read. The file is kept open until the next snapshot or
+		self.close, so that if it is replaced, its inode number cannot be taken by the new file and the replacement
+		always changes the state."""
+		try:
+			snapshot_file = open(self.path, 'rb')
+		except OSError as err:
+			raise VaultError('Could not read {} ({}).'.format(self.path, err))
+		self.release_snapshot()
+		self.snapshot_file = snapshot_file
+		self.snapshot_state = self.file_state(os.fstat(snapshot_file.fileno()))
+
+	def release_snapshot(self):
+		if self.snapshot_file:
+			self.snapshot_file.close()
+		self.snapshot_file = None
+		self.snapshot_state = None
+
+	def read_snapshot(self, read):
+		"""Call read, a function reading the archive, and return its result, calling it again if the archive changed
+		while it ran, so that the result is a consistent snapshot of the archive. If it changed during each of
+		self.SNAPSHOT_ATTEMPTS calls, read is called once more holding the write lock, so that a reader always gets
+		a snapshot however busy the writers are."""
+		for _ in range(self.SNAPSHOT_ATTEMPTS):
+			self.mark_snapshot()
+			result = read()
+			if not self.archive_changed():
+				return result
+			logger.debug('{} changed while it was read. Reading it again.'.format(os.path.basename(self.path)))
+		with self.write_lock():
+			self.mark_snapshot()
+			return read()
+
+	def refresh(self):
+		"""Read the open archive again if another process has changed it since it was read, keeping the staged
+		changes, so that lookups and the next commit see its latest contents. Return True if it was read again. Raise
+		ArchiveError or VaultError if it can no longer be read (e.g. its password has been changed)."""
+		self.check_open()
+		if not self.archive_changed():
+			return False
+		logger.info('{} has been changed by another process. Reading it again.'.format(os.path.basename(self.path)))
+		try:
+			if self.native_vault:
+				self.read_snapshot(self.native_vault.reload)
+			else:
+				self.load_members(self.archive, self.read_snapshot(lambda: self.read_members(self.archive)))
+		except OSError as err:
+			self.release_snapshot()
+			raise VaultError('Could not read {} ({}).'.format(self.path, err))
+		except PwmgrError:
+			# What was read is not what is kept, so it must be read again next time.
+			self.release_snapshot()
+			raise
+		self.trigram_index = None
+		return True
+
+	@contextlib.contextmanager
+	def write_lock(self):
+		"""Context manager holding an exclusive lock on the archive, so that only one writer changes it at a time.
+
+		The lock is an flock of the lock file (see LOCK_FILENAME_TEMPLATE) beside the archive, which is created if
+		needed and never removed, and is released when the file is closed (even if the process is killed). Another
+		process holding it is waited for for up to self.lock_timeout seconds, after which VaultError is raised. Nested
+		contexts use the lock already held.
+		"""
+		if self.lock_depth:
+			self.lock_depth += 1
+			try:
+				yield
+			finally:
+				self.lock_depth -= 1
+			return
+		import fcntl
+		path_lock = os.path.join(os.path.dirname(self.path), self.LOCK_FILENAME_TEMPLATE.format(
+			archive_name=os.path.basename(self.path)))
+		try:
+			lock_fd = os.open(path_lock, os.O_RDWR | os.O_CREAT, 0o600)
+		except OSError as err:
+			raise VaultError('Could not open the lock file {} ({}).'.format(path_lock, err))
+		try:
+			deadline = time.monotonic() + self.lock_timeout
+			delay = 0.005
+			with profiler.phase('lock'):
+				while True:
+					try:
+						fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+						break
+					except BlockingIOError:
+						if time.monotonic() >= deadline:
+							raise VaultError('Gave up waiting {:g} seconds for another process to finish writing to '
+								'{}.'.format(self.lock_timeout, self.path))
+					time.sleep(min(delay, max(0, deadline - time.monotonic())))
+					delay = min(2 * delay, 0.1)
+			self.lock_depth = 1
+			try:
+				yield
+			finally:
+				self.lock_depth = 0
+		finally:
+			# Closing the file releases the lock.
+			os.close(lock_fd)
+
+	def peek(self, password, name):
+		"""Return the first password for the application name (case insensitive), decrypting no more of a 7z archive
+		than needed, without opening the vault. 7z's output is parsed line by line as it is decrypted, and 7z is killed
+		once the entry is found (see SevenZipBackend.iter_member_lines). The journal is read at the same time in
+		another thread and the entry is only used if the journal has not replaced or deleted it.
+
+		If there is no entry for name, the whole archive has been read by then. The vault is left open (as by
+		self.open) and the result of self.get returned. A native vault is always opened, since only the index and the
+		entry are decrypted anyway. If the archive is replaced while it is read, it is opened instead, which reads it
+		again (see self.read_snapshot).
+		"""
+		if self.native_vault:
+			self.open(password)
+			return self.get(name)
+		self.close()
+		target = name.lower()
+		archive = self.open_archive(password)
+		self.mark_snapshot()
+		member_lines = archive.iter_member_lines(self.PASSWORD_FILENAME)
+		lines = []
+		journal = None
+		import concurrent.futures
+		with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+			journal_text = executor.submit(archive.read_member, self.JOURNAL_FILENAME)
+			try:
+				for line in member_lines:
+					match = PasswordFile.ENTRY_PATTERN.match(line)
+					if match and match.group(1).lower() == target:
+						deleted, new_pwords = PasswordJournal(journal_text.result()).changes()
+						new_pwords = {name.lower(): new_pword for name, new_pword in new_pwords.items()}
+						if target in new_pwords or target not in deleted:
+							if self.archive_changed():
+								break
+							logger.debug('Password for {} found on line {}. Stopping extraction.'.format(
+								target, len(lines) + 1))
+							return new_pwords.get(target, match.group(2))
+					lines.append(line)
+				else:
+					journal = PasswordJournal(journal_text.result())
+			finally:
+				member_lines.close()
+				profiler.count('lines parsed', len(lines))
+		if journal is None or self.archive_changed():
+			logger.debug('{} changed while it was read. Opening it.'.format(os.path.basename(self.path)))
+			self.open(password)
+			return self.get(name)
+		self.archive = archive
+		self.load(''.join(lines), journal)
+		self.is_open = True
+		self.cache_names()
+		return self.get(name)
+
+	def close(self):
+		"""Forget the password and everything decrypted, including any staged changes."""
+		if self.native_vault:
+			self.native_vault.lock()
+		self.archive = None
+		self.password_file = PasswordFile('')
+		self.journal = PasswordJournal()
+		self.rollback()
+		self.release_snapshot()
+		self.is_open = False
+
+	def cache_names(self):
+		"""Store the application names as last committed in self.name_cache, if there is one."""
+		if self.name_cache:
+			self.name_cache.write(self.native_vault.names() if self.native_vault else self.password_file.sorted_names)
+
+	def rekey(self, password, new_password):
+		"""Change the password of the vault from password to new_password, leaving it closed. Every member of a 7z
+		archive is streamed from the archive into a new one encrypted with new_password (see ArchiveBackend.rekey),
+		and a native vault is rewritten under a key derived from new_password (see NativeVault.rekey). Either way,
+		the new archive is checked and then renamed over the old one, so if anything fails (e.g. password is
+		incorrect) the archive is untouched. No plaintext is written to disk. The write lock is held throughout (see
+		self.write_lock). Raise ArchiveError or VaultError on failure."""
+		self.close()
+		try:
+			with self.write_lock():
+				if self.native_vault:
+					self.native_vault.unlock(password)
+					self.native_vault.rekey(new_password)
+				else:
+					self.open_archive(password).rekey(new_password)
+		except OSError as err:
+			raise VaultError('Could not re-encrypt {} ({}).'.format(self.path, err))
+		finally:
+			self.close()
+		logger.debug('{} re-encrypted.'.format(os.path.basename(self.path)))
+
+	def check_open(self):
+		if not self.is_open:
+			raise VaultError('{} is not open.'.format(self.path))
+
+	@classmethod
+	def check_entry(cls, name, password):
+		"""Raise ValueError unless name and password may be stored in a password file (see PasswordFile): a name
+		without whitespace and a password of printable characters which does not begin or end with whitespace."""
+		if not name or name.split() != [name]:
+			raise ValueError('Application name {!r} is empty or contains whitespace.'.format(name))
+		if not password or password != password.strip() or not cls.PASSWORD_CHARACTERS.issuperset(password):
+			raise ValueError('Password for {} is empty, begins or ends with whitespace or contains non-printable '
+				'characters.'.format(name))
+
+	def stored_passwords(self, name):
+		"""Return the list of passwords for the application name as last committed."""
+		if self.native_vault:
+			return self.native_vault.get(name)
+		return self.password_file.passwords(name)
+
+	def names(self):
+		"""Return an alphabetically ordered list of all application names (lower case)."""
+		self.check_open()
+		if self.native_vault:
+			names = self.native_vault.names()
+		else:
+			names = list(self.password_file.sorted_names)
+		if self.staged_upserts or self.staged_deletions:
+			names = sorted(set(names).difference(self.staged_deletions).union(self.staged_upserts))
+		return names
+
+	def get_all(self, name):
+		"""Return the list of passwords for the application name (case insensitive), empty if there are none."""
+		self.check_open()
+		passwords = [] if name.lower() in self.staged_deletions else self.stored_passwords(name)
+		if name.lower() in self.staged_upserts:
+			passwords = [self.staged_upserts[name.lower()][1]] + passwords[1:]
+		return passwords
+
+	def get(self, name):
+		"""Return the first password for the application name (case insensitive), or None if there is none."""
+		passwords = self.get_all(name)
+		return passwords[0] if passwords else None
+
+	def search(self, pattern):
+		"""Return an alphabetically ordered list of the application names (lower case) containing a match for the
+		regular expression pattern (a string, matched case insensitively, or a compiled pattern). Raise re.error if
+		pattern is not a valid regular expression."""
+		if isinstance(pattern, str):
+			pattern = re.compile(pattern, re.IGNORECASE)
+		return [name for name in self.names() if pattern.search(name)]
+
+	def fuzzy_search(self, query, limit=None, usage=None):
+		"""Return the application names (lower case) resembling query, even if misspelt, best first (see TrigramIndex).
+		usage is an optional function returning a usage score from 0 to 1 of a name (e.g. UsageLog.score) which
+		moves the names used most to the front. Only the first limit names are returned if limit is given."""
+		if self.trigram_index is None:
+			self.trigram_index = TrigramIndex(self.names())
+		return self.trigram_index.search(query, limit, usage)
+
+	def upsert(self, name, password):
+		"""Stage setting the (first) password of the application name to password, adding the application if it has
+		none. Return 'added' or 'replaced'."""
+		self.check_entry(name, password)
+		action = 'replaced' if self.get_all(name) else 'added'
+		self.staged_upserts[name.lower()] = (name, password)
+		if action == 'added':
+			self.trigram_index = None
+		return action
+
+	def upsert_many(self, new_pwords):
+		"""Stage an upsert of each application and password in the dictionary new_pwords. Return a dictionary mapping
+		each name to 'added' or 'replaced'. If the same name appears with different case, the last one given wins."""
+		for name, password in new_pwords.items():
+			self.check_entry(name, password)
+		latest = {name.lower(): name for name in new_pwords}
+		return {name: self.upsert(name, new_pwords[name]) for name in latest.values()}
+
+	def delete(self, name):
+		"""Stage the deletion of every password for the application name. Return False if it has none."""
+		if not self.get_all(name):
+			return False
+		self.staged_upserts.pop(name.lower(), None)
+		self.staged_deletions[name.lower()] = name
+		self.trigram_index = None
+		return True
+
+	def staged_changes(self):
+		"""Return the number of staged upserts and deletions."""
+		return len(self.staged_upserts) + len(self.staged_deletions)
+
+	def rollback(self):
+		"""Discard all staged changes."""
+		self.staged_upserts = {}
+		self.staged_deletions = {}
+		self.trigram_index = None
+
+	def commit(self, defer_compaction=False):
+		"""Write all staged changes to the archive at once.
+
+		A 7z archive is updated with a single atomic commit of the archive backend (see ArchiveBackend), which adds
+		the changes to the journal, unless the journal would then be larger than self.journal_max_size. In that case
+		the whole password file is written and the journal emptied in the same commit. The journal only saves sorting
+		and serialising the password file: the backend still copies and rewrites the whole archive (and reads the
+		journal back to check it), so this takes time in proportion to the size of the archive. Only a native vault
+		is written in time proportional to the change: it has one entry record appended per application, and is
+		compacted afterwards if self.compaction_due(). If defer_compaction is True, neither is merged or compacted
+		and the caller is left to call self.compact.
+
+		The write lock is held throughout (see self.write_lock), and if another process has changed the archive since
+		it was read, it is read again first (see self.refresh), so that its changes are kept.
+		"""
+		self.check_open()
+		if not (self.staged_upserts or self.staged_deletions):
+			return
+		with self.write_lock():
+			self.refresh()
+			self.write_staged_changes(defer_compaction)
+
+	def write_staged_changes(self, defer_compaction):
+		"""Write the staged changes to the archive (see self.commit), whose write lock must be held."""
+		records = [{'op': 'delete', 'name': name} for name in self.staged_deletions.values()]
+		records.extend({'op': 'upsert', 'name': name, 'password': password}
+			for name, password in self.staged_upserts.values())
+		try:
+			if self.native_vault:
+				# An upsert of a deleted application replaces all its passwords, so needs no deletion record.
+				entries = [(name, []) for lower_name, name in self.staged_deletions.items()
+					if lower_name not in self.staged_upserts]
+				entries.extend((name, [password] + ([] if lower_name in self.staged_deletions else
+					self.native_vault.get(name)[1:])) for lower_name, (name, password) in self.staged_upserts.items())
+				self.native_vault.append_entries(entries)
+			else:
+				journal = self.journal.with_records(records)
+				text = PasswordJournal().with_records(records).apply(self.password_file.text)
+				if journal.size() > self.journal_max_size and not defer_compaction:
+					logger.debug('Merging {} into {}.'.format(self.JOURNAL_FILENAME, self.PASSWORD_FILENAME))
+					journal = PasswordJournal()
+					self.archive.write_member(self.PASSWORD_FILENAME, text)
+				self.archive.write_member(self.JOURNAL_FILENAME, journal.text)
+				with profiler.phase('commit'):
+					self.archive.commit()
+				self.journal = journal
+				self.password_file = PasswordFile(text)
+			self.mark_snapshot()
+		except OSError as err:
+			raise VaultError('Could not write {} ({}).'.format(self.path, err))
+		logger.debug('{} changes committed to {}.'.format(len(records), os.path.basename(self.path)))
+		self.rollback()
+		if self.native_vault and not defer_compaction and self.compaction_due():
+			self.compact()
+		else:
+			self.cache_names()
+
+	def compaction_due(self):
+		"""Return True if the journal of the 7z archive (or the superseded entries of a native vault) has outgrown
+		self.journal_max_size."""
+		if self.native_vault:
+			return self.native_vault.garbage > max(self.journal_max_size, self.native_vault.live_size())
+		return self.journal.size() > self.journal_max_size
+
+	def compact(self):
+		"""Write the password file, which includes all changes in the journal, and empty the journal with a single
+		commit. Native vaults are rewritten without their superseded entries instead (see NativeVault.compact). Staged
+		changes are not included. If this fails, the archive is untouched. As for self.commit, the write lock is held
+		and changes made by other processes are read first."""
+		self.check_open()
+		with self.write_lock():
+			self.refresh()
+			try:
+				if self.native_vault:
+					self.native_vault.compact()
+				else:
+					self.archive.write_member(self.PASSWORD_FILENAME, self.password_file.text)
+					self.archive.write_member(self.JOURNAL_FILENAME, '')
+					self.archive.commit()
+				self.mark_snapshot()
+			except OSError as err:
+				raise VaultError('Compaction of {} failed ({}).'.format(self.path, err))
+		self.journal = PasswordJournal()
+		self.cache_names()
+
+	def entries(self):
+		"""Yield (name, list of passwords) for every application as last committed, in alphabetical order."""
+		self.check_open()
+		if self.native_vault:
+			yield from self.native_vault.entries()
+		else:
+			yield from self.password_file.entries()
+
+	def import_entries(self, records, conflict='keep'):
+		"""Merge records, an iterable of (name, password) pairs in any order, into the vault and write it at once.
+		Return a dictionary mapping each name imported to the action taken (see PasswordFile.merge_passwords).
+
+		The records are sorted by name (case insensitive), keeping the order of the passwords of each application, and
+		repeated passwords dropped. An application which already has passwords keeps them if conflict is 'keep', has
+		them replaced by the imported ones if it is 'overwrite' and has the imported ones added after them if it is
+		'append'. The sorted records are merged with the password file of a 7z archive in one pass (see
+		PasswordFile.merged_with), which is written, with an empty journal, by a single commit. A native vault has one
+		entry record appended for each application changed, as by self.commit.
+
+		Raise ValueError, before anything is written, if conflict is not one of self.CONFLICT_POLICIES or any name or
+		password is invalid, and VaultError if there are staged changes (commit or roll them back first). As for
+		self.commit, the write lock is held and the records merged with any changes made by other processes.
+		"""
+		self.check_open()
+		if conflict not in self.CONFLICT_POLICIES:
+			raise ValueError('{} is not a conflict policy (use one of {}).'.format(conflict,
+				', '.join(self.CONFLICT_POLICIES)))
+		if self.staged_changes():
+			raise VaultError('{} has staged changes, which must be committed or rolled back before an import.'.format(
+				self.path))
+		# (name, list of passwords) of each application, by lower case name.
+		entries = []
+		for name, password in sorted(records, key=lambda record: record[0].lower()):
+			self.check_entry(name, password)
+			if entries and entries[-1][0].lower() == name.lower():
+				if password not in entries[-1][1]:
+					entries[-1][1].append(password)
+			else:
+				entries.append((name, [password]))
+		with self.write_lock():
+			self.refresh()
+			actions = self.write_imported_entries(entries, conflict)
+			logger.debug('{} applications imported into {}.'.format(len(entries), os.path.basename(self.path)))
+			self.trigram_index = None
+			if self.native_vault and self.compaction_due():
+				self.compact()
+			else:
+				self.cache_names()
+		return actions
+
+	def write_imported_entries(self, entries, conflict):
+		"""Merge entries, a sorted list of (name, list of passwords) pairs, into the archive, whose write lock must be
+		held (see self.import_entries). Return the dictionary of actions taken."""
+		try:
+			if self.native_vault:
+				actions = {}
+				changed = []
+				for name, passwords in entries:
+					existing = self.native_vault.get(name) if name.lower() in self.native_vault.offsets else []
+					actions[name], passwords = PasswordFile.merge_passwords(existing, passwords, conflict)
+					if actions[name] not in {'kept', 'unchanged'}:
+						changed.append((name, passwords))
+				if changed:
+					self.native_vault.append_entries(changed)
+			else:
+				text, actions = self.password_file.merged_with(entries, conflict)
+				if text != self.password_file.text:
+					self.archive.write_member(self.PASSWORD_FILENAME, text)
+					self.archive.write_member(self.JOURNAL_FILENAME, '')
+					with profiler.phase('commit'):
+						self.archive.commit()
+					self.journal = PasswordJournal()
+					self.password_file = PasswordFile(text)
+			self.mark_snapshot()
+		except OSError as err:
+			raise VaultError('Could not write {} ({}).'.format(self.path, err))
+		return actions
+
+class EntryFile:
+	"""A file of application names and passwords exported by or for another password manager, read by --import and
+	written by --export. The formats are:
+
+		passes  Lines of the password file: application_name password.
+		csv     Comma separated values with a header row, as exported by e.g. Bitwarden, KeePassXC, LastPass, 1Password
+		        and web browsers. The name is taken from the first column in NAME_FIELDS and the password from the
+		        first in PASSWORD_FIELDS. A file without such a header holds rows of application_name,password.
+		jsonl   One JSON object per line holding "name" and either "password" or "passwords" (a list), as written by
+		        --export and --get.
+		json    A JSON list of such objects, or an unencrypted Bitwarden export (whose "items" hold a "login" object).
+
+	If an entry has no name, the host name of its URL (URL_FIELDS) is used instead. Whitespace within names, which the
+	password file cannot hold, is replaced by underscores. Entries without a name or a password (e.g. secure notes) are
+	skipped and counted in self.skipped.
+
+	Class Variables
+	---------------
+	EXTENSIONS : dictionary
+		Maps each file extension (lower case) to the format of files which have it.
+	FORMATS : list
+		Names of the formats.
+	NAME_FIELDS, PASSWORD_FIELDS, URL_FIELDS : tuples
+		Names of the CSV columns and JSON keys (lower case) holding the name, password and URL of an entry, in order
+		of preference.
+	"""
+	EXTENSIONS = {'.csv':'csv', '.jsonl':'jsonl', '.ndjson':'jsonl', '.json':'json'}
+	FORMATS = ['passes', 'csv', 'jsonl', 'json']
+	NAME_FIELDS = ('name', 'title', 'application', 'account')
+	PASSWORD_FIELDS = ('password', 'login_password')
+	URL_FIELDS = ('url', 'login_uri', 'uri', 'website')
+
+	def __init__(self, file_format):
+		if file_format not in self.FORMATS:
+			raise ValueError('{} is not a file format (use one of {}).'.format(file_format, ', '.join(self.FORMATS)))
+		self.file_format = file_format
+		self.skipped = 0
+
+	@classmethod
+	def detect_format(cls, path, first_line=''):
+		"""Return the format of the file at path ('-' for standard input or output) given by its extension or, failing
+		that, by first_line, its first non-blank line (if it has been read). The default is 'passes'."""
+		extension = os.path.splitext(path)[1].lower()
+		if extension in cls.EXTENSIONS:
+			return cls.EXTENSIONS[extension]
+		first_line = first_line.strip()
+		if first_line.startswith('['):
+			return 'json'
+		if first_line.startswith('{'):
+			try:
+				json.loads(first_line)
+			except ValueError:
+				return 'json'
+			return 'jsonl'
+		if {field.strip().strip('"').lower() for field in first_line.split(',')}.intersection(cls.PASSWORD_FIELDS):
+			return 'csv'
+		return 'passes'
+
+	def read(self, lines):
+		"""Yield (name, password) for each password in lines, an iterable of the lines of the file (e.g. the open file,
+		which is then read one line at a time, except in the json format). Raise ValueError, saying where, if the file
+		is not in self.file_format."""
+		if self.file_format == 'csv':
+			yield from self.read_csv(lines)
+			return
+		if self.file_format == 'json':
+			try:
+				document = json.loads(''.join(lines))
+			except ValueError as err:
+				raise ValueError('not a JSON document ({})'.format(err))
+			items = document.get('items') if isinstance(document, dict) else document
+			if not isinstance(items, list):
+				raise ValueError('expected a list of entries or an unencrypted Bitwarden export')
+			for item_num, item in enumerate(items, 1):
+				yield from self.object_records(item, 'entry {}'.format(item_num))
+			return
+		for line_num, line in enumerate(lines, 1):
+			if not line.strip():
+				continue
+			if self.file_format == 'passes':
+				fields = line.split(sep=None, maxsplit=1)
+				yield from self.entry_records(fields[0], [field.strip() for field in fields[1:]], None)
+				continue
+			try:
+				record = json.loads(line)
+			except ValueError:
+				raise ValueError('line {} is not valid JSON'.format(line_num))
+			yield from self.object_records(record, 'line {}'.format(line_num))
+
+	def read_csv(self, lines):
+		"""Yield (name, password) for each row of the CSV file with the lines given (see self.read)."""
+		import csv, itertools
+		reader = csv.reader(lines)
+		try:
+			header = next(reader, [])
+			columns = [field.strip().lower() for field in header]
+			column = lambda fields: next((columns.index(field) for field in fields if field in columns), None)
+			password_column = column(self.PASSWORD_FIELDS)
+			if password_column is None:
+				# No header: the first row is an entry like any other.
+				rows, name_column, password_column, url_column = itertools.chain([header], reader), 0, 1, None
+			else:
+				rows, name_column, url_column = reader, column(self.NAME_FIELDS), column(self.URL_FIELDS)
+			for row in rows:
+				field = lambda index: row[index] if index is not None and index < len(row) else ''
+				yield from self.entry_records(field(name_column), [field(password_column)], field(url_column))
+		except csv.Error as err:
+			raise ValueError('line {}: {}'.format(reader.line_num, err))
+
+	def object_records(self, record, where):
+		"""Yield (name, password) for each password of record, an entry of a JSON or JSON lines file found at where
+		(used in error messages)."""
+		if not isinstance(record, dict):
+			raise ValueError('{} is not a JSON object'.format(where))
+		# Bitwarden keeps the password and URLs of a login in a separate object.
+		login = record['login'] if isinstance(record.get('login'), dict) else record
+		passwords = login.get('passwords', [login.get('password')])
+		if not isinstance(passwords, list) or not all(isinstance(pword, str) for pword in passwords if pword):
+			raise ValueError('the passwords of {} are not strings'.format(where))
+		urls = [uri.get('uri') for uri in login.get('uris') or [] if isinstance(uri, dict)]
+		urls.extend(login.get(field) for field in self.URL_FIELDS)
+		name = next((record[field] for field in self.NAME_FIELDS if isinstance(record.get(field), str)), '')
+		url = next((url for url in urls if isinstance(url, str) and url), '')
+		yield from self.entry_records(name, passwords, url)
+
+	def entry_records(self, name, passwords, url):
+		"""Yield (name, password) for each password (skipping empty ones) of an entry with the name and URL given,
+		unless it has neither a name nor a URL, or no password."""
+		name = '_'.join(name.split())
+		if not name and url:
+			import urllib.parse
+			url = url.strip()
+			try:
+				name = urllib.parse.urlsplit(url if '//' in url else '//' + url).hostname or ''
+			except ValueError:
+				name = ''
+			name = name[4:] if name.startswith('www.') else name
+		passwords = [pword for pword in passwords if pword]
+		if not name or not passwords:
+			self.skipped += 1
+			return
+		for pword in passwords:
+			yield name, pword
+
+	def write(self, entries, out_file):
+		"""Write entries, an iterable of (name, list of passwords) pairs, to the open file out_file in self.file_format,
+		one line per password (passes and csv) or per application (jsonl and json). Return the numbers of applications
+		and of passwords written."""
+		num_applications = num_pwords = 0
+		if self.file_format == 'csv':
+			import csv
+			writer = csv.writer(out_file, lineterminator='\n')
+			writer.writerow(['name', 'password'])
+		elif self.file_format == 'json':
+			out_file.write('[')
+		for name, passwords in entries:
+			if self.file_format == 'passes':
+				out_file.write(''.join('{} {}\n'.format(name, pword) for pword in passwords))
+			elif self.file_format == 'csv':
+				writer.writerows([name, pword] for pword in passwords)
+			else:
+				line = json.dumps({'name': name, 'passwords': passwords})
+				if self.file_format == 'jsonl':
+					out_file.write(line + '\n')
+				else:
+					out_file.write(('\n' if not num_applications else ',\n') + line)
+			num_applications += 1
+			num_pwords += len(passwords)
+		if self.file_format == 'json':
+			out_file.write('\n]\n')
+		return num_applications, num_pwords
+
+class PasswordPolicy:
+	"""Rules for generated passwords (see PasswordGenerator): either characters drawn from some classes (lower case
+	letters, upper case letters, digits and symbols), with a minimum number of some of them, or a passphrase of words
+	drawn from a word list.
+
+	A policy is written as a spec, a whitespace separated list of key=value pairs, e.g.
+		length=20 symbols=!#%+-.:=@_ exclude_ambiguous=true require=lower:1,upper:1,digit:2,symbol:1
+		words=6 wordlist=/usr/share/dict/words separator=-
+	length is the number of characters and symbols the punctuation characters used (none by default). require gives
+	the minimum number of characters of each class. If words is not 0, passphrases of that many words joined by
+	separator are generated instead, and the other keys are ignored. Applying a spec to a policy (see self.updated)
+	only changes the keys it gives.
+
+	Class Variables
+	---------------
+	AMBIGUOUS_CHARACTERS : string
+		Characters left out by exclude_ambiguous=true, as they are easily mistaken for one another.
+	CLASSES : dictionary
+		Each key is the name of a class of characters and its value the characters in it ('symbol' holds the symbols
+		of the policy).
+	DEFAULT_REQUIRE : dictionary
+		Minimum number of characters of each class when the spec gives none.
+	DEFAULT_WORDLIST : string
+		Word list of passphrases if the spec gives none.
+	MIN_LENGTH, MAX_LENGTH : int
+		Bounds of the length of generated passwords (in characters).
+	"""
+	AMBIGUOUS_CHARACTERS = 'Il1|O0o`\'"'
+	CLASSES = {'lower': string.ascii_lowercase, 'upper': string.ascii_uppercase, 'digit': string.digits,
+		'symbol': ''}
+	DEFAULT_REQUIRE = {'lower': 1, 'upper': 1, 'digit': 3}
+	DEFAULT_WORDLIST = '/usr/share/dict/words'
+	MIN_LENGTH = 8
+	MAX_LENGTH = 100
+
+	def __init__(self, length=15, symbols='', exclude_ambiguous=False, require=None, words=0, wordlist=None,
+			separator='-'):
+		self.length = length
+		self.symbols = ''.join(sorted(set(symbols)))
+		self.exclude_ambiguous = exclude_ambiguous
+		self.require = dict(self.DEFAULT_REQUIRE if require is None else require)
+		self.words = words
+		self.wordlist = wordlist or self.DEFAULT_WORDLIST
+		self.separator = separator
+		self.validate()
+
+	def __repr__(self):
+		return 'PasswordPolicy({!r})'.format(self.spec())
+
+	def spec(self):
+		"""Return the spec of this policy."""
+		if self.words:
+			return 'words={} wordlist={} separator={}'.format(self.words, self.wordlist, self.separator)
+		spec = 'length={} require={}'.format(self.length,
+			','.join('{}:{}'.format(name, count) for name, count in self.require.items()))
+		if self.symbols:
+			spec += ' symbols=' + self.symbols
+		if self.exclude_ambiguous:
+			spec += ' exclude_ambiguous=true'
+		return spec
+
+	def updated(self, spec):
+		"""Return a copy of this policy with the keys given in spec changed. Raise ValueError if spec is invalid."""
+		settings = {'length': self.length, 'symbols': self.symbols, 'exclude_ambiguous': self.exclude_ambiguous,
+			'require': self.require, 'words': self.words, 'wordlist': self.wordlist, 'separator': self.separator}
+		for item in spec.split():
+			key, separator, value = item.partition('=')
+			if not separator or key not in settings:
+				raise ValueError('{} is not of the form key=value with key one of {}.'.format(item, ', '.join(settings)))
+			if key in {'length', 'words'}:
+				if not value.isdigit():
+					raise ValueError('{} must be a whole number.'.format(key))
+				value = int(value)
+			elif key == 'exclude_ambiguous':
+				if value.lower() not in {'true', 'false', 'on', 'off'}:
+					raise ValueError('exclude_ambiguous must be true or false.')
+				value = value.lower() in {'true', 'on'}
+			elif key == 'require':
+				require = {}
+				for requirement in filter(None, value.split(',')):
+					name, _, count = requirement.partition(':')
+					if name not in self.CLASSES or not count.isdigit():
+						raise ValueError('{} is not of the form class:count with class one of {}.'.format(requirement,
+							', '.join(self.CLASSES)))
+					require[name] = int(count)
+				value = require
+			settings[key] = value
+		return PasswordPolicy(**settings)
+
+	def validate(self):
+		"""Raise ValueError unless passwords can be generated following this policy."""
+		if self.words:
+			if not self.separator.isprintable() or self.separator != self.separator.strip():
+				raise ValueError('The separator must be printable and may not hold spaces.')
+			return
+		if not self.MIN_LENGTH <= self.length <= self.MAX_LENGTH:
+			raise ValueError('The length must be between {} and {}.'.format(self.MIN_LENGTH, self.MAX_LENGTH))
+		if any(char not in string.punctuation for char in self.symbols):
+			raise ValueError('Symbols must be punctuation characters ({}).'.format(string.punctuation))
+		alphabets = self.alphabets()
+		for name, count in self.require.items():
+			if count and not alphabets.get(name):
+				raise ValueError('{} {} characters are required, but there are none to choose from.'.format(count, name))
+		if sum(self.require.values()) > self.length:
+			raise ValueError('More characters are required ({}) than the length ({}).'.format(
+				sum(self.require.values()), self.length))
+
+	def alphabets(self):
+		"""Return a dictionary of the characters of each class passwords are drawn from (empty classes left out)."""
+		alphabets = {}
+		for name, characters in self.CLASSES.items():
+			characters = characters or self.symbols
+			if self.exclude_ambiguous:
+				characters = ''.join(char for char in characters if char not in self.AMBIGUOUS_CHARACTERS)
+			if characters:
+				alphabets[name] = characters
+		return alphabets
+
+class PasswordGenerator:
+	"""Generates passwords following a PasswordPolicy, every password the policy allows being equally likely.
+
+	No password is ever generated and then thrown away for lacking a required class, so the time taken does not depend
+	on how strict the policy is. Instead, the number of characters of each class is drawn first, with the probability
+	of the share of all allowed passwords which have that many (see self.counts_table). The classes are then placed
+	in a random order (a Fisher-Yates shuffle) and each character is drawn from its class.
+
+	Random bytes are read from os.urandom (as by the secrets module) in chunks of RANDOM_CHUNK_SIZE bytes, and turned
+	into characters of an alphabet, or numbers below n, all at once with bytes.translate. Bytes which would favour some
+	values (those at or above the largest multiple of the alphabet size or n) are dropped by the same call, so every
+	value is equally likely.
+
+	Class Variables
+	---------------
+	RANDOM_CHUNK_SIZE : int
+		Number of random bytes read at a time.
+	"""
+	RANDOM_CHUNK_SIZE = 4096
+
+	def __init__(self, policy):
+		self.policy = policy
+		# Unused random characters of each alphabet (or numbers below n, as bytes), with the position of the next one.
+		self.random_buffers = {}
+		if policy.words:
+			self.words = self.read_wordlist(policy.wordlist)
+			return
+		alphabets = policy.alphabets()
+		self.classes = list(alphabets)
+		self.alphabets = [alphabets[name] for name in self.classes]
+		self.minimums = [policy.require.get(name, 0) for name in self.classes]
+		self.counts_table = {}
+		# self.totals[i][n]: number of ways to fill n positions with classes i onwards, meeting their minimums.
+		self.totals = [[0] * (policy.length + 1) for _ in range(len(self.classes) + 1)]
+		self.totals[-1][0] = 1
+		for i in reversed(range(len(self.classes))):
+			for n in range(policy.length + 1):
+				self.totals[i][n] = sum(self.binomial(n, k) * len(self.alphabets[i]) ** k * self.totals[i + 1][n - k]
+					for k in range(self.minimums[i], n + 1))
+
+	@staticmethod
+	def binomial(n, k):
+		import math
+		return math.factorial(n) // (math.factorial(k) * math.factorial(n - k))
+
+	@staticmethod
+	def read_wordlist(path):
+		"""Return the sorted list of distinct words in the file path (one per line) which are only lower case ASCII
+		letters. Raise ValueError if there are fewer than two."""
+		try:
+			with open(path) as wordlist_file:
+				words = sorted({word for word in wordlist_file.read().split()
+					if word.isascii() and word.isalpha() and word.islower()})
+		except OSError as err:
+			raise ValueError('Could not read the word list {} ({}).'.format(path, err))
+		if len(words) < 2:
+			raise ValueError('The word list {} has no words of lower case letters.'.format(path))
+		return words
+
+	def entropy(self):
+		"""Return the entropy (bits) of a generated password, i.e. log2 of the number of passwords allowed."""
+		import math
+		if self.policy.words:
+			return self.policy.words * math.log2(len(self.words))
+		return math.log2(self.totals[0][self.policy.length])
+
+	def random_characters(self, alphabet, count):
+		"""Return a string of count characters drawn uniformly from alphabet (at most 256 characters, all with code
+		points below 256, which are mapped to and from single bytes by the latin-1 encoding)."""
+		buffer, position = self.random_buffers.get(alphabet, ('', 0))
+		if len(buffer) - position < count:
+			size = len(alphabet)
+			limit = 256 - 256 % size
+			table = bytes(ord(alphabet[byte % size]) if byte < limit else 0 for byte in range(256))
+			fresh = [buffer[position:]]
+			dropped = bytes(range(limit, 256))
+			while sum(map(len, fresh)) < count:
+				fresh.append(os.urandom(self.RANDOM_CHUNK_SIZE).translate(table, dropped).decode('latin-1'))
+			buffer, position = ''.join(fresh), 0
+		self.random_buffers[alphabet] = (buffer, position + count)
+		return buffer[position:position + count]
+
+	def random_numbers(self, n, count):
+		"""Return a string of count characters whose code points are numbers from 0 to n - 1 (at most 256), each
+		equally likely."""
+		return self.random_characters(''.join(map(chr, range(n))), count)
+
+	def random_below(self, n):
+		"""Return a number from 0 to n - 1, each equally likely."""
+		if n <= 256:
+			return ord(self.random_numbers(n, 1))
+		bits = n.bit_length()
+		size = (bits + 7) // 8
+		while True:
+			# Each draw succeeds with probability over a half.
+			value = int.from_bytes(self.random_bytes(size), 'big') >> (8 * size - bits)
+			if value < n:
+				return value
+
+	def random_bytes(self, size):
+		"""Return size random bytes."""
+		buffer, position = self.random_buffers.get(bytes, (b'', 0))
+		if len(buffer) - position < size:
+			buffer, position = buffer[position:] + os.urandom(max(size, self.RANDOM_CHUNK_SIZE)), 0
+		self.random_buffers[bytes] = (buffer, position + size)
+		return buffer[position:position + size]
+
+	def class_counts(self):
+		"""Return the number of characters of each class in a new password."""
+		counts = []
+		remaining = self.policy.length
+		for i in range(len(self.classes) - 1):
+			key = (i, remaining)
+			if key not in self.counts_table:
+				# Cumulative number of passwords with k characters of class i, for k from its minimum upwards.
+				cumulative, total = [], 0
+				size = len(self.alphabets[i])
+				for k in range(self.minimums[i], remaining + 1):
+					total += self.binomial(remaining, k) * size ** k * self.totals[i + 1][remaining - k]
+					cumulative.append(total)
+				self.counts_table[key] = cumulative
+			cumulative = self.counts_table[key]
+			count = self.minimums[i] + bisect.bisect_right(cumulative, self.random_below(cumulative[-1]))
+			counts.append(count)
+			remaining -= count
+		counts.append(remaining)
+		return counts
+
+	def generate(self):
+		"""Return a new password."""
+		return self.generate_many(1)[0]
+
+	def generate_many(self, number):
+		"""Return a list of number new passwords. The random characters of each class, and the random numbers of each
+		step of the shuffles, are drawn for all the passwords at once."""
+		if self.policy.words:
+			return [self.policy.separator.join(self.words[self.random_below(len(self.words))]
+				for _ in range(self.policy.words)) for _ in range(number)]
+		length = self.policy.length
+		all_counts = [self.class_counts() for _ in range(number)]
+		# The characters of every password, class by class, then the positions swapped at each step of its shuffle.
+		class_characters = [self.random_characters(alphabet, sum(counts[i] for counts in all_counts))
+			for i, alphabet in enumerate(self.alphabets)]
+		positions = [0] * len(class_characters)
+		swaps = [(i, self.random_numbers(i + 1, number).encode('latin-1')) for i in reversed(range(1, length))]
+		passwords = []
+		for index, counts in enumerate(all_counts):
+			characters = []
+			for i, count in enumerate(counts):
+				characters.extend(class_characters[i][positions[i]:positions[i] + count])
+				positions[i] += count
+			for i, numbers in swaps:
+				j = numbers[index]
+				characters[i], characters[j] = characters[j], characters[i]
+			passwords.append(''.join(characters))
+		return passwords
+
+class IncrementalSearch:
+	"""Narrows the application names of an open vault as a query is typed, for the interactive shell (see
+	PassManager.run_shell). A name matches if the characters of the query appear in it in order (case insensitive),
+	e.g. gml matches gmail.
+
+	Matching is incremental. Each candidate is kept with the position just after the last character of the query it
+	matched, and the candidates are kept for every prefix of the query typed so far. A keystroke which extends the
+	query only resumes the match of each candidate of the previous query from its position (a single str.find), and
+	one which deletes characters simply drops the candidates of the longer queries. The candidates of a one
+	character query come from an index of the names containing each character, built once.
+	"""
+	def __init__(self, names):
+		# Alphabetically ordered list of all names (lower case).
+		self.names = list(names)
+		# Maps each character to the (ordered) list of names containing it.
+		self.names_by_char = {}
+		for name in self.names:
+			for char in set(name):
+				self.names_by_char.setdefault(char, []).append(name)
+		self.reset()
+
+	def reset(self):
+		# (query, list of (name, position after the match of query)) for the query typed and each of its prefixes.
+		self.candidates = [('', [(name, 0) for name in self.names])]
+
+	def __contains__(self, name):
+		position = bisect.bisect_left(self.names, name)
+		return position < len(self.names) and self.names[position] == name
+
+	def add(self, name):
+		"""Add the name (lower case) of a new application."""
+		if name in self:
+			return
+		bisect.insort(self.names, name)
+		for char in set(name):
+			bisect.insort(self.names_by_char.setdefault(char, []), name)
+		self.reset()
+
+	def remove(self, name):
+		"""Remove the name (lower case) of a deleted application."""
+		if name not in self:
+			return
+		self.names.remove(name)
+		for char in set(name):
+			self.names_by_char[char].remove(name)
+		self.reset()
+
+	def matches(self, query):
+		"""Return the alphabetically ordered list of names matching query."""
+		query = query.lower()
+		while not query.startswith(self.candidates[-1][0]):
+			self.candidates.pop()
+		while len(self.candidates[-1][0]) < len(query):
+			previous_query, previous_candidates = self.candidates[-1]
+			char = query[len(previous_query)]
+			if previous_query:
+				candidates = []
+				for name, position in previous_candidates:
+					position = name.find(char, position)
+					if position != -1:
+						candidates.append((name, position + 1))
+			else:
+				candidates = [(name, name.find(char) + 1) for name in self.names_by_char.get(char, [])]
+			self.candidates.append((query[:len(previous_query) + 1], candidates))
+		return [name for name, _ in self.candidates[-1][1]]
+
+class TrigramIndex:
+	"""Index of application names by their trigrams (runs of three characters), for fuzzy search (see
+	Vault.fuzzy_search). Names are padded with two spaces in front and one behind, so that their beginning and end
+	count too, e.g. git has the trigrams '  g', ' gi', 'git' and 'it '.
+
+	The similarity of a name to a query is the number of trigrams they share divided by the number of trigrams of
+	either (0 to 1, counting those of the name with repeats, i.e. one more than its length). A typo only changes the
+	trigrams around it, so misspelt queries still find the name.
+
+	Only the names sharing a trigram with the query are scored, through the list of names holding each trigram of the
+	query (its posting list). A posting list is built the first time its trigram is searched for, by a scan of all the
+	names joined together, and then kept. The first search of an index therefore takes time in proportion to the
+	number of names (as reading them does anyway), and only searches whose trigrams have all been searched for before,
+	as in a long running agent or shell, take time in proportion to the number of names resembling the query. Building
+	the lists of all trigrams up front would take longer than a one-shot search (about a second for 100000 names).
+
+	Class Variables
+	---------------
+	MIN_SIMILARITY : float
+		Similarity below which names are not returned by self.search.
+	USAGE_WEIGHT : float
+		Weight of the usage score (0 to 1, see UsageLog.score) of a name relative to its similarity when ranking.
+	"""
+	MIN_SIMILARITY = 0.15
+	USAGE_WEIGHT = 0.5
+
+	def __init__(self, names):
+		self.names = list(names)
+		# Each name padded as in self.trigrams, to search for trigrams in, and all of them joined by newlines with the
+		# offset in self.text at which each begins (and that of the end).
+		self.padded_names = ['  ' + name.lower() + ' ' for name in self.names]
+		self.text = '\n'.join(self.padded_names)
+		self.offsets = [0]
+		for padded_name in self.padded_names:
+			self.offsets.append(self.offsets[-1] + len(padded_name) + 1)
+		# Posting list (ordered list of indices of the names holding it) of each trigram searched for so far.
+		self.postings = {}
+
+	@staticmethod
+	def trigrams(text):
+		"""Return the set of trigrams of text (lower case)."""
+		text = '  ' + text.lower() + ' '
+		return {text[i:i + 3] for i in range(len(text) - 2)}
+
+	def posting_list(self, trigram):
+		"""Return the ordered list of indices of the names holding trigram."""
+		if trigram in self.postings:
+			return self.postings[trigram]
+		if self.text.count(trigram) * 16 > len(self.names):
+			# Common trigrams are quicker to look for in each name in turn.
+			indices = [index for index, padded_name in enumerate(self.padded_names) if trigram in padded_name]
+		else:
+			# Otherwise skip from one occurrence in self.text to the next.
+			indices = []
+			position = self.text.find(trigram)
+			while position != -1:
+				index = bisect.bisect_right(self.offsets, position) - 1
+				indices.append(index)
+				position = self.text.find(trigram, self.offsets[index + 1])
+		self.postings[trigram] = indices
+		return indices
+
+	def similarities(self, query):
+		"""Return a dictionary of the similarity to query of every name at least self.MIN_SIMILARITY similar."""
+		query_trigrams = self.trigrams(query)
+		shared = {}
+		for trigram in query_trigrams:
+			for index in self.posting_list(trigram):
+				shared[index] = shared.get(index, 0) + 1
+		similarities = {}
+		for index, count in shared.items():
+			similarity = count / (len(query_trigrams) + len(self.names[index]) + 1 - count)
+			if similarity >= self.MIN_SIMILARITY:
+				similarities[self.names[index]] = similarity
+		return similarities
+
+	def search(self, query, limit=None, usage=None):
+		"""Return the names resembling query, best first: by similarity plus, if usage (a function returning the usage
+		score of a name) is given, self.USAGE_WEIGHT times its usage score. Equal scores are in alphabetical order, so
+		the order is always the same. Only the first limit names are returned if limit is given."""
+		scores = self.similarities(query)
+		if usage:
+			for name in scores:
+				scores[name] += self.USAGE_WEIGHT * usage(name)
+		def rank(name):
+			return -scores[name], name
+		if limit is None:
+			return sorted(scores, key=rank)
+		import heapq
+		return heapq.nsmallest(limit, scores, key=rank)
+
+class UsageLog:
+	"""Count of retrievals of each application and time of the last one, kept in a file (see the usage_file setting)
+	so that fuzzy search ranks the applications used often and recently first.
+
+	The file holds JSON: a random key and, under a keyed hash (BLAKE2b) of each lower case application name, [number of
+	retrievals, time of the last retrieval]. Names are not stored in it, but anyone able to read it may test whether it
+	holds a given name, so it is only readable by its owner.
+
+	Class Variables
+	---------------
+	HALF_LIFE : int
+		Number of seconds after which the weight of retrievals in the usage score has halved.
+	"""
+	HALF_LIFE = 30 * 24 * 3600
+
+	def __init__(self, path):
+		self.path = path
+		self.key = None
+		self.entries = {}
+		try:
+			with open(path) as usage_file:
+				data = json.load(usage_file)
+			self.key, self.entries = bytes.fromhex(data['key']), data['entries']
+		except FileNotFoundError:
+			pass
+		except (OSError, ValueError, KeyError, TypeError) as err:
+			logger.warning('Could not read usage file {} ({}). Starting a new one.'.format(path, err))
+		if self.key is None:
+			self.key, self.entries = os.urandom(16), {}
+
+	def digest(self, name):
+		import hashlib
+		return hashlib.blake2b(name.lower().encode(), key=self.key, digest_size=12).hexdigest()
+
+	def score(self, name):
+		"""Return the usage score of the application name, from 0 (never retrieved) towards 1 (retrieved many times and
+		recently)."""
+		entry = self.entries.get(self.digest(name))
+		if not entry:
+			return 0.0
+		count, last_used = entry
+		return 0.5 ** (max(time.time() - last_used, 0) / self.HALF_LIFE) * count / (count + 1)
+
+	def record(self, name):
+		"""Record a retrieval of the application name now and write the file."""
+		entry = self.entries.setdefault(self.digest(name), [0, 0])
+		entry[0], entry[1] = entry[0] + 1, int(time.time())
+		temp_path = self.path + '.tmp'
+		try:
+			file_descriptor = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+			with open(file_descriptor, 'w') as usage_file:
+				json.dump({'key': self.key.hex(), 'entries': self.entries}, usage_file)
+			os.replace(temp_path, self.path)
+		except OSError as err:
+			logger.warning('Could not write to usage file {} ({}).'.format(self.path, err))
+
+class BreachCorpus:
+	"""A local copy of a corpus of breached passwords (see the breach_corpus setting): a file of SHA-1 hashes sorted
+	by hash, one per line, in the format of the Pwned Passwords downloads (40 hexadecimal digits, optionally followed by
+	a colon and the number of times the password was seen).
+
+	The file is memory-mapped and searched by bisection, so each lookup only reads the few pages of the file it
+	touches, however large the file is (tens of gigabytes). Nothing is loaded into memory or sent over the network.
+
+	Class Variables
+	---------------
+	LINE_PATTERN : compiled regular expression
+		Matches a line of the file (as bytes).
+	"""
+	LINE_PATTERN = re.compile(rb'[0-9A-Fa-f]{40}(:[0-9]+)?\r?')
+
+	def __init__(self, path):
+		self.path = path
+
+	def counts(self, digests):
+		"""Return a dictionary mapping each of digests (SHA-1 hexadecimal digests, lower case) found in the file to the
+		number of times the password was seen (1 if the file does not say). Raise ValueError if the file is not in the
+		expected format, and OSError if it cannot be read."""
+		import mmap
+		found = {}
+		with open(self.path, 'rb') as corpus_file:
+			if not os.fstat(corpus_file.fileno()).st_size:
+				return found
+			with mmap.mmap(corpus_file.fileno(), 0, access=mmap.ACCESS_READ) as corpus:
+				if hasattr(corpus, 'madvise'):
+					corpus.madvise(mmap.MADV_RANDOM)
+				first_line = corpus[:corpus.find(b'\n') if corpus.find(b'\n') != -1 else len(corpus)]
+				if not self.LINE_PATTERN.fullmatch(first_line):
+					raise ValueError('{} is not a file of SHA-1 hashes'.format(self.path))
+				upper_case = not first_line[:40].islower()
+				# Each search starts where the previous one ended, as the digests are looked up in order.
+				start = 0
+				for digest in sorted(digests):
+					start, count = self.find(corpus, (digest.upper() if upper_case else digest).encode(), start)
+					if count:
+						found[digest] = count
+		return found
+
+	@staticmethod
+	def find(corpus, target, lo):
+		"""Search the memory-mapped corpus, from offset lo (the start of a line) on, for the line beginning with target.
+		Return (offset of the start of the line where the search ended, which is at or before target's place in
+		corpus, number of times target was seen or 0 if it was not found)."""
+		hi = len(corpus)
+		while lo < hi:
+			mid = (lo + hi) // 2
+			start = corpus.rfind(b'\n', lo, mid)
+			start = lo if start == -1 else start + 1
+			end = corpus.find(b'\n', mid)
+			end = len(corpus) if end == -1 else end
+			key = corpus[start:start + len(target)]
+			if key == target:
+				count = corpus[start + len(target) + 1:end].strip()
+				return start, int(count) if count.isdigit() else 1
+			if key < target:
+				lo = end + 1
+			else:
+				hi = start
+		return lo, 0
+
+class PasswordAudit:
+	"""Audit of the passwords in an archive (see --audit): passwords used by more than one application, weak passwords
+	and passwords found in a BreachCorpus. The findings refer to passwords by application name only, so they may be
+	printed safely. The passwords themselves are not kept.
+
+	A password is weak if it is shorter than MIN_LENGTH, has characters of only one class (e.g. only digits), has
+	fewer than MIN_DISTINCT_CHARACTERS different characters or, failing all those, could be found by trying fewer
+	than 2**MIN_ENTROPY passwords of its length and classes of characters.
+
+	Class Variables
+	---------------
+	CLASS_DESCRIPTIONS : dictionary
+		Description of the characters in each class of characters a password may contain.
+	CLASS_SIZES : dictionary
+		Number of characters in each class.
+	MIN_DISTINCT_CHARACTERS : int
+		Minimum number of different characters in a password which is not weak.
+	MIN_ENTROPY : int
+		Minimum number of bits of entropy (an upper bound worked out from the length and classes of characters) of a
+		password which is not weak.
+	MIN_LENGTH : int
+		Minimum length of a password which is not weak.
+
+	Instance Variables
+	------------------
+	reused : list
+		A list of labels (see self.label) of the passwords shared by each group of applications using the same one.
+	weak : list
+		(label, list of the reasons the password is weak) for each weak password.
+	breached : list
+		(label, number of times seen) for each password found in the breach corpus.
+	"""
+	CLASS_DESCRIPTIONS = {'lower': 'lower case letters', 'upper': 'upper case letters', 'digit': 'digits',
+		'symbol': 'symbols'}
+	CLASS_SIZES = {'lower': 26, 'upper': 26, 'digit': 10, 'symbol': 33}
+	MIN_DISTINCT_CHARACTERS = 5
+	MIN_ENTROPY = 50
+	MIN_LENGTH = PasswordPolicy.MIN_LENGTH
+
+	def __init__(self, entries, corpus=None):
+		"""Audit entries, an iterable of (name, list of passwords) pairs, checking the passwords against corpus (a
+		BreachCorpus) if one is given."""
+		self.num_applications = 0
+		self.num_pwords = 0
+		self.weak = []
+		# Labels of the uses of each password, found in a single pass over the entries.
+		labels_by_pword = {}
+		for name, passwords in entries:
+			self.num_applications += 1
+			self.num_pwords += len(passwords)
+			for index, pword in enumerate(passwords):
+				label = self.label(name, index, len(passwords))
+				labels_by_pword.setdefault(pword, []).append(label)
+				reasons = self.weaknesses(pword)
+				if reasons:
+					self.weak.append((label, reasons))
+		self.reused = sorted(labels for labels in labels_by_pword.values() if len(labels) > 1)
+		self.breached = []
+		if corpus:
+			import hashlib
+			# Each password is hashed once, however many applications use it.
+			labels_by_digest = {hashlib.sha1(pword.encode()).hexdigest(): labels
+				for pword, labels in labels_by_pword.items()}
+			counts = corpus.counts(labels_by_digest)
+			self.breached = sorted((label, count) for digest, count in counts.items()
+				for label in labels_by_digest[digest])
+
+	@staticmethod
+	def label(name, index, num_pwords):
+		"""Return how the password at index in the list of num_pwords passwords of the application name is referred to."""
+		return name if num_pwords == 1 else '{} (password {})'.format(name, index + 1)
+
+	@classmethod
+	def weaknesses(cls, pword):
+		"""Return a list of the reasons pword is weak, empty if it is not."""
+		reasons = []
+		if len(pword) < cls.MIN_LENGTH:
+			reasons.append('shorter than {} characters'.format(cls.MIN_LENGTH))
+		classes = {'lower' if char in string.ascii_lowercase else 'upper' if char in string.ascii_uppercase
+			else 'digit' if char in string.digits else 'symbol' for char in pword}
+		if len(classes) == 1:
+			reasons.append('only {}'.format(cls.CLASS_DESCRIPTIONS[next(iter(classes))]))
+		if len(set(pword)) < cls.MIN_DISTINCT_CHARACTERS:
+			num_distinct = len(set(pword))
+			reasons.append('only {} different character{}'.format(num_distinct, 's' if num_distinct > 1 else ''))
+		if not reasons:
+			import math
+			entropy = len(pword) * math.log2(sum(cls.CLASS_SIZES[name] for name in classes))
+			if entropy < cls.MIN_ENTROPY:
+				reasons.append('at most {:.0f} bits of entropy'.format(entropy))
+		return reasons
+
+class ClipboardError(PwmgrError):
+	"""Raised when text cannot be copied to the clipboard, e.g. because no backend suits the session."""
+
+class Clipboard:
+	"""The clipboard (or another selection) of the user's session, written with one of several backends.
+
+	Every backend but osc52 runs a program found on the PATH, with the commands given by COMMANDS. osc52 writes an OSC
+	52 escape sequence to the terminal, which asks the terminal itself to set its clipboard (this works over ssh, but
+	not every terminal allows it). The backend named by the clipboard_backend setting is used or, if it is 'auto', the
+	first in DETECTION_ORDER whose environment variable is set and programs are installed. Since that means searching
+	the PATH for several programs, the backend detected is cached in a file (see CACHE_FILENAME) in the runtime
+	directory, with the environment it was detected in, and detected again only if that changes or the cached backend
+	fails. A backend can be tried out against a fake program of the same name earlier on the PATH (see
+	tools/fakeclip.py).
+
+	clear_later starts a detached process which clears the clipboard after a delay, if it still holds the text copied
+	(compared by SHA-256 digest, so the text itself is not passed on). The process is in a session of its own, which
+	the command line interface neither waits for nor is kept alive by. osc52 cannot read the clipboard back, so what it
+	copies is never cleared.
+
+	Class Variables
+	---------------
+	CACHE_FILENAME : string
+		Name of the file, in the runtime directory, caching the backend detected.
+	CLEARER_SCRIPT : string
+		Python code run by the process started by clear_later, with the directory holding pwmgr as its argument and
+		the JSON encoded arguments of clear_if_unchanged on standard input.
+	COMMANDS : dictionary
+		Maps each backend but osc52 to the environment variable which must be set for it to be detected and to the
+		copy, paste and clear commands, in which {selection} is replaced by the selection (see SELECTION_ARGUMENTS).
+		A clear command of None means copying nothing.
+	DETECTION_ORDER : list
+		Backends in the order they are tried by detect.
+	SELECTION_ARGUMENTS : dictionary
+		Maps each backend to a dictionary giving the argument naming each selection in its commands (osc52: the
+		selection parameter of the escape sequence). Backends with fewer selections use the clipboard instead.
+	SELECTIONS : list
+		Possible values of the selection setting.
+	TIMEOUT : int
+		Number of seconds a clipboard program may take.
+	"""
+	CACHE_FILENAME = 'pwmgr-clipboard.json'
+	CLEARER_SCRIPT = 'import sys; sys.path.insert(0, sys.argv[1]); import pwmgr; pwmgr.Clipboard.run_clearer(sys.stdin)'
+	COMMANDS = {
+		'wl-copy': {'environment': 'WAYLAND_DISPLAY', 'copy': ['wl-copy', '{selection}'],
+			'paste': ['wl-paste', '--no-newline', '{selection}'], 'clear': ['wl-copy', '--clear', '{selection}']},
+		'xclip': {'environment': 'DISPLAY', 'copy': ['xclip', '-selection', '{selection}'],
+			'paste': ['xclip', '-selection', '{selection}', '-o'], 'clear': None},
+		'xsel': {'environment': 'DISPLAY', 'copy': ['xsel', '{selection}', '--input'],
+			'paste': ['xsel', '{selection}', '--output'], 'clear': ['xsel', '{selection}', '--clear']},
+		'tmux': {'environment': 'TMUX', 'copy': ['tmux', 'load-buffer', '-'], 'paste': ['tmux', 'save-buffer', '-'],
+			'clear': ['tmux', 'delete-buffer']},
+	}
+	DETECTION_ORDER = ['wl-copy', 'xclip', 'xsel', 'tmux', 'osc52']
+	SELECTION_ARGUMENTS = {
+		'wl-copy': {'primary': '--primary', 'secondary': '', 'clipboard': ''},
+		'xclip': {'primary': 'primary', 'secondary': 'secondary', 'clipboard': 'clipboard'},
+		'xsel': {'primary': '--primary', 'secondary': '--secondary', 'clipboard': '--clipboard'},
+		'tmux': {'primary': '', 'secondary': '', 'clipboard': ''},
+		'osc52': {'primary': 'p', 'secondary': 'c', 'clipboard': 'c'},
+	}
+	SELECTIONS = ['primary', 'secondary', 'clipboard']
+	TIMEOUT = 5
+
+	def __init__(self, backend='auto', selection='clipboard', cache_dir=None):
+		if backend != 'auto' and backend not in self.DETECTION_ORDER:
+			raise ClipboardError('{} is not a clipboard backend (use auto or one of {}).'.format(backend,
+				', '.join(self.DETECTION_ORDER)))
+		if selection not in self.SELECTIONS:
+			raise ClipboardError('{} is not a selection (use one of {}).'.format(selection, ', '.join(self.SELECTIONS)))
+		self.selection = selection
+		self.path_cache = os.path.join(cache_dir, self.CACHE_FILENAME) if cache_dir else None
+		# Detected when first needed if 'auto'.
+		self.backend = None if backend == 'auto' else backend
+		self.auto = backend == 'auto'
+
+	@classmethod
+	def environment(cls):
+		"""Return the environment variables which determine the backend detected."""
+		names = sorted({command['environment'] for command in cls.COMMANDS.values()}) + ['PATH']
+		return {name: os.environ.get(name, '') for name in names}
+
+	def detect(self, use_cache=True):
+		"""Return the backend suiting the session (see the class docstring), from the cache if use_cache is True and
+		it was cached in the same environment."""
+		environment = self.environment()
+		if use_cache and self.path_cache:
+			try:
+				with open(self.path_cache) as cache_file:
+					cached = json.load(cache_file)
+				if cached['environment'] == environment and cached['backend'] in self.DETECTION_ORDER:
+					return cached['backend']
+			except (OSError, ValueError, KeyError, TypeError):
+				pass
+		import shutil
+		with profiler.phase('clipboard detection'):
+			for backend in self.DETECTION_ORDER:
+				command = self.COMMANDS.get(backend)
+				if command is None or (environment[command['environment']] and all(shutil.which(program)
+						for program in {command['copy'][0], command['paste'][0]})):
+					break
+		logger.debug('Clipboard backend {} detected.'.format(backend))
+		if self.path_cache:
+			try:
+				os.makedirs(os.path.dirname(self.path_cache), mode=0o700, exist_ok=True)
+				temp_path = '{}.{}.tmp'.format(self.path_cache, os.getpid())
+				with open(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as cache_file:
+					json.dump({'environment': environment, 'backend': backend}, cache_file)
+				os.replace(temp_path, self.path_cache)
+			except OSError as err:
+				logger.debug('Could not cache the clipboard backend in {} ({}).'.format(self.path_cache, err))
+		return backend
+
+	def command(self, action):
+		"""Return the arguments of the command of self.backend for action ('copy', 'paste' or 'clear')."""
+		selection = self.SELECTION_ARGUMENTS[self.backend][self.selection]
+		return [argument.format(selection=selection) for argument in self.COMMANDS[self.backend][action]
+			if argument.format(selection=selection)]
+
+	def run(self, action, text=None):
+		"""Run the command of self.backend for action, with text (if given) as its input, and return its output (None
+		unless action is 'paste'). Raise ClipboardError if it fails."""
+		process_args = self.command(action)
+		# Programs which keep serving the selection after copying (xclip, xsel and wl-copy) do so in a child
+		# process which inherits the output streams, so these are only read when pasting. Otherwise the command would
+		# not be done until the selection was taken over.
+		output = subprocess.PIPE if action == 'paste' else subprocess.DEVNULL
+		try:
+			with profiler.subprocess_phase(process_args):
+				process = subprocess.run(process_args, input=text, stdout=output, stderr=output,
+					universal_newlines=True, timeout=self.TIMEOUT)
+		except (OSError, subprocess.SubprocessError) as err:
+			raise ClipboardError('Could not run {} ({}).'.format(process_args[0], err))
+		if process.returncode:
+			raise ClipboardError('{} failed (exit status {}).'.format(' '.join(process_args), process.returncode))
+		return process.stdout
+
+	def copy(self, text):
+		"""Copy text to the selection. If the backend was detected from the cache and fails, detect it again and
+		retry. Raise ClipboardError on failure."""
+		if self.backend is None:
+			self.backend = self.detect()
+		try:
+			self.copy_with_backend(text)
+		except ClipboardError as err:
+			if not self.auto:
+				raise
+			backend = self.detect(use_cache=False)
+			if backend == self.backend:
+				raise
+			logger.debug('{} Retrying with clipboard backend {}.'.format(err, backend))
+			self.backend = backend
+			self.copy_with_backend(text)
+
+	def copy_with_backend(self, text):
+		if self.backend != 'osc52':
+			self.run('copy', text)
+			return
+		import base64
+		sequence = '\x1B]52;{};{}\x07'.format(self.SELECTION_ARGUMENTS['osc52'][self.selection],
+			base64.b64encode(text.encode()).decode())
+		try:
+			with open('/dev/tty', 'w') as tty:
+				tty.write(sequence)
+		except OSError as err:
+			raise ClipboardError('Could not write to the terminal ({}).'.format(err))
+
+	def paste(self):
+		"""Return the contents of the selection, or None if the backend cannot read it (osc52)."""
+		if self.backend is None:
+			self.backend = self.detect()
+		if self.backend == 'osc52':
+			return None
+		return self.run('paste')
+
+	def clear(self):
+		"""Empty the selection."""
+		if self.COMMANDS[self.backend]['clear'] is None:
+			self.run('copy', '')
+		else:
+			self.run('clear')
+
+	def clear_if_unchanged(self, digest):
+		"""Clear the selection if it holds the text whose SHA-256 digest (hexadecimal) is digest. Return True if it
+		was cleared."""
+		import hashlib
+		text = self.paste()
+		if text is None or hashlib.sha256(text.encode()).hexdigest() != digest:
+			return False
+		self.clear()
+		return True
+
+	def clear_later(self, text, delay):
+		"""Start a detached process which calls self.clear_if_unchanged for text after delay seconds. Return at once.
+		Nothing is done if the backend cannot read the selection."""
+		if self.backend == 'osc52':
+			logger.debug('The clipboard is not cleared (OSC 52 cannot read it back).')
+			return
+		import hashlib
+		arguments = {'backend': self.backend, 'selection': self.selection, 'delay': delay,
+			'digest': hashlib.sha256(text.encode()).hexdigest()}
+		try:
+			process = subprocess.Popen([sys.executable, '-c', self.CLEARER_SCRIPT,
+				os.path.dirname(os.path.abspath(__file__))], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+				stderr=subprocess.DEVNULL, universal_newlines=True, start_new_session=True)
+			with process.stdin:
+				process.stdin.write(json.dumps(arguments))
+		except OSError as err:
+			logger.warning('The clipboard will not be cleared ({}).'.format(err))
+
+	@classmethod
+	def run_clearer(cls, arguments_file):
+		"""Body of the process started by clear_later: read the arguments from arguments_file, wait, and clear the
+		selection if it is unchanged."""
+		arguments = json.load(arguments_file)
+		time.sleep(arguments['delay'])
+		try:
+			cls(arguments['backend'], arguments['selection']).clear_if_unchanged(arguments['digest'])
+		except ClipboardError:
+			# Nobody is left to tell.
+			pass
+
+class RecordWriter:
+	"""Writes the results of a run to standard output as records for another program to read, rather than as text
+	for the user (see the --format option of PassManager). Every record is written and flushed as soon as it is
+	produced, so a reader gets results from a long run (e.g. a search of every archive) while it goes on.
+
+	Class Variables
+	---------------
+	FORMATS : list
+		The possible formats:
+		json   A single JSON list of the records, begun with the first record and ended by self.close().
+		jsonl  One JSON object per line.
+		nul    Only the values of each record chosen by the caller, each followed by a NUL character (as with
+		       find -print0). A NUL can appear neither in an application name nor in a password.
+	"""
+	FORMATS = ['json', 'jsonl', 'nul']
+
+	def __init__(self, output_format, out_file=None):
+		self.output_format = output_format
+		self.out_file = out_file or sys.stdout
+		self.num_records = 0
+
+	def write(self, record, values):
+		"""Write record (a dictionary), or in the nul format the strings in values, and flush it."""
+		if self.output_format == 'nul':
+			text = ''.join(value + '\0' for value in values)
+		elif self.output_format == 'json':
+			text = ('[' if not self.num_records else ',\n') + json.dumps(record)
+		else:
+			text = json.dumps(record) + '\n'
+		self.out_file.write(text)
+		self.out_file.flush()
+		self.num_records += 1
+
+	def close(self):
+		"""End the output (the JSON list of the json format, which is empty if no record was written)."""
+		if self.output_format == 'json':
+			self.out_file.write(']\n' if self.num_records else '[]\n')
+			self.out_file.flush()
+
 class PassManager:
 	"""
 	Class Variables
 	---------------
+	AGENT_MAX_REQUEST_SIZE : int
+		Maximum size in bytes of a single request accepted by the agent.
+	AGENT_SOCKET_ENV : string
+		Environment variable which, if set, gives the path of the socket of a running agent (see --agent).
+	AGENT_SOCKET_NAME : string
+		Name of the agent socket when neither AGENT_SOCKET_ENV nor the agent_socket setting is set.
+	ARCHIVE_BACKENDS : dictionary
+		Each key is a possible value of the archive_backend setting and its value the ArchiveBackend subclass used to
+		read and write 7z archives (see Vault).
 	ALLOWED_OPTIONS : dictionary
 		Each key is the full name of a possible command line option as: --key, and its value is the default for
 		that option.
 	ALLOWED_OPTIONS_WITH_PARAMETER : dictionary
 		Each key is the full name of a possible command line option which must be followed by a single parameter as:
 		--key parameter. Its value defines the default value of the parameter.
+	ALLOWED_OPTIONS_WITH_PARAMETERS : dictionary
+		Each key is the full name of a possible command line option which may be followed by any number of parameters
+		as: --key parameter1 parameter2 ... Its value defines the default value of the (list of) parameters.
 	CONFIG_FILE_NAME : string
 		Name of configuration file (this must be in the same directory as this script.
 	CONFIG_SETTINGS : dictionary
 		Each key is the identifier (string) of a setting that may be set in CONFIG_FILE_NAME. Its value is the 
 		default for that setting.
+	EXIT_USAGE, EXIT_NOT_FOUND, EXIT_INCORRECT_PASSWORD, EXIT_INPUT_REQUIRED : int
+		Exit statuses of a run with invalid command line arguments, in which nothing was found for (one of) the
+		application names or the search asked for, which failed because the archive password was incorrect, and which
+		needed input forbidden by --no-input. Any other error exits with status 1.
 	HIDDEN_PRINT_COLOUR_ID : string
 		Template ANSI escape sequence \u001b[38;5;{id}m' used to conceal passwords printed to the console.
 		{id} runs from 0 to 255; 232-255 describes greys (black to white). Usage of this code is shell and/or
 		terminal dependent.
+	JOURNAL_FILENAME : string
+		Name of the journal in the archive, which records changes not yet merged into PASSWORD_FILENAME (see
+		PasswordJournal).
 	MIN_GENERATED_PWORD_LENGTH : int
 		Minimum length of password that can be generated. It is not recommended to reduce this (see implementation in 
 		self.generate_new_pword()). Note that there is no restriction on user entered passwords.
 	MAX_GENERATED_PWORD_LENGTH : int
 		Maximum length of password that can be generated.
+	MAX_ARCHIVE_WORKERS : int
+		Maximum number of archives read at the same time by the all-archives option.
+	GENERATE_BATCH_SIZE : int
+		Number of passwords generated (see PasswordGenerator.generate_many) and printed at a time by --generate.
 	OPTION_ABBREVIATIONS : dictionary
 		Each key is a possible short command line option; -key, and its value is the key of the option in 
 		ALLOWED_OPTIONS or ALLOWED_OPTIONS_WITH_PARAMETER that key is an abbreviation of.
+	OUTPUT_FORMATS : list
+		Possible parameters of the --format option (see RecordWriter).
+	PASSWORD_FD_ENV : string
+		Environment variable which, if set, gives a file descriptor from which passwords are read instead of
+		prompting for them (as does --password-fd).
 	PASSWORD_FILENAME : string
 		Name of the password file in the archive.
 	RESET_ANSI : string
 		ANSI escape sequence used to reset all formatting (in particular, any foreground colour change).
+	SHELL_HELP : string
+		Message displayed by the help command of the interactive shell (--shell).
+	SHELL_COMMANDS : list
+		Commands of the interactive shell which take an application name.
+	SHELL_MATCHES : int
+		Maximum number of matching application names shown below the command line of the interactive shell.
+	THROUGHPUT_FILENAME : string
+		Name of the file in the cache directory (see self.cache_directory) recording how fast 7z reads and writes
+		archives (see ThroughputStats).
 	TIMEOUT : int
-		Length of time to wait for 7z extraction and update commands to complete (None for no timeout).
+		Length of time to wait for 7z extraction and update commands to complete when the 7z_timeout setting is auto,
+		to which the time expected for the size of the archive is added (see ThroughputStats.timeout).
 	USAGE : string
 		Message displayed with the --help option.
 	VERSION : float
 		Current version of this program.
 	"""
-	ALLOWED_OPTIONS = {'help':False, 'list':False, 'version': False}
+	AGENT_MAX_REQUEST_SIZE = 65536
+	AGENT_SOCKET_ENV = 'PWMGR_AGENT_SOCK'
+	AGENT_SOCKET_NAME = 'pwmgr-agent.sock'
+	ARCHIVE_BACKENDS = Vault.ARCHIVE_BACKENDS
+	ALLOWED_OPTIONS = {'help':False, 'list':False, 'version': False, 'agent':False, 'lock':False, 'unlock':False,
+		'stop-agent':False, 'all':False, 'all-archives':False, 'profile':False,
+		'shell':False, 'audit':False, 'rekey':False, 'no-input':False}
 	ALLOWED_OPTIONS_WITH_PARAMETER = {'set-archive':None, 'application_name':None, 'update':None, 'search':None,
-		'new-archive':None}
+		'new-archive':None, 'update-batch':None, 'migrate':None, 'fuzzy':None, 'limit':None, 'complete':None,
+		'generate':None, 'policy':None, 'import':None, 'export':None, 'conflict':None, 'file-format':None,
+		'format':None, 'password-fd':None}
+	ALLOWED_OPTIONS_WITH_PARAMETERS = {'get':None}
 	CONFIG_FILE_NAME = 'pwmgr_config'
 	CONFIG_SETTINGS = {'archive_name':'', '7z_application':'7z', 'always_print':False, 'copy_to_selection':True,
 	'logging_level':'WARNING', 'pvault_dir':'pvault', 'hidden_colour_visibility': 0.6, 'selection':'clipboard',
-	'generated_password_length':15, 'check_new_password':True}
+	'generated_password_length':15, 'check_new_password':True, 'agent_socket':'', 'agent_timeout':900,
+	'retrieve_all':False, 'archive_backend':'7z', 'journal_max_size':16384, 'lock_timeout':10,
+	'metrics_file':'', 'usage_file':'', 'name_cache':True, 'password_policy':'', 'password_rules':'', 'breach_corpus':'',
+	'clipboard_backend':'auto', 'selection_timeout':45, '7z_timeout':'auto'}
+	EXIT_USAGE = 2
+	EXIT_NOT_FOUND = 3
+	EXIT_INCORRECT_PASSWORD = 4
+	EXIT_INPUT_REQUIRED = 5
 	HIDDEN_PRINT_COLOUR_ID = '\u001b[38;5;idm'
-	MIN_GENERATED_PWORD_LENGTH = 8
-	MAX_GENERATED_PWORD_LENGTH = 100
-	OPTION_ABBREVIATIONS = {'h':'help','sa':'set-archive', 'u':'update', 's':'search', 'v':'version', 'n':'new-archive'}
-	PASSWORD_FILENAME = 'passes'
+	JOURNAL_FILENAME = Vault.JOURNAL_FILENAME
+	MIN_GENERATED_PWORD_LENGTH = PasswordPolicy.MIN_LENGTH
+	MAX_GENERATED_PWORD_LENGTH = PasswordPolicy.MAX_LENGTH
+	GENERATE_BATCH_SIZE = 10000
+	MAX_ARCHIVE_WORKERS = 8
+	OPTION_ABBREVIATIONS = {'h':'help','sa':'set-archive', 'u':'update', 's':'search', 'v':'version', 'n':'new-archive',
+		'ub':'update-batch', 'a':'all', 'aa':'all-archives', 'f':'fuzzy'}
+	OUTPUT_FORMATS = RecordWriter.FORMATS
+	PASSWORD_FD_ENV = 'PWMGR_PASSWORD_FD'
+	PASSWORD_FILENAME = Vault.PASSWORD_FILENAME
 	RESET_ANSI = '\u001b[0m'
+	SHELL_HELP = """Type part of an application name to see the names matching it (its characters in order) as you type. Tab
+completes the name to the first match. NAME below may be abbreviated to anything only one application matches.
+	get NAME       Print the passwords for NAME.
+	copy NAME      Copy the first password for NAME to the X selection.
+	update NAME    Set a new password for NAME (enter nothing to generate one).
+	delete NAME    Delete all passwords for NAME.
+	commit         Save the updates and deletions made so far.
+	rollback       Discard the updates and deletions made since the last commit.
+	quit, exit     Save any updates and deletions and end the session (also Ctrl-D).
+	abort          End the session without saving."""
+	SHELL_COMMANDS = ['get', 'copy', 'update', 'delete']
+	SHELL_MATCHES = 10
+	THROUGHPUT_FILENAME = '7z_throughput.json'
 	TIMEOUT = 5
 	USAGE = """PWMGR
 
@@ -68,35 +3312,196 @@ class PassManager:
 \u001b[1mOPTIONS\u001b[21m
 	\x1B[3mapplication_name\x1B[23m
 		Retrieves any passwords for \x1B[3mapplication_name\x1B[23m listed in the password file of the current archive.
-		If the archive is password protected, a prompt will be given to enter the archive password. By default, the
-		first password found is copied to the clipboard and, if multiple passwords are found, the user may choose
-		to print them to the console. Relevant configuration settings include: \x1B[3mcopy_to_selection\x1B[23m, 
-		\x1B[3mhidden_colour_visibility\x1B[23m and \x1B[3malways_print\x1B[23m.
+		If the archive is password protected, a prompt will be given to enter the archive password. By default,
+		extraction stops as soon as the first password for \x1B[3mapplication_name\x1B[23m is found, and this password
+		is copied to the clipboard. With the -a option (or the \x1B[3mretrieve_all\x1B[23m setting) the whole password
+		file is read and, if multiple passwords are found, the user may choose to print them to the console. Relevant
+		configuration settings include: \x1B[3mcopy_to_selection\x1B[23m, \x1B[3mhidden_colour_visibility\x1B[23m and
+		\x1B[3malways_print\x1B[23m.
+
+	-a, --all
+		Retrieve all passwords for \x1B[3mapplication_name\x1B[23m, rather than only the first.
+
+	-aa, --all-archives
+		Used with -s or --rekey, search or re-encrypt every 7-Zip archive and native vault in the pvault directory
+		instead of only the current archive. The archives are decrypted at the same time and the matches found in
+		each archive are printed, as archive_name: application_name, as soon as that archive has been searched. A
+		prompt is given for a password, which is tried on every archive, followed by a prompt for each archive it does
+		not open.
+
+	--agent
+		Unlock the current archive once and start a background agent which keeps the password file in memory.
+		Subsequent retrievals, searches and updates of that archive are answered by the agent over a Unix socket
+		instead of a password prompt and a 7z extraction. The agent locks itself (forgets the archive password and
+		its contents) after \x1B[3magent_timeout\x1B[23m seconds without requests. The shell commands printed on
+		start-up export PWMGR_AGENT_SOCK, which may be used to point clients at a non-default socket.
+
+	--lock, --unlock, --stop-agent
+		Lock a running agent, unlock it again (a prompt will be given for the archive password) or stop it.
+
+	--get [\x1B[3mapplication_name\x1B[23m ...]
+		Retrieve the passwords for several applications with a single extraction of the archive. If no application
+		names follow the option, whitespace separated names are read from standard input. For each requested name,
+		one line of JSON is printed in the order requested:
+			{"name": "application_name", "found": true, "passwords": ["pword1", ...]}
+		Names with no passwords are reported with "found": false and an empty list (and the exit status is 3). Nothing
+		is copied to the X selection. See also --format.
+
+	--audit
+		Check every password in the current archive and list the applications whose passwords are used by other
+		applications too, are weak (short, of only one kind of character, made of a few repeated characters or
+		otherwise easily guessed) or, if the \x1B[3mbreach_corpus\x1B[23m setting is set, are in that list of breached
+		passwords. Passwords are never printed. --limit limits the number of applications listed under each heading.
+
+	--complete \x1B[3mprefix\x1B[23m
+		Print the application names in the current archive beginning with \x1B[3mprefix\x1B[23m (which may be empty),
+		one per line, for shell completion (see completion/pwmgr.bash and completion/pwmgr.zsh). No password is asked
+		for and the archive is not decrypted: the names come from the encrypted copy kept by the
+		\x1B[3mname_cache\x1B[23m setting or, failing that, from a running agent. If neither has them (e.g. after
+		logging in again, until the archive is next opened), nothing is printed.
+
+	--export \x1B[3mfile\x1B[23m
+		Write every application name and password in the current archive to \x1B[3mfile\x1B[23m (- for standard
+		output), which must not exist already and is created readable only by its owner. Its format (see --import) is
+		given by --file-format or the extension of \x1B[3mfile\x1B[23m (.csv, .jsonl or .json), and is otherwise that of
+		the password file. The passwords are \x1B[3mnot\x1B[23m encrypted, so delete the file once it has been used.
+
+	-f, --fuzzy \x1B[3mquery\x1B[23m
+		Print the application names resembling \x1B[3mquery\x1B[23m, best first, one per line and nothing else (so the
+		output may be piped, e.g. into a selector). Names are compared by the runs of three characters they share with
+		\x1B[3mquery\x1B[23m, so misspelt queries still find them. If the \x1B[3musage_file\x1B[23m setting is set,
+		names retrieved often and recently are ranked higher. Names which score the same are in alphabetical order.
+
+	--format json|jsonl|nul
+		Write the results of a retrieval, --get, -s (also with -aa), -f, -u or -ub to standard output as records for
+		another program to read, and nothing else: no messages, colours or prompts to show more, and nothing is copied
+		to the X selection. Each record is written as soon as it is known. The records are JSON objects:
+			retrieval, --get   {"name": "application_name", "found": true, "passwords": ["pword1", ...]}
+			-s, -f             {"name": "application_name"} ({"archive": ..., "name": ...} with -aa)
+			-u                 {"name": "application_name", "password": "pword"}
+			-ub                as printed without --format
+		json writes a single JSON list of all the records and jsonl one record per line. nul writes only values, each
+		followed by a NUL character (as find -print0 does): the passwords retrieved; for --get, the first password of
+		each name requested (empty if there is none); the names found by -s or -f (with -aa, archive and name); the
+		password set by -u; and for -ub, each name and its generated password (empty if it was not generated). See
+		also EXIT STATUS.
+
+	--generate \x1B[3mN\x1B[23m
+		Print \x1B[3mN\x1B[23m new passwords, one per line, generated following the password policy (see the
+		\x1B[3mpassword_policy\x1B[23m and \x1B[3mpassword_rules\x1B[23m settings, and --policy), and report on
+		standard error how many bits of entropy each has. If an \x1B[3mapplication_name\x1B[23m is given first, the
+		rule for that application applies. No archive is read.
 
 	-h, --help
 		Display this message and quit.
 
+	--import \x1B[3mfile\x1B[23m [--conflict keep|overwrite|append] [--file-format passes|csv|jsonl|json]
+		Add the passwords in \x1B[3mfile\x1B[23m (- for standard input), e.g. exported from another password manager,
+		to the current archive. The format is given by --file-format or the extension of \x1B[3mfile\x1B[23m, or else
+		judged from its first line:
+			passes   application_name password on each line, as in the password file.
+			csv      A header row naming the columns, with one holding the password (password or login_password)
+			         and one the name (name, title, application or account) or a URL (url, login_uri or website).
+			         This covers the CSV exports of Bitwarden, KeePassXC, LastPass, 1Password and web browsers.
+			         Without such a header, each row is application_name,password.
+			jsonl    One JSON object per line with "name" and "password" (or a list, "passwords").
+			json     A list of such objects, or an unencrypted Bitwarden JSON export.
+		Whitespace in names is replaced by underscores, and entries without a password are skipped. If an application
+		already has passwords, --conflict says whether they are kept and the imported ones ignored (keep, the
+		default), replaced by the imported ones (overwrite) or followed by those of the imported ones they do not
+		include (append). The whole file is read and checked before the archive password is prompted for, then
+		merged into the archive, which is written once, so either every password is imported or none are.
+
+	--limit \x1B[3mN\x1B[23m
+		Show no more than the first \x1B[3mN\x1B[23m results of -s or -f (or under each heading of --audit).
+
+	--migrate \x1B[3mvault_name\x1B[23m
+		Copy all passwords in the current 7-Zip archive into a new native vault called \x1B[3mvault_name\x1B[23m in the
+		pvault directory, protected by the same password. The archive itself is not changed.
+
 	-n, --new-archive \x1B[3marchive_name\x1B[23m
 		Create a new archive with an empty password file inside the pvault directory. A prompt will be given to set
 		a password for the archive (enter nothing for no password). If the archive_name setting is not already specified
-		in pwmgr_config, it will be set to the newly created archive.
+		in pwmgr_config, it will be set to the newly created archive. If \x1B[3marchive_name\x1B[23m ends in .pwv, a
+		native vault is created instead of a 7-Zip archive.
+
+	--no-input
+		Never wait for the user to answer: every question which has a default answer (such as whether to show all
+		the passwords found, or, for -u, the new password, which is then generated) takes it, and pwmgr exits with
+		status 5 if anything else (e.g. the archive password) would have to be asked for. Use with --password-fd.
+
+	--password-fd \x1B[3mfd\x1B[23m
+		Read passwords from the open file descriptor \x1B[3mfd\x1B[23m, one per line, instead of prompting for them
+		(a new password is read once, whatever the check_new_password setting), e.g.
+			pwmgr github --password-fd 3 3< file_holding_the_password
+		Each password which would be asked for is read from the next line, e.g. for -u the archive password and then
+		the new password (an empty line generates one). The PWMGR_PASSWORD_FD environment variable may be set to
+		\x1B[3mfd\x1B[23m instead.
+
+	--profile
+		Once finished, print (to standard error) how long each phase of the run took, e.g. reading pwmgr_config, the
+		password prompt, each 7z or clipboard process (without the password) and parsing the password file, together
+		with the number of lines parsed and bytes read and written. See also the metrics_file setting.
+
+	--policy '\x1B[3mspec\x1B[23m'
+		Change the password policy for this run only, as does the \x1B[3mpassword_policy\x1B[23m setting (which it
+		follows), e.g. --policy 'length=24 symbols=!#%+-.:=@_'.
+
+	--rekey
+		Change the password of the current archive (or, with -aa, of every archive in the pvault directory). Prompts
+		are given for the current and the new password. Every file in the archive is streamed from 7z extraction into
+		a new archive encrypted with the new password, without being written to disk unencrypted, and the new archive
+		is checked before it replaces the old one, so an archive is either fully re-encrypted or untouched. Native
+		vaults are rewritten under a new key. With -aa the archives are re-encrypted at the same time, the current
+		password is tried on every one and a prompt is then given for each archive it did not open. Whether each
+		archive succeeded is printed at the end.
 
 	-s, --search '\x1B[3mregular_expression\x1B[23m'
 		Searches the list of application names in the password file using a pythonic regular expression (case insensitive).
-		To avoid shell expansion, this should be placed in single quotes.
+		To avoid shell expansion, this should be placed in single quotes. Matching names are listed in alphabetical
+		order.
 
 	-sa, --set-archive \x1B[3marchive_name\x1B[23m
 		Choose which 7-Zip archive in the pvault directory to use. This sets the archive_name configuration setting
 		in pwmgr_config.
 
+	--shell
+		Unlock the current archive once and start an interactive session. As an application name is typed, the names
+		matching it (containing its characters in order) are shown below it, narrowing with every keystroke. The
+		commands get, copy, update and delete act on an application, and updates and deletions are only saved by the
+		commit command or when the session ends (type help for details).
+
 	-u, --update \x1B[3mapplication_name\x1B[23m
 		Update the password for \x1B[3mapplication_name\x1B[23m, or create a new entry if one does not already exist.
 		A prompt will be given to enter the new password - enter nothing to have pwmgr generate a password for you
 		(by default the generated password will be copied to the clipboard).
 
+	-ub, --update-batch \x1B[3mfile\x1B[23m
+		Add or update the passwords for many applications at once. Each line of \x1B[3mfile\x1B[23m (- for standard
+		input) has the format of the password file: application_name password. A line with only an application name
+		has a password generated for it. All entries are merged into the password file in a single pass and the
+		archive is updated once, so either every entry is stored or none are. One line of JSON is printed per
+		application, including the password if it was generated.
+
 	-v, --version
 		Print the version of the program and quit.
 
+\u001b[1mEXIT STATUS\u001b[21m
+	0	Success.
+	1	Any error not listed below (e.g. a failure of 7z, or an archive which cannot be written).
+	2	Invalid command line arguments.
+	3	Nothing was found: no password for \x1B[3mapplication_name\x1B[23m (or for one of the names given to --get), or
+		no application name matching -s or resembling -f.
+	4	The archive password was incorrect (or the archive is corrupt, which 7-Zip cannot tell apart).
+	5	Input was required, which --no-input forbids.
+
+\u001b[1mNATIVE VAULTS\u001b[21m
+	As an alternative to a 7-Zip archive, passwords may be kept in a native vault (a .pwv file in the pvault
+	directory, see -n and --migrate), which is used in exactly the same way. Every application's entry is encrypted
+	separately (ChaCha20-Poly1305 with a key derived from the password by scrypt), so a retrieval only decrypts the
+	index of names and that application's entry, and an update only appends to the file. 7-Zip is not used, but the
+	cryptography python package is required.
+
 \u001b[1mSet-up\u001b[21m
 	For initial set-up and additional information, please refer to https://github.com/piperfw/pwmgr/blob/master/README.md
 
@@ -118,8 +3523,9 @@ class PassManager:
 		Default: False
 
 	copy_to_selection (True/False)
-		If True, xclip is used to copy the first password retrieved to the X selection specified by the selection setting
-		(this also occurs when a new password is generated following use of the -u option).
+		If True, the first password retrieved is copied to the selection specified by the selection setting (this also
+		occurs when a new password is generated following use of the -u option), using clipboard_backend. If copying
+		fails, the password is printed instead.
 		Default: True.
 
 	logging_level
@@ -136,22 +3542,140 @@ class PassManager:
 		Default: 0.6
 
 	selection (primary/secondary/clipboard)
-		The X selection to be used if copy_to_selection is True.
+		The X selection to be used if copy_to_selection is True. Under Wayland and with OSC 52, secondary means the
+		clipboard, and tmux only has its paste buffers.
 		Default: clipboard
 
+	clipboard_backend (auto/xclip/xsel/wl-copy/tmux/osc52)
+		How passwords are copied: with the xclip, xsel or wl-copy (and wl-paste) program, into the paste buffer of
+		tmux, or by osc52, an escape sequence asking the terminal to set its clipboard (which also works over ssh, if
+		the terminal allows it). auto uses the first of wl-copy (under Wayland), xclip and xsel (under X) and tmux (in
+		tmux) which is installed, and otherwise osc52. The backend detected is remembered in the runtime directory
+		($XDG_RUNTIME_DIR, or /tmp/pwmgr-uid) until the session's environment changes.
+		Default: auto.
+
+	selection_timeout (float)
+		Number of seconds after which a copied password is cleared from the selection, if it is still there (0 to
+		never clear it). This is done by a background process, so pwmgr exits at once. Passwords copied with osc52
+		are never cleared, as the clipboard cannot then be read back.
+		Default: 45.
+
 	generated_password_length (int)
 		The length of passwords generated by the program following use of the -u option. Must be at least 8 and no
-		greater than 100.
+		greater than 100 (see also password_policy).
 
 	check_new_password (True/False)
 		If True, when manually adding a new password you must enter it twice.
-		Default: True."""
+		Default: True.
+
+	agent_socket
+		Path of the Unix socket used by the agent (--agent). Overridden by the PWMGR_AGENT_SOCK environment variable.
+		Default: None ($XDG_RUNTIME_DIR/pwmgr-agent.sock, or /tmp/pwmgr-uid/pwmgr-agent.sock).
+
+	agent_timeout (int)
+		Number of seconds without requests after which the agent locks itself (0 to never lock).
+		Default: 900.
+
+	retrieve_all (True/False)
+		If True, always retrieve all passwords for an application (as with the -a option).
+		Default: False.
+
+	archive_backend (7z/py7zr)
+		How 7-Zip archives are read and written. 7z runs the program given by 7z_application for every read and
+		write. py7zr reads and writes archives within pwmgr (no 7z process is started) and requires the py7zr python
+		package. Both use AES-256 encrypted archives with encrypted headers and either may be used with any archive.
+		Default: 7z.
+
+	journal_max_size (int)
+		Updates of a 7-Zip archive are recorded in a journal (a second file in the archive, passes.journal) instead of
+		sorting and writing out the whole password file again (7-Zip still rewrites the whole archive, so updates of
+		large archives remain slow). Once the journal would grow beyond this many bytes, it is merged into the
+		password file. 0 merges every update immediately (set this if the archive is also used with versions of pwmgr
+		which do not read the journal). Native vaults are rewritten without their superseded entries once these take
+		up more than this many bytes and more than half of the vault.
+		Default: 16384.
+
+	lock_timeout (float)
+		Number of seconds to wait, when updating an archive, for another pwmgr process which is updating it to finish
+		(it is locked with the file .archive_name.lock in the pvault directory). pwmgr then exits with an error and
+		the archive is left as it was. Lookups never wait.
+		Default: 10.
+
+	7z_timeout (auto/float)
+		Number of seconds after which a 7z process which has not finished is stopped, and the read or update of the
+		archive fails (leaving the archive as it was), or 0 for never. auto allows 5 seconds plus four times as long
+		as the size of the archive should take, judging by how fast 7z has been measured to read and write archives
+		on this machine (recorded in $XDG_CACHE_HOME/pwmgr/7z_throughput.json, or ~/.cache/pwmgr/...). A process
+		which runs for longer than a second is shown on the terminal (standard error), with the time it should take.
+		Default: auto.
+
+	metrics_file
+		Path of a file to which a line of JSON is appended after every run, holding the names of the options used and
+		the timings and counts printed by --profile. No passwords or application names are recorded.
+		Default: None (no metrics are recorded).
+
+	usage_file
+		Path (relative to the pvault directory) of a file recording how often and when each application was last
+		retrieved, used to rank the results of -f. Application names are only stored as keyed hashes, but anyone who
+		can read the file may test whether it holds a given name (it is created readable only by its owner).
+		Default: None (results are ranked by similarity alone).
+
+	name_cache (True/False)
+		If True, whenever all the application names of an archive have been read (or the archive updated), they are
+		encrypted and stored beside it (in .archive_name.names) for --complete. The key is kept in the runtime
+		directory ($XDG_RUNTIME_DIR, or /tmp/pwmgr-uid), so the names can only be read during the same login session.
+		Requires the cryptography python package.
+		Default: True.
+
+	password_policy
+		How passwords are generated, as a whitespace separated list of key=value pairs:
+			length=N                  Number of characters (default: generated_password_length).
+			symbols=CHARACTERS        Punctuation characters used as well as letters and digits (default: none).
+			exclude_ambiguous=true    Leave out characters easily mistaken for one another, such as l, 1 and O, 0.
+			require=CLASS:N,...       Minimum number of characters of each class (lower, upper, digit or symbol).
+			                          Default: lower:1,upper:1,digit:3.
+			words=N                   Generate passphrases of N words instead (default: 0, i.e. characters).
+			wordlist=PATH             Words of passphrases, one per line (default: /usr/share/dict/words).
+			separator=CHARACTERS      Joins the words of passphrases (default: -).
+		e.g. password_policy length=20 symbols=!#%+-.:=@_ require=lower:1,upper:1,digit:2,symbol:1
+		Every password the policy allows is equally likely to be generated.
+		Default: None (letters and digits, as above).
+
+	password_rules
+		Path (relative to the pvault directory) of a file of rules for the passwords of particular applications.
+		Each line holds a pattern, which may contain shell-style wildcards (* and ?) and is matched against the
+		application name ignoring case, followed by key=value pairs as in password_policy. The pairs of the first line
+		whose pattern matches change the password policy for that application, e.g.
+			*bank*      length=12 symbols= require=digit:2
+			github      words=5 separator=.
+		Lines beginning with # are ignored.
+		Default: None.
+
+	breach_corpus
+		Path (relative to the pvault directory) of a local copy of a corpus of breached passwords for --audit: a file
+		of SHA-1 hashes sorted by hash, as downloaded from Pwned Passwords (e.g. with the PwnedPasswordsDownloader
+		tool), with lines such as 000000005AD76BD555C1D6D771DE417A4B87E4B4:10. The file is searched in place, without
+		reading it all or using the network, so it may be tens of gigabytes.
+		Default: None (passwords are not checked against a breach corpus)."""
 	VERSION = 1.4
 
 	def __init__(self, options):
 		# Options provided by command line arguments.
 		self.options = options
 		self.unset_options_to_defaults()
+		# Exit status of the run (see EXIT_NOT_FOUND), checked by main() once the run is over.
+		self.exit_status = 0
+		# Writes results as records instead of text for the user, if the format option is given (see RecordWriter).
+		self.record_writer = None
+		try:
+			self.run()
+		finally:
+			# Completes the output (e.g. closes the JSON list), even if the run ends with an error.
+			if self.record_writer:
+				self.record_writer.close()
+
+	def run(self):
+		"""Do whatever the options ask for. Called by __init__."""
 		# If help was passed as an argument, print the help message and exit.
 		if self.options['help']:
 			print(self.USAGE)
@@ -162,51 +3686,139 @@ class PassManager:
 			return
 		# self.config_dict holds settings loaded from config file (or their defaults).
 		self.config_dict = {}
-		self.config_file_path = os.path.abspath(os.path.join(os.path.dirname(__file__), self.CONFIG_FILE_NAME))
-		self.read_config_file()
-		self.unset_config_settings_to_defaults()
+		self.config_file_path = os.path.join(self.script_directory(), self.CONFIG_FILE_NAME)
+		with profiler.phase('config'):
+			self.read_config_file()
+			self.unset_config_settings_to_defaults()
+		# Report the time taken by each phase (see Profiler) if requested.
+		profiler.enabled = self.options['profile']
+		profiler.metrics_file = self.config_dict['metrics_file']
 		user_print_scale = float(self.config_dict['hidden_colour_visibility'])
 		self.hidden_print_colour = self.HIDDEN_PRINT_COLOUR_ID.replace(
 			'id', str(int(232+min(abs(23 * user_print_scale), 23))))
 		# Set logging level according to setting in self.config_dict (default INFO).
 		self.set_logging_level()
+		# Passwords are read from a file descriptor instead of the terminal if one is given (see self.read_password).
+		self.password_file = self.open_password_fd()
+		# How long 7z processes may run, and how slow ones are shown, for every Vault (see self.vault_settings).
+		self.archive_timeouts = self.read_archive_timeouts()
+		self.progress = ProgressIndicator() if sys.stderr.isatty() else None
+		if self.options['format']:
+			self.set_record_writer()
 		if self.options['set-archive']:
 			self.set_archive_save_to_config(self.options['set-archive'])
-		# string to hold contents of self.PASSWORD_FILENAME extracted from the archive
-		self.password_file_string = ''
 		# Set to store names of all applications found in archive (repeats omitted)
 		self.all_applications = set()
 		# Empty list to store all passwords found for the parameter application_name (if not None).
 		self.all_passes_retrieved = []
 		# Initialise relevant absolute pathnames (7z, pvault_dir, archive and pvault_output_dir).
 		self.abs_paths_init()
+		# Complete an application name and exit, if requested. This never prompts, even if the archive is missing.
+		if self.options['complete'] is not None:
+			self.complete()
+			return
+		# PasswordGenerator for each password policy used so far, by its spec.
+		self.password_generators = {}
+		# Generate passwords and exit, if requested.
+		if self.options['generate']:
+			self.generate_passwords()
+			return
 		# Create a new archive and exit, if requested.
 		if self.options['new-archive']:
 			self.make_new_archive()
 			return
+		# Lock, unlock or stop a running agent and exit, if requested.
+		if any([self.options['lock'], self.options['unlock'], self.options['stop-agent']]):
+			self.control_agent()
+			return
+		# Change the password of every archive in the pvault directory, or search them all, and exit, if requested.
+		if self.options['all-archives'] and self.options['rekey']:
+			self.rekey_archives(self.list_archives())
+			return
+		if self.options['all-archives']:
+			self.search_all_archives()
+			return
 		# Check archive actually exists (gives user option to temporarily reassign archive_username if it doesn't)
 		self.determine_archive()
-		# Unless one of search, update or application_name options is set, functionality ends.
-		if not any([self.options['search'], self.options['update'], self.options['application_name']]):
+		# All reads and updates of the archive (a 7z archive or a native vault) go through a Vault.
+		self.vault = self.make_vault(self.path_archive)
+		# Copy the archive into a new native vault and exit, if requested.
+		if self.options['migrate']:
+			self.migrate_archive()
+			return
+		# Import passwords from a file, or export them all to one, and exit, if requested.
+		if self.options['import']:
+			self.import_entries()
 			return
+		if self.options['export']:
+			self.export_entries()
+			return
+		# Audit the passwords in the archive and exit, if requested.
+		if self.options['audit']:
+			self.audit_vault()
+			return
+		# Change the password of the archive and exit, if requested.
+		if self.options['rekey']:
+			self.rekey_archives([self.config_dict['archive_name']])
+			return
+		# Start an agent serving the archive and exit, if requested.
+		if self.options['agent']:
+			self.start_agent()
+			return
+		# Start an interactive session, if requested.
+		if self.options['shell']:
+			self.run_shell()
+			return
+		# Unless one of search, fuzzy, update, update-batch, get or application_name options is set, functionality ends.
+		if not any([self.options['search'], self.options['fuzzy'], self.options['update'],
+				self.options['application_name'], self.options['update-batch'], self.options['get'] is not None]):
+			return
+		self.set_result_limit()
+		if self.options['get'] is not None:
+			self.read_batch_names()
+		# Read (and validate) all new entries before prompting for the archive password.
+		if self.options['update-batch']:
+			self.read_update_batch()
+		# If an agent is serving this archive, let it answer instead of prompting and extracting.
+		with profiler.phase('agent'):
+			if self.use_agent():
+				return
 		# Otherwise we must extract passwords from the archive, so get archive pword from user (empty if none).
-		self.archive_pword = getpass.getpass(prompt='Enter password for {}: '.format(self.config_dict['archive_name']))
-		# Extract self.PASSWORD_FILENAME in archive to self.password_file_string
-		self.extract_archive_to_string()
+		with profiler.phase('getpass'):
+			self.archive_pword = self.read_password('Enter password for {}: '.format(self.config_dict['archive_name']))
+		# If only the first password for an application is wanted, stop extracting as soon as it is found.
+		if self.first_match_only():
+			with profiler.phase('extract'):
+				found = self.extract_first_match()
+			if found:
+				self.present_passwords()
+				return
+		else:
+			# Decrypt the archive (the whole password file of a 7z archive, only the index of a native vault).
+			with profiler.phase('extract'):
+				self.open_vault()
 		# Holds pattern (regex) compiled from command line parameter following the search option, if specified.
 		self.user_regex_pattern = None
-		# Set of application names for which self.user_regex_pattern produces a match. Remains empty if no pattern.
-		self.search_results = set()
+		# Ordered list of application names for which self.user_regex_pattern produces a match. Empty if no pattern.
+		self.search_results = []
+		# Application names resembling self.options['fuzzy'], best first.
+		self.fuzzy_results = []
+		# Passwords found for each (lower case) name requested with the get option.
+		self.batch_results = {name.lower(): [] for name in self.options['get'] or []}
 		if self.options['search']:
 			self.set_user_regex_pattern()
 		# Main functionality - handles password retrieval, regex searching and updating.
-		self.parse_password_file_string()
+		self.read_vault()
 		# Present passwords or (inclusive) search results according to user options.
 		if self.options['application_name']:
-			# Show passwords found for self.options['application_name'] in self.password_file_string
+			# Show passwords found for self.options['application_name'] in the archive
 			self.present_passwords()
 		if self.options['search']:
 			self.present_search_results()
+		if self.options['fuzzy']:
+			self.present_fuzzy_results()
+		if self.options['get']:
+			self.present_batch_results()
 
 	def unset_options_to_defaults(self):
 		"""Option values in self.options that were NOT provided by command line arguments are set to the default values
@@ -218,6 +3830,46 @@ class PassManager:
 		for option_name, default_value in self.ALLOWED_OPTIONS_WITH_PARAMETER.items():
 			if option_name not in self.options:
 				self.options[option_name] = default_value
+		for option_name, default_value in self.ALLOWED_OPTIONS_WITH_PARAMETERS.items():
+			if option_name not in self.options:
+				self.options[option_name] = default_value
+
+	def complete(self):
+		"""Print the application names of the current archive beginning with self.options['complete'], one per line.
+		The names come from the archive's NameCache or, failing that, from an unlocked agent serving the archive.
+		Otherwise nothing is printed, as completion must never prompt or decrypt the archive."""
+		prefix = self.options['complete'].lower()
+		names = None
+		if self.config_dict['name_cache']:
+			names = NameCache(self.path_archive, self.runtime_directory()).read()
+		if names is None:
+			status = self.agent_request({'op': 'status'})
+			if not status or status['archive'] != self.path_archive or status['locked']:
+				return
+			response = self.agent_request({'op': 'complete', 'prefix': prefix})
+			names = response['names'] if response and response['ok'] else []
+		start = bisect.bisect_left(names, prefix)
+		for name in names[start:]:
+			if not name.startswith(prefix):
+				break
+			print(name)
+
+	def read_batch_names(self):
+		"""If no application names followed the get option, read whitespace separated names from stdin instead."""
+		if not self.options['get']:
+			self.options['get'] = sys.stdin.read().split()
+		if not self.options['get']:
+			logger.error('No application names given to the get option. Exiting.')
+			sys.exit(1)
+
+	@staticmethod
+	def script_directory():
+		"""Return the absolute path of the directory holding this script or, when run from a zipapp built by
+		tools/build_zipapp.py, the directory holding the zipapp (pwmgr_config and pvault are kept beside it)."""
+		directory = os.path.dirname(os.path.abspath(__file__))
+		if os.path.isfile(directory):
+			directory = os.path.dirname(directory)
+		return directory
 
 	def read_config_file(self):
 		"""Read config file at self.config_file_path and store settings as key-value pairs in self.config_dict."""
@@ -269,6 +3921,59 @@ class PassManager:
 				.format(self.config_dict['logging_level'], self.CONFIG_FILE_NAME))
 			logger.setLevel(logging.INFO)
 
+	def set_record_writer(self):
+		"""Check the parameter of the format option and set self.record_writer to write results in that format. The
+		records hold the passwords, so nothing is copied to the selection (nor printed in colour)."""
+		if self.options['format'] not in self.OUTPUT_FORMATS:
+			logger.error('{} is not an output format (use one of {}). Exiting.'.format(self.options['format'],
+				', '.join(self.OUTPUT_FORMATS)))
+			sys.exit(self.EXIT_USAGE)
+		self.record_writer = RecordWriter(self.options['format'])
+		self.config_dict['copy_to_selection'] = False
+
+	def open_password_fd(self):
+		"""Return a file object reading the file descriptor given by the password-fd option, or else the
+		PASSWORD_FD_ENV environment variable, or None if neither is set (passwords are then prompted for)."""
+		password_fd = self.options['password-fd'] or os.environ.get(self.PASSWORD_FD_ENV)
+		if not password_fd:
+			return None
+		try:
+			# The descriptor is left open, as it may be shared with the process which started this one.
+			return open(int(password_fd), 'r', closefd=False)
+		except (ValueError, OSError) as err:
+			logger.error('Cannot read passwords from file descriptor {} ({}). Exiting.'.format(password_fd, err))
+			sys.exit(self.EXIT_USAGE)
+
+	def read_password(self, prompt, default=None):
+		"""Prompt the user for a password (without echoing it) and return it.
+
+		If self.password_file is open (see self.open_password_fd), the next line read from it is returned instead,
+		without prompting, so each password asked for during the run is on a line of its own. Once the file is
+		exhausted, an empty string is returned. Otherwise, with the no-input option, default is returned or, if it is
+		None, the run exits with status EXIT_INPUT_REQUIRED.
+		"""
+		if self.password_file:
+			line = self.password_file.readline()
+			return line[:-1] if line.endswith('\n') else line
+		if self.options['no-input']:
+			if default is None:
+				self.input_required(prompt)
+			return default
+		return getpass.getpass(prompt=prompt)
+
+	def ask(self, prompt):
+		"""Print prompt and return the user's answer. With the no-input option, nothing is printed and an empty string
+		is returned, as if the user had just hit Enter (the default answer of every question asked this way)."""
+		if self.options['no-input']:
+			return ''
+		return input(prompt)
+
+	def input_required(self, prompt):
+		"""Exit with status EXIT_INPUT_REQUIRED, as the no-input option forbids prompting the user with prompt."""
+		logger.error('Input is required ({}) but the no-input option was given. Exiting.'.format(
+			prompt.strip().rstrip(':')))
+		sys.exit(self.EXIT_INPUT_REQUIRED)
+
 	def set_archive_save_to_config(self, new_archive_name):
 		"""Save the parameter of the -sa option passed to the command line as the name of the archive for future
 		retrievals, searches and updates."""
@@ -283,7 +3988,7 @@ class PassManager:
 		for setting_id, setting_value in self.config_dict.items():
 			# Adhere to format of config file defined in the usage/help message.
 			lines_to_write.append(' '.join([str(setting_id), str(setting_value)]))
-		str_to_write = '\n'.join(lines_to_write)
+		str_to_write = '\n'.join(lines_to_write) + '\n'
 		with open(self.config_file_path, 'w') as cfg:
 			cfg.write(str_to_write)
 
@@ -298,27 +4003,16 @@ class PassManager:
 			return
 		# Get a master password for the new archive.
 		new_archive_pword = self.get_new_pword(self.options['new-archive'])
-		# 7z quirk - if archive name does not end in .7z this extension will be added.
-		# End with . to ensure this does not occur.
-		if not new_archive_path.endswith('.7z'):
-			new_archive_path += '.'
-		# Run a 7z process to create the new archive (cannot include this in self.subprocess_run_wrapper - see 
-		# see note on subprocess usage in self.present_passwords).
-		creation_args = ['7z', 'a', new_archive_path, '-si' + self.PASSWORD_FILENAME, '-mhe', '-p' + new_archive_pword]
-		process = subprocess.Popen(creation_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-			universal_newlines=True, stdin=subprocess.PIPE)
-		try:
-			# Immediately close stdin (7z waits for keyboard input ended by EOF).
-			process.stdin.close() #7z now creates the archive
-			# Wait for the process to terminate by itself for up to self.TIMEOUT seconds.
-			process.wait(self.TIMEOUT)
+		# Create the new archive, holding an empty password file (or a new native vault).
+		try:
+			Vault.create(new_archive_path, new_archive_pword, archive_backend=self.archive_backend(),
+				path_7z=self.path_7z, progress=self.progress, **self.archive_timeouts)
+		except PwmgrError as err:
+			self.exit_on_error(err)
+		if new_archive_path.endswith(NativeVault.FILE_EXTENSION):
+			print('Vault {} created successfully.'.format(self.options['new-archive']))
+		else:
 			print('Archive {} created successfully.'.format(self.options['new-archive']))
-		except subprocess.TimeoutExpired:
-			error_message = '{} process failed to complete after {} seconds.'.format('Archive creation', self.TIMEOUT)
-			if process.stderr:
-				error_message += ' There were the following errors: {}'.format(process.stderr)
-			error_message += 'Exiting.'
-			logger.error(error_message)
 		# self.config_dict['archive_name'] == '' by default
 		if not self.config_dict['archive_name']:
 			self.set_archive_save_to_config(self.options['new-archive'])
@@ -326,13 +4020,179 @@ class PassManager:
 			logger.info('Did not set target archive to {} as \'archive_name\' setting already specified in {}.'.
 				format(self.options['new-archive'], self.CONFIG_FILE_NAME))
 
+	def migrate_archive(self):
+		"""Copy every entry of the 7z archive self.path_archive into a new native vault, self.options['migrate'] in the
+		pvault directory, protected by the same password. The archive is left unchanged."""
+		if self.vault.native_vault:
+			logger.error('{} is already a native vault. Exiting.'.format(self.config_dict['archive_name']))
+			sys.exit(1)
+		new_vault_path = os.path.abspath(os.path.join(self.path_pvault_dir, self.options['migrate']))
+		if os.path.exists(new_vault_path):
+			logger.error('{} already exists in {}. Please remove this or use a different vault name.'.format(
+				self.options['migrate'], self.path_pvault_dir))
+			sys.exit(1)
+		self.archive_pword = self.read_password('Enter password for {}: '.format(self.config_dict['archive_name']))
+		self.open_vault()
+		entries = list(self.vault.entries())
+		try:
+			NativeVault.create(new_vault_path, self.archive_pword, entries)
+		except (OSError, VaultError) as err:
+			self.exit_on_error(err)
+		print('{} applications copied from {} to {}. Use pwmgr -sa {} to switch to the new vault.'.format(
+			len(entries), self.config_dict['archive_name'], self.options['migrate'], self.options['migrate']))
+
+	def file_format(self, path, first_line=''):
+		"""Return the format (see EntryFile) of the file at path, read by --import or written by --export: the
+		file-format option if given, otherwise judged by EntryFile.detect_format. Exit if it is not a format."""
+		file_format = self.options['file-format'] or EntryFile.detect_format(path, first_line)
+		if file_format not in EntryFile.FORMATS:
+			logger.error('{} is not a file format (use one of {}). Exiting.'.format(file_format,
+				', '.join(EntryFile.FORMATS)))
+			sys.exit(1)
+		return file_format
+
+	def read_import_file(self):
+		"""Read every password in the file self.options['import'] ('-' for stdin) and return the EntryFile and the
+		list of (name, password) pairs read. The file is parsed one line at a time as it is read. Exit if it cannot be
+		read or is not in the expected format."""
+		import itertools
+		path = self.options['import']
+		try:
+			import_file = sys.stdin if path == '-' else open(path, 'r', newline='')
+			try:
+				# The first non-blank line may be needed to tell the format, so read up to it before the rest.
+				leading_lines = []
+				for line in import_file:
+					leading_lines.append(line)
+					if line.strip():
+						break
+				entry_file = EntryFile(self.file_format(path, leading_lines[-1] if leading_lines else ''))
+				records = list(entry_file.read(itertools.chain(leading_lines, import_file)))
+			finally:
+				if import_file is not sys.stdin:
+					import_file.close()
+		except OSError as err:
+			self.exit_on_error(err)
+		except ValueError as err:
+			# Also raised if the file is not valid UTF-8 (UnicodeDecodeError).
+			logger.error('Could not import {} ({}). No passwords were imported.'.format(path, err))
+			sys.exit(1)
+		if not records:
+			logger.error('No passwords found in {}. Exiting.'.format(path))
+			sys.exit(1)
+		return entry_file, records
+
+	def import_entries(self):
+		"""Merge the passwords in the file self.options['import'] into the archive, written with a single update (see
+		Vault.import_entries), and print a summary. The conflict option (default keep) says what happens to the
+		passwords of applications already in the archive. The whole file is read, and rejected if it is not valid,
+		before the archive password is prompted for."""
+		conflict = self.options['conflict'] or 'keep'
+		if conflict not in Vault.CONFLICT_POLICIES:
+			logger.error('{} is not a conflict policy (use one of {}). Exiting.'.format(conflict,
+				', '.join(Vault.CONFLICT_POLICIES)))
+			sys.exit(1)
+		entry_file, records = self.read_import_file()
+		self.archive_pword = self.read_password('Enter password for {}: '.format(self.config_dict['archive_name']))
+		with profiler.phase('extract'):
+			self.open_vault()
+		try:
+			actions = self.vault.import_entries(records, conflict)
+		except ValueError as err:
+			logger.error('{} No passwords were imported.'.format(err))
+			sys.exit(1)
+		except PwmgrError as err:
+			logger.error('Import into {} failed ({}). Exiting.'.format(self.config_dict['archive_name'], err))
+			sys.exit(1)
+		# An agent serving the archive holds its old contents, so lock it to make it read the archive again.
+		status = self.agent_request({'op': 'status'})
+		if status and status['archive'] == self.path_archive and not status['locked']:
+			self.agent_request({'op': 'lock'})
+			logger.info('Agent locked, as the archive it holds has changed.')
+		counts = {}
+		for action in actions.values():
+			counts[action] = counts.get(action, 0) + 1
+		descriptions = [('added', 'added'), ('replaced', 'replaced'), ('appended', 'with passwords appended'),
+			('kept', 'already present and kept'), ('unchanged', 'unchanged')]
+		print('{} applications imported from {} into {}: {}.'.format(len(actions), self.options['import'],
+			self.config_dict['archive_name'], ', '.join('{} {}'.format(counts[action], description)
+			for action, description in descriptions if action in counts)))
+		if entry_file.skipped:
+			print('{} entries without a name or a password were skipped.'.format(entry_file.skipped))
+
+	def export_entries(self):
+		"""Write every application and password in the archive to the file self.options['export'] ('-' for stdout), in
+		the format given by the file-format option or its extension (passes by default, see EntryFile). The file must
+		not exist already and is created readable only by its owner."""
+		path = self.options['export']
+		entry_file = EntryFile(self.file_format(path))
+		if path != '-' and os.path.exists(path):
+			logger.error('{} already exists. Please remove it or export to a different file.'.format(path))
+			sys.exit(1)
+		self.archive_pword = self.read_password('Enter password for {}: '.format(self.config_dict['archive_name']))
+		with profiler.phase('extract'):
+			self.open_vault()
+		try:
+			if path == '-':
+				num_applications, num_pwords = entry_file.write(self.vault.entries(), sys.stdout)
+			else:
+				with open(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'w') as export_file:
+					num_applications, num_pwords = entry_file.write(self.vault.entries(), export_file)
+		except OSError as err:
+			self.exit_on_error(err)
+		print('{} passwords for {} applications exported to {} ({}). The passwords are not encrypted: delete the file '
+			'once it is no longer needed.'.format(num_pwords, num_applications, path, entry_file.file_format),
+			file=sys.stderr)
+
+	def audit_vault(self):
+		"""Audit every password in the archive for reuse, weakness and, if the breach_corpus setting is set, presence
+		in a breach corpus (see PasswordAudit and BreachCorpus), then print the findings. No password is printed."""
+		self.set_result_limit()
+		corpus = None
+		if self.config_dict['breach_corpus']:
+			path_corpus = os.path.join(self.path_pvault_dir, os.path.expanduser(self.config_dict['breach_corpus']))
+			if not os.path.isfile(path_corpus):
+				logger.error('Breach corpus {} not found. Exiting.'.format(path_corpus))
+				sys.exit(1)
+			corpus = BreachCorpus(path_corpus)
+		self.archive_pword = self.read_password('Enter password for {}: '.format(self.config_dict['archive_name']))
+		with profiler.phase('extract'):
+			self.open_vault()
+		try:
+			with profiler.phase('audit'):
+				audit = PasswordAudit(self.vault.entries(), corpus)
+		except (OSError, ValueError) as err:
+			logger.error('Could not search the breach corpus ({}). Exiting.'.format(err))
+			sys.exit(1)
+		self.present_audit(audit, corpus)
+
+	def present_audit(self, audit, corpus):
+		"""Print the findings of audit (a PasswordAudit), listing no more than self.result_limit applications under
+		each heading."""
+		print('Audit of {} passwords for {} applications in {}.'.format(audit.num_pwords, audit.num_applications,
+			self.config_dict['archive_name']))
+		reused = [', '.join(labels) for labels in audit.reused]
+		weak = ['{}: {}'.format(label, ', '.join(reasons)) for label, reasons in audit.weak]
+		breached = ['{}: seen {} times'.format(label, count) for label, count in audit.breached]
+		headings = [('Passwords used by more than one application', reused), ('Weak passwords', weak)]
+		if corpus:
+			headings.append(('Passwords found in {}'.format(os.path.basename(corpus.path)), breached))
+		for heading, lines in headings:
+			print('{} ({}):'.format(heading, len(lines)) if lines else '{}: none.'.format(heading))
+			for line in lines[:self.result_limit]:
+				print('\t' + line)
+			if self.result_limit and len(lines) > self.result_limit:
+				print('\t... and {} more.'.format(len(lines) - self.result_limit))
+		if not corpus:
+			print('Passwords were not checked against a breach corpus (see the breach_corpus setting).')
+
 	def abs_paths_init(self):
 		"""Initialises a set of attributes corresponding to relevant path names for PassManager."""
 		# Absolute paths to the 'pvault' directory and the contained (ensures script will work when run from anywhere 
 		# in file system). N.B. If self.config_dict['pvault_dir'] == 'pvault', it is taken as a relative path
 		# to this script
 		if self.config_dict['pvault_dir'] == 'pvault':
-			self.path_pvault_dir = os.path.join(os.path.dirname(__file__), self.config_dict['pvault_dir'])
+			self.path_pvault_dir = os.path.join(self.script_directory(), self.config_dict['pvault_dir'])
 		else:
 			self.path_pvault_dir = os.path.abspath(self.config_dict['pvault_dir'])
 		self.path_archive = os.path.abspath(os.path.join(self.path_pvault_dir, self.config_dict['archive_name']))
@@ -358,12 +4218,12 @@ class PassManager:
 			else:
 				# 'archive_setting' set in config but not an actual archive.
 				print('Archive {} not found. Current files in pvault:'.format(self.config_dict['archive_name']))
-			# Print all .7z files in ./pvault/
-			for filename in os.listdir(self.path_pvault_dir):
-				# splitext[1] includes period ([0] gives filename).
-				if os.path.splitext(filename)[1] == '.7z':
-					print(filename)
+			# Print all .7z files (and native vaults) in ./pvault/
+			for filename in self.list_archives():
+				print(filename)
 			# Prompt user and set 'archive_name' setting to user's response unless the response is 'q'.
+			if self.options['no-input']:
+				self.input_required('Enter desired archive or q to quit:')
 			print('Enter desired archive or q to quit:', end=' ')
 			user_respose = input().strip()
 			# Note: 'q' does not have a .7z extension so cannot be an archive.
@@ -374,55 +4234,91 @@ class PassManager:
 			# Construct new path to be checked i next loop.
 			self.path_archive = os.path.abspath(os.path.join(self.path_pvault_dir, self.config_dict['archive_name']))
 
-	def extract_archive_to_string(self):
-		"""Extract from the 7z archive self.path_archive the contents of the file self.PASSWORD_FILENAME and store in 
-		self.password_file_string. The 7z application is used.
-		N.B. The file itself is not extracted in the sense that a copy of the file is not created outside the archive.
-		Removing self.PASSWORD_FILENAME would instead extract the contents of ALL files in the archive (possibly
-		allow for this in the future).
+	def list_archives(self):
+		"""Return an alphabetically ordered list of the names of all .7z archives and native vaults in the pvault
+		directory."""
+		# splitext[1] includes period ([0] gives filename).
+		return sorted(filename for filename in os.listdir(self.path_pvault_dir)
+			if os.path.splitext(filename)[1] in {'.7z', NativeVault.FILE_EXTENSION})
 
-		For the command line usage of the 7z program, see https://sevenzip.osdn.jp/chm/cmdline/
-		"""
-		# Arguments to be used in subprocess. Each element of list is passed to command line as its own string
-		# Note, it is fine for self.archive_pword is an empty string (archive not password protected).
-		extract_args = ['7z', 'e', self.path_archive, self.PASSWORD_FILENAME, '-so', '-p' + self.archive_pword]
-		# Run a command described by extract_args assign output (the contents of self.PASSWORD_FILENAME) to 
-		# self.password_file_string
-		self.password_file_string = self.subprocess_run_wrapper(process_args=extract_args, process_name='Extraction')
-		# If it is empty, then self.PASSWORD_FILENAME did not exist or was empty.
-		if not self.password_file_string:
-			logger.warning(
-				'{} was empty or missing from {}.'.format(self.PASSWORD_FILENAME, self.config_dict['archive_name']))
+	def archive_backend(self):
+		"""Return the archive_backend setting (a key of self.ARCHIVE_BACKENDS), replacing it with the default if it is
+		not valid."""
+		if self.config_dict['archive_backend'] not in self.ARCHIVE_BACKENDS:
+			logger.warning('{} is not a valid archive backend - default (7z) will be used. Please change or remove the '
+				'value in {}.'.format(self.config_dict['archive_backend'], self.CONFIG_FILE_NAME))
+			self.config_dict['archive_backend'] = '7z'
+		return self.config_dict['archive_backend']
 
-	def subprocess_run_wrapper(self, process_args, process_input=None, process_name=''):
-		"""Run a process described by process_args. Use process_input, if provided, capture any output and return 
-		to caller. If there are errors or the process timesout (self.TIMEOUT), exit this program.
+	def vault_settings(self):
+		"""Return the keyword arguments of Vault given by the settings."""
+		return dict(self.archive_timeouts, archive_backend=self.archive_backend(), path_7z=self.path_7z,
+			journal_max_size=int(self.config_dict['journal_max_size']),
+			lock_timeout=float(self.config_dict['lock_timeout']),
+			name_cache_dir=self.runtime_directory() if self.config_dict['name_cache'] else None, progress=self.progress)
 
-		For subprocess usage, see the official python docs and my subprocess_test.py testing script.
+	def read_archive_timeouts(self):
+		"""Return the timeout and throughput keyword arguments of Vault given by the 7z_timeout setting: with auto, a
+		ThroughputStats kept in the cache directory, so that timeouts follow the size of the archive, and otherwise the
+		fixed number of seconds given (0 for no timeout)."""
+		setting = str(self.config_dict['7z_timeout']).strip()
+		if setting != 'auto':
+			try:
+				return {'timeout': max(float(setting), 0) or None, 'throughput': None}
+			except ValueError:
+				logger.warning('{} is not a valid 7z_timeout - default (auto) will be used. Please change or remove '
+					'the value in {}.'.format(setting, self.CONFIG_FILE_NAME))
+		path_throughput = os.path.join(self.cache_directory(), self.THROUGHPUT_FILENAME)
+		return {'timeout': self.TIMEOUT, 'throughput': ThroughputStats(path_throughput)}
+
+	@staticmethod
+	def cache_directory():
+		"""Return the directory for data worth keeping between sessions, but not precious ($XDG_CACHE_HOME/pwmgr, or
+		~/.cache/pwmgr). It is only created when something is written to it."""
+		return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+			'pwmgr')
+
+	def make_vault(self, path_archive):
+		"""Return a Vault for the 7z archive or native vault at path_archive. Exit if it cannot be read."""
+		try:
+			return Vault(path_archive, **self.vault_settings())
+		except (OSError, PwmgrError) as err:
+			self.exit_on_error(err)
+
+	def open_vault(self):
+		"""Open self.vault with self.archive_pword (see Vault.open), exiting if this fails."""
+		try:
+			self.vault.open(self.archive_pword)
+		except PwmgrError as err:
+			self.exit_on_error(err)
+
+	@classmethod
+	def exit_on_error(cls, err):
+		"""Notify the user of err (an ArchiveError, VaultError or OSError) and exit, with status
+		EXIT_INCORRECT_PASSWORD if err is an IncorrectPasswordError."""
+		logger.error('{} Exiting.'.format(err))
+		sys.exit(cls.EXIT_INCORRECT_PASSWORD if isinstance(err, IncorrectPasswordError) else 1)
+
+	def first_match_only(self):
+		"""Return True if the only thing requested is the first password for self.options['application_name']."""
+		return bool(self.options['application_name'] and not self.vault.native_vault and not self.options['all']
+			and not self.config_dict['retrieve_all']
+			and not any([self.options['search'], self.options['fuzzy'], self.options['update'],
+				self.options['update-batch'], self.options['get'] is not None]))
+
+	def extract_first_match(self):
+		"""Read the archive only until the first password for self.options['application_name'] is found (see
+		Vault.peek). If it is found, store it in self.all_passes_retrieved and return True. Otherwise self.vault is
+		left open with everything read (so it may be used as usual, e.g. to list all applications) and return False.
 		"""
 		try:
-			# Run a command described by process_args and capture both stdout and stderr (not captured by default).
-			# universal_newlines=True -> stdout and stderr will be text rather than bytes (this uses the io.TextIOWrapper 
-			# default encoding). .run waits for the process to finish. timeout=self.TIMEOUT kills the process after 
-			# self.TIMEOUT seconds and raises subprocess.TimeoutExpired.
-			process = subprocess.run(process_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-				universal_newlines=True, timeout=self.TIMEOUT, input=process_input)
-			# .run returns a subprocess.completed process object (see python docs on subprocess)
-			logger.debug('{} process with arguments '.format(process_name) + '[' + ', '.join(process_args) + ']'
-			+ ' completed with return code {}.'.format(process.returncode))
-			# 7z will give error if password is incorrect.
-			if process.stderr != '':
-				print(process.stderr)
-				sys.exit(1)
-			return process.stdout
-		except subprocess.TimeoutExpired:
-			# Process was killed due to timeout expiring. Notify user and print any error.
-			error_message = '{} process failed to complete after {} seconds.'.format(self.process_name, self.TIMEOUT)
-			if process.stderr:
-				error_message += ' There were the following errors: {}'.format(process.stderr)
-			error_message += 'Exiting.'
-			logger.error(error_message)
-			sys.exit(1)
+			pword = self.vault.peek(self.archive_pword, self.options['application_name'])
+		except PwmgrError as err:
+			self.exit_on_error(err)
+		if pword is None:
+			return False
+		self.all_passes_retrieved = [pword]
+		return True
 
 	def set_user_regex_pattern(self):
 		"""Compile a regular expression pattern using the parameter passed to the command line following the -s
@@ -435,126 +4331,200 @@ class PassManager:
 			logger.error("{} is not a valid regular expression ({}). Exciting.".format(err.pattern, err.msg))
 			sys.exit(1)
 
-	def parse_password_file_string(self):
-		"""Parse self.password_file_string, identifying application names and passwords in this string. In addition:
+	def set_result_limit(self):
+		"""Set self.result_limit, the maximum number of search results shown (None for all), from the limit option."""
+		self.result_limit = None
+		if self.options['limit'] is None:
+			return
+		try:
+			self.result_limit = int(self.options['limit'])
+		except ValueError:
+			pass
+		if not self.result_limit or self.result_limit < 1:
+			logger.error('The limit option must be followed by a positive whole number. Exiting.')
+			sys.exit(1)
+
+	def usage_log(self):
+		"""Return the UsageLog of the usage_file setting, or None if it is not set."""
+		if not self.config_dict['usage_file']:
+			return None
+		return UsageLog(os.path.join(self.path_pvault_dir, os.path.expanduser(self.config_dict['usage_file'])))
+
+	def record_usage(self, name):
+		"""Record a retrieval of a password for the application name in the usage_file, if it is set."""
+		usage_log = self.usage_log()
+		if usage_log:
+			with profiler.phase('usage'):
+				usage_log.record(name)
+
+	def fuzzy_usage(self):
+		"""Return the function giving the usage score of a name to rank fuzzy search results with, or None."""
+		usage_log = self.usage_log()
+		return usage_log.score if usage_log else None
+
+	def read_vault(self):
+		"""Look up and search the application names and passwords in the open self.vault according to the user's
+		options, then make any updates requested:
 
-		if self.options['application_name'], store any passwords for self.options['application_name'] found in
-		self.password_file_string in self.all_passes_retrieved. 
+		if self.options['application_name'], store any passwords for self.options['application_name'] in
+		self.all_passes_retrieved.
+
+		if self.options['get'], store any passwords for each of the names in self.options['get'] in
+		self.batch_results.
 
 		if self.options['search'], store any matches for the regular expression pattern self.user_regex_pattern in
 		self.search_results
 
-		if self.options['update'], look for the appropriate line to which to insert a new password for the 
-		application self.options['update']. When found, insert into a copy of self.password_file_string,
-		and update the archive using this modified string via a call to self.update.
+		if self.options['fuzzy'], store the application names resembling it, best first, in self.fuzzy_results.
+
+		if self.options['update'] or self.options['update-batch'], store the new passwords and commit them to the
+		archive (see self.update_entry and self.update_batch_entries).
+		"""
+		# Names of all applications (lower case).
+		self.all_applications = self.vault.names()
+		# Retrieval mode functionality (a single dictionary lookup, case-insensitive).
+		if self.options['application_name']:
+			self.all_passes_retrieved = self.vault.get_all(self.options['application_name'])
+		# Batch retrieval functionality (a single dictionary lookup for each requested name).
+		for name in self.batch_results:
+			self.batch_results[name] = self.vault.get_all(name)
+		# Search mode functionality. Each (lower case) name is examined once, however many entries it has.
+		if self.user_regex_pattern:
+			self.search_results = self.vault.search(self.user_regex_pattern)
+			logger.debug("{} matches for {} found.".format(len(self.search_results), self.user_regex_pattern))
+		# Fuzzy search functionality. Only names sharing a trigram with the query are compared with it.
+		if self.options['fuzzy']:
+			self.fuzzy_results = self.vault.fuzzy_search(self.options['fuzzy'], self.result_limit, self.fuzzy_usage())
+		# Update mode functionality.
+		if self.options['update']:
+			self.update_entry()
+		if self.options['update-batch']:
+			self.update_batch_entries()
+
+	def update_entry(self):
+		"""Obtain a new password for the application self.options['update'] from the user, store it in the archive
+		and notify the user.
 
-		See the usage message for the application_name pword syntax (i.e. format of selfPASSWORD_FILENAME).
+		Called by self.read_vault once the archive has been read.
 		"""
+		# Obtain new password from get_new_pword (which is also used to get archive pword)
+		# self.options['update'] is used in the password prompt and the user may use the pword generator tool.
+		new_pword = self.get_new_pword(self.options['update'], offer_to_generate_password=True)
+		try:
+			self.vault.upsert(self.options['update'], new_pword)
+		except ValueError as err:
+			logger.error('{} No passwords were updated.'.format(err))
+			sys.exit(1)
+		# Update the archive and notify user.
+		self.commit_vault()
+		self.present_update(self.options['update'], new_pword)
+
+	def read_update_batch(self):
+		"""Read the file given by self.options['update-batch'] ('-' for stdin) into self.batch_new_pwords, a dictionary
+		mapping application names to their new passwords.
 
-		# Copy self.password_file_string and split this copy into a list of lines (i.e. split on '\n').
-		# if self.options['update'], this list will be modified and used to update self.path_archive.
-		# Slice is essential to perform a shallow copy (alternatively use .copy()), while keepends=True retains
-		# any newline characters, so as to preserve any (arbitrary) formatting the user may have in the password file.
-		self.lines_to_write = self.password_file_string[:].splitlines(keepends=True)
-		# We only want to update the archive with a new password once, so keep track if it has been.
-		# May be more appropriate to name this 'lines_to_write_modified' or similar.
-		self.archive_updated = False
-		# Strip leading/trailing whitespace characters from each line.
-		stripped_lines = [line.strip() for line in self.password_file_string.splitlines(keepends=False)]
-		# Iterate through stripped_lines, examining each line with non-whitespace characters
-		for index, line in enumerate(stripped_lines):			
-			line_num = index + 1  # Current line number is index plus 1
-			# Ignore lines containing whitespace only (which are empty after .strip())
-			# Note: Could alternatively have used stripped_lines = list(filter(None,stripped_lines)) 
-			# (see https://stackoverflow.com/questions/3845423/remove-empty-strings-from-a-list-of-strings)
-			if not line:
-				# logger.debug('Line {} is blank.'.format(line_num))
+		Each line of the file has the format of the password file: application_name password. A line containing only
+		an application name requests a generated password. If a name appears more than once, its last line is used.
+		Blank lines are ignored. The whole batch is rejected if any line is invalid, so nothing is written.
+		"""
+		try:
+			if self.options['update-batch'] == '-':
+				lines = sys.stdin.read().splitlines()
+			else:
+				with open(self.options['update-batch'], 'r') as batch_file:
+					lines = batch_file.read().splitlines()
+		except (OSError, UnicodeDecodeError) as err:
+			logger.error('Could not read {} ({}). No passwords were updated.'.format(self.options['update-batch'], err))
+			sys.exit(1)
+		self.batch_new_pwords = {}
+		# Names of the applications for which a password was generated.
+		self.batch_generated = set()
+		# Names as they appear in self.batch_new_pwords, keyed by lower case name (names are case insensitive).
+		names = {}
+		for index, line in enumerate(lines):
+			fields = line.split(sep=None, maxsplit=1)
+			if not fields:
 				continue
-			try:				
-				# Split line on 1st whitespace for maximum of 2 strings. Note sep=None treats runs of consecutive 
-				# whitespace are regarded as a single separator (assume pword does not begin with spaces).
-				application_name, pword = line.split(sep=None, maxsplit=1) 
-				# Update application set (use lowercase to avoid repeats with different case)
-				self.all_applications.add(application_name.lower())
-				# Strip trailing whitespace (inc. '\n') from pword - assumes that pword does not end with spaces,
-				# spaces within pword allowed (due to sep=None in .split, we know there is no leading whitespace).
-				pword = pword.strip()
-				# If ValueError on unpack (fewer than 2 elements after .split()), the formatting of .txt is incorrect
-			except ValueError as err:
-				rel_path = os.path.relpath(os.path.join(self.config_dict['archive_name'], os.path.basename(file_to_search)))
-				logger.warning('Formatting error in {}, line {}.'.format(rel_path, line_num))
-				# Continue work with rest of file (the formatting of other lines may be fine
-				continue 
-			# Retrieval mode functionality
-			if self.options['application_name']:				
-				# See if application_name matches self.options['application_name']. Compare after .lower() to make
-				# search case-insensitive. Could use re.fullmatch here.
-				if application_name.lower() == self.options['application_name']:
-					# Match found so append password to password list (now non-empty)
-					self.all_passes_retrieved.append(pword)
-					logger.debug('Password {} found for application {}.'.format(pword, application_name))
-			# Search mode functionality
-			if self.user_regex_pattern:
-				# If match for self.user_regex_pattern found, add this application (lower case) to set self.search_results
-				if re.search(self.user_regex_pattern, application_name.lower()):
-					self.search_results.add(application_name.lower())
-					logger.debug("Match for {} found in '{}'".format(self.user_regex_pattern, application_name.lower()))
-			
-			# Update mode functionality. 
-			if self.options['update'] and not self.archive_updated:
-				self.update_if_appropiate(index, application_name)
-
-	def update_if_appropiate(self, index, application_name):
-		"""Checks the alphabetical relation of self.options['update'] to application_name and inserts 
-		an entry with self.options['update'] and a new password obtained from the user, if appropriate.
-		
-		If self.options['update'] should occur BEFORE application_name in an alphabetically ordered list,
-		the new entry added one line above the entry for application name.
-		If self.options['update'] matches application_name, the new entry replaces the old entry.
-		In addition, if the final line has been reached, just append the new entry.
-
-		N.B. It is essential that the archive is updated only once because a) Once we find the first application_name
-		the new entry should appear before, the below if will be true for all application_names thereafter and b)
-		once self.lines_to_write is modified, its indexing no longer matches that of stripped_lines in 
-		self.parse_password_file_string().
+			if fields[0].lower() in names:
+				previous_name = names[fields[0].lower()]
+				del self.batch_new_pwords[previous_name]
+				self.batch_generated.discard(previous_name)
+			names[fields[0].lower()] = fields[0]
+			if len(fields) == 1:
+				self.batch_new_pwords[fields[0]] = self.generate_new_pword(fields[0])
+				self.batch_generated.add(fields[0])
+				continue
+			new_pword = fields[1].strip()
+			if not all(char in string.printable for char in new_pword):
+				logger.error('Password on line {} of {} contains non-printable characters. No passwords were updated.'
+					.format(index + 1, self.options['update-batch']))
+				sys.exit(1)
+			self.batch_new_pwords[fields[0]] = new_pword
+		if not self.batch_new_pwords:
+			logger.error('No entries found in {}. Exiting.'.format(self.options['update-batch']))
+			sys.exit(1)
+
+	def update_batch_entries(self):
+		"""Store all entries read by self.read_update_batch and update the archive once.
+
+		The archive is written by a single call to self.commit_vault, so either every entry in the batch is stored or
+		(if the update fails) none are.
 		"""
-		if application_name.lower() >= self.options['update'].lower() or index == len(self.lines_to_write) - 1:
-			# Obtain new password from get_new_pword (which is also used to get archive pword)
-			# self.options['update'] is used in the password prompt and the user may use the pword generator tool.
-			new_pword = self.get_new_pword(self.options['update'], offer_to_generate_password=True)
-			# Displayed to user to notify of success
-			str_to_print = 'Password successfully added to archive'
-			# Print and/or copy pword to X selection if appropriate.
-			if self.config_dict['always_print'] and self.config_dict['copy_to_selection']:
-				self.xclip_copy_to_selection(new_pword)
-				str_to_print += '.\nYour new password for {} is:\n{}{}{}\nThis has been copied to {}.'.format(
-					self.options['update'], self.hidden_print_colour, new_pword, self.RESET_ANSI, self.config_dict['selection'])
-			elif self.config_dict['always_print']:
-				str_to_print += '.\nYour new password for {} is:\n{}'.format(self.options['update'], new_pword)
-			elif self.config_dict['copy_to_selection']:
-				self.xclip_copy_to_selection(new_pword)
-				str_to_print += ' (copied to {}).'.format(self.config_dict['selection'])
-			# New entry to replace current application_name password (space delimited)
-			new_entry = self.options['update'] + ' ' + new_pword + '\n'
-			logger.debug('New entry to be added to {}: {}'.format(self.config_dict['archive_name'], new_entry.strip()))
-			if application_name.lower() == self.options['update'].lower():
-				self.lines_to_write[index] = new_entry
-				logger.debug('Entry for {} overwritten with {} (line {}).'.format(application_name, new_entry[:-1], index + 1))
-			elif application_name.lower() > self.options['update'].lower():
-				self.lines_to_write.insert(index, new_entry)
+		try:
+			actions = self.vault.upsert_many(self.batch_new_pwords)
+		except ValueError as err:
+			logger.error('{} No passwords were updated.'.format(err))
+			sys.exit(1)
+		self.commit_vault()
+		self.present_batch_update(actions)
+
+	def present_batch_update(self, actions):
+		"""Print one line of JSON (or a record, see RecordWriter) per updated application giving the action taken
+		('added' or 'replaced'). Generated passwords are included, as this is the only way the user can learn them.
+		In the nul format, the name and generated password (an empty string if none) of each application are written.
+		"""
+		for name in sorted(actions, key=str.lower):
+			record = {'name': name, 'action': actions[name], 'generated': name in self.batch_generated}
+			if name in self.batch_generated:
+				record['password'] = self.batch_new_pwords[name]
+			if self.record_writer:
+				self.record_writer.write(record, [name, record.get('password', '')])
 			else:
-				self.lines_to_write.append(new_entry)
-			# Update the archive and notify user.
-			self.update()
-			print(str_to_print)
-			# Set flag to ensure this function is never run again (see self.parse_password_file_string()).
-			self.archive_updated = True
+				print(json.dumps(record))
+
+	def present_update(self, name, new_pword):
+		"""Notify the user that the password for the application name has been set to new_pword (see
+		self.present_new_pword) or, with the format option, write a record holding it (the nul format just the
+		password)."""
+		if self.record_writer:
+			self.record_writer.write({'name': name, 'password': new_pword}, [new_pword])
+		else:
+			print(self.present_new_pword(name, new_pword))
+
+	def present_new_pword(self, name, new_pword, str_to_print='Password successfully added to archive'):
+		"""Print and/or copy new_pword, the new password for the application name, to the X selection according to
+		the always_print and copy_to_selection settings. Return a message to notify the user of the update, which
+		begins with str_to_print."""
+		# Print and/or copy pword to X selection if appropriate (if copying fails, it is printed instead).
+		copy = self.config_dict['copy_to_selection']
+		copied = copy and self.copy_to_selection(new_pword)
+		if self.config_dict['always_print'] and copied:
+			str_to_print += '.\nYour new password for {} is:\n{}{}{}\nThis has been copied to {}.'.format(
+				name, self.hidden_print_colour, new_pword, self.RESET_ANSI, self.config_dict['selection'])
+		elif self.config_dict['always_print'] or copy and not copied:
+			str_to_print += '.\nYour new password for {} is:\n{}'.format(name, new_pword)
+		elif copied:
+			str_to_print += ' (copied to {}).'.format(self.config_dict['selection'])
+		else:
+			str_to_print += '.'
+		return str_to_print
 
 	def get_new_pword(self, name, offer_to_generate_password=False):
-		"""Get new password from user for application self.to_update. Called by self.update_if_appropiate.
+		"""Get new password from user for application self.to_update. Called by self.update_entry.
 
 		Validation: Password must contain printable characters only and cannot begin or end with a space. 
-		If self.config_dict['check_new_password'] is True, the user must enter the password twice.
+		If self.config_dict['check_new_password'] is True, the user must enter the password twice. A password read
+		from --password-fd (see self.read_password) is read once, and the run ends if it is invalid.
 		"""
 		prompt_string = 'New password for {} '.format(name)
 		if offer_to_generate_password:
@@ -563,9 +4533,17 @@ class PassManager:
 			prompt_string += '(q to quit): '
 		new_pword = ''
 		while True:
-			user_response = getpass.getpass(prompt=prompt_string)
+			with profiler.phase('getpass'):
+				# Without input, a password is generated if that is offered (as if the user entered nothing).
+				user_response = self.read_password(prompt_string, default='' if offer_to_generate_password else None)
 			if offer_to_generate_password and not user_response:
-				return self.generate_new_pword()
+				return self.generate_new_pword(name)
+			if self.password_file:
+				problem = self.new_pword_problem(user_response) if user_response else 'Password cannot be empty.'
+				if problem:
+					logger.error('{} Exiting.'.format(problem))
+					sys.exit(1)
+				return user_response
 			# Otherwise return prompt string to 'non-offer' mode and set offer_to_generate_password False so 
 			# the user cannot accidentally generate a password on the next iteration with an empty input.
 			offer_to_generate_password = False
@@ -574,15 +4552,9 @@ class PassManager:
 			user_response_stripped = user_response.strip()
 			if user_response_stripped == 'q':
 				sys.exit(0)
-			# Check user input contains valid (printable) characters only (uses printable defined in the string module).
-			if not all(char in string.printable for char in user_response_stripped):
-				logger.debug('Password found to contain non-printable characters.')
-				print('Password cannot contain non-printable characters.')
-				continue
-			# Don't allow user to enter password starting or ending with white-space
-			if user_response != user_response_stripped:
-				logger.debug('Leading or trailing spaces were stripped from user_input.')
-				print('Password cannot begin or end with a space.')
+			problem = self.new_pword_problem(user_response)
+			if problem:
+				print(problem)
 				continue
 			# User must enter the same password twice. This check is skipped when new_pword == '' (first iteration).
 			if new_pword and self.config_dict['check_new_password'] and new_pword != user_response_stripped:
@@ -599,74 +4571,107 @@ class PassManager:
 					logger.warning('Password found to contain one or more spaces (permitted).')
 				return new_pword
 
-	def generate_new_pword(self):
-		"""Generate a password containing at least one uppercase character, lowercase character and digit. The length
-		of the password is determined by self.config_dict['generated_password_length'], which must be between 
+	@staticmethod
+	def new_pword_problem(new_pword):
+		"""Return a message saying why new_pword may not be used as a password, or None if it may."""
+		# Check user input contains valid (printable) characters only (uses printable defined in the string module).
+		if not all(char in string.printable for char in new_pword):
+			logger.debug('Password found to contain non-printable characters.')
+			return 'Password cannot contain non-printable characters.'
+		# Don't allow user to enter password starting or ending with white-space
+		if new_pword != new_pword.strip():
+			logger.debug('Leading or trailing spaces were stripped from user_input.')
+			return 'Password cannot begin or end with a space.'
+		return None
+
+	def generate_new_pword(self, name=None):
+		"""Generate a password for the application name following its password policy (see self.password_policy). By
+		default, this has at least one uppercase character, one lowercase character and three digits, and its length
+		is determined by self.config_dict['generated_password_length'], which must be between
 		self.MIN_GENERATED_PWORD_LENGTH and self.MAX_GENERATED_PWORD_LENGTH."""
-		character_pool = string.ascii_letters + string.digits
-		password_length = int(self.config_dict['generated_password_length'])
-		# character_pool = string.ascii_letters + string.digits + string.ascii_lowercase # Skew slightly with lowercase (more readable).
+		generator = self.password_generator(name)
+		logger.debug('Generating a password with {:.0f} bits of entropy.'.format(generator.entropy()))
+		return generator.generate()
+
+	def password_generator(self, name=None):
+		"""Return the PasswordGenerator for the password policy of the application name (see self.password_policy).
+		Each is only made once, as making it counts the passwords the policy allows."""
+		policy = self.password_policy(name)
+		if policy.spec() not in self.password_generators:
+			try:
+				self.password_generators[policy.spec()] = PasswordGenerator(policy)
+			except ValueError as err:
+				logger.error('{} Exiting.'.format(err))
+				sys.exit(1)
+		return self.password_generators[policy.spec()]
+
+	def password_policy(self, name=None):
+		"""Return the PasswordPolicy for the passwords generated for the application name: generated_password_length
+		characters, changed by the password_policy setting, then the policy option and then, if name is given, the
+		first rule in the password_rules file which matches it. Exit if any of these is invalid."""
+		try:
+			password_length = int(self.config_dict['generated_password_length'])
+		except ValueError:
+			password_length = 0
 		if not self.MIN_GENERATED_PWORD_LENGTH <= password_length <= self.MAX_GENERATED_PWORD_LENGTH:
-			logger.warning('Value for \'generated_password_length\' is not permitted. ' 
+			logger.warning('Value for \'generated_password_length\' is not permitted. '
 				+ 'Using the default password length (15).')
 			password_length = 15
-		while True:
-			# Taken from recipes on the page for the secrets module on the official docs
-			# secrets is preferrable to using random (note: /dev/urandom is used as a seed).
-		    password = ''.join(secrets.choice(character_pool) for i in range(password_length))
-		    if (any(c.islower() for c in password)
-		            and any(c.isupper() for c in password)
-		            and sum(c.isdigit() for c in password) >= 3):
-		        return password
-
-	def update(self):
-		"""Update password text file in user's archive with new password.
-
-		Called by self.update_if_appropiate upon insert a new entry (application name + password) into
-		self.lines_to_write (which was a copy of the content's of self.PASSWORD_FILENAME).
-		The self.PASSWORD_FILENAME file is updated (or created) in the archive self.archive using the 7-zip program.
-
-		This function should only be called once per running of this script (see N.B. in self.update_if_appropiate -
-		the flag self.archive_updated is set to True here to enforce this).
-
-		Before updating self.PASSWORD_FILENAME, a backup password file, self.PASSWORD_FILENAME + '.bak', is created
-		using self.password_file_string. This is deleted if the update occurs successfully. Note that the 7z -u 
-		switch does not appear to accommodate stdin (this can be used to update a file in the archive if it is 
-		found to be older than file to be added, for example) (note the -ao overwrite switch applies during extraction
-		[to file] only).
-		"""
-		# Quirk of 7z - if the file ending is not .7z or ., the .7z extension will be appended when updating.
-		# (See note in self.make_new_archive()).
-		if not self.path_archive.endswith('.7z'):
-			# Do this AFTER extracting from the archive!
-			self.path_archive += '.'
-		# Create list of arguments to be used to call 7z from CL. Note -mhe encrypts file headers (i.e. name of files).
-		stdin_arg = '-si' + self.PASSWORD_FILENAME
-		update_args = [self.config_dict['7z_application'], 'u', self.path_archive, stdin_arg, '-mhe', '-p' + self.archive_pword]
-		# String written to self.PASSWORD_FILENAME (self.lines_to_write is a list of strings)
-		str_to_write = ''.join(self.lines_to_write)
-		# Backup the password file.
-		self.backup_password_file()
-		# Process to update the archive (we don't need the output - there shouldn't be any).
-		self.subprocess_run_wrapper(process_args=update_args, process_input=str_to_write, process_name='Update')
-		# Update was successful (subprocess_run_wrapper sys.exit(1) otherwise), so remove the backup.
-		self.remove_backup_password_file()
-
-	def backup_password_file(self):
-		"""Create a backup password file, self.PASSWORD_FILENAME + '.bak', using the original contents of 
-		self.PASSWORD_FILENAME,	self.password_file_string. Note: Don't simply make a copy of the archive, in case
-		it is very large."""
-		stdin_arg = '-si' + self.PASSWORD_FILENAME + '.bak'
-		backup_args = [self.config_dict['7z_application'], 'u', self.path_archive, stdin_arg, '-mhe', '-p' + self.archive_pword]
-		self.subprocess_run_wrapper(
-			process_args=backup_args, process_input=self.password_file_string, process_name='Backup')
-
-	def remove_backup_password_file(self):
-		"""Delete self.PASSWORD_FILENAME + '.bak' from the user's archive. Called if self.PASSWORD_FILENAME was
-		successfully updated."""
-		delete_args = [self.config_dict['7z_application'], 'd', self.path_archive, self.PASSWORD_FILENAME + '.bak', '-p' + self.archive_pword]
-		self.subprocess_run_wrapper(
-			process_args=delete_args, process_input=self.password_file_string, process_name='Removal of backup')
+		policy = PasswordPolicy(length=password_length)
+		specs = [('the password_policy setting', self.config_dict['password_policy'] or ''),
+			('the policy option', self.options['policy'] or '')]
+		if name and self.config_dict['password_rules']:
+			specs.append(self.password_rule(name))
+		for source, spec in specs:
+			try:
+				policy = policy.updated(spec)
+			except ValueError as err:
+				logger.error('Invalid password policy in {}: {} Exiting.'.format(source, err))
+				sys.exit(1)
+		return policy
+
+	def password_rule(self, name):
+		"""Return (description of its line, spec) of the first rule in the password_rules file whose pattern matches
+		the application name, or ('', '') if none does."""
+		import fnmatch
+		path_rules = os.path.join(self.path_pvault_dir, os.path.expanduser(self.config_dict['password_rules']))
+		try:
+			with open(path_rules) as rules_file:
+				lines = rules_file.read().splitlines()
+		except OSError as err:
+			logger.error('Could not read the password_rules file {} ({}). Exiting.'.format(path_rules, err))
+			sys.exit(1)
+		for line_number, line in enumerate(lines, 1):
+			fields = line.split(None, 1)
+			if fields and not fields[0].startswith('#') and fnmatch.fnmatchcase(name.lower(), fields[0].lower()):
+				logger.debug('Password rule on line {} of {} applies to {}.'.format(line_number, path_rules, name))
+				return 'line {} of {}'.format(line_number, path_rules), fields[1] if len(fields) > 1 else ''
+		return '', ''
+
+	def generate_passwords(self):
+		"""Print self.options['generate'] passwords generated following the password policy (for the application
+		self.options['application_name'], if given), one per line, after reporting their entropy on stderr."""
+		try:
+			number = int(self.options['generate'])
+		except ValueError:
+			number = 0
+		if number < 1:
+			logger.error('The generate option must be followed by a positive whole number. Exiting.')
+			sys.exit(1)
+		generator = self.password_generator(self.options['application_name'])
+		print('{} password{} ({}), each with {:.1f} bits of entropy:'.format(number, 's' if number > 1 else '',
+			generator.policy.spec(), generator.entropy()), file=sys.stderr)
+		for start in range(0, number, self.GENERATE_BATCH_SIZE):
+			sys.stdout.write('\n'.join(generator.generate_many(min(self.GENERATE_BATCH_SIZE, number - start))) + '\n')
+
+	def commit_vault(self):
+		"""Write the changes stored in self.vault to the archive (see Vault.commit). Exit if this fails, in which case
+		the archive is untouched."""
+		try:
+			self.vault.commit()
+		except PwmgrError as err:
+			logger.error('Update of {} failed ({}). Exiting.'.format(self.config_dict['archive_name'], err))
+			sys.exit(1)
 
 	def present_passwords(self):
 		"""Present result of password search in archive to user.
@@ -676,16 +4681,27 @@ class PassManager:
 		- If 1 password found and not self.config_dict['copy_to_selection'], the password is printed with a 
 		'hidden' colouring.
 		- If no passwords are found, the user is notified and asked if wants to view full list of applications.
+		- With the format option, a record of the passwords found is written instead (see RecordWriter).
 		"""
-		logger.debug('All passwords retrieved: {}.'.format(self.all_passes_retrieved))
+		# Never log the passwords themselves.
+		logger.debug('{} passwords retrieved.'.format(len(self.all_passes_retrieved)))
+		if not self.all_passes_retrieved:
+			self.exit_status = self.EXIT_NOT_FOUND
+		else:
+			self.record_usage(self.options['application_name'])
+		if self.record_writer:
+			self.record_writer.write({'name': self.options['application_name'], 'found': bool(self.all_passes_retrieved),
+				'passwords': self.all_passes_retrieved}, self.all_passes_retrieved)
+			return
 		# If no passwords were found (self.all_passes_retrieved empty) notify user and offer to print application set
 		if not self.all_passes_retrieved:
 			print('No passwords found for {}.'.format(self.options['application_name']))
 			self.print_all_applications()
 			return
 		if self.config_dict['copy_to_selection']:
-			# Run xclip to copy first password found to X selection self.config_dict['selection']
-			self.xclip_copy_to_selection(self.all_passes_retrieved[0])
+			# Copy the first password found to the selection. If this fails, copy_to_selection is turned off, so the
+			# password is printed below.
+			self.copy_to_selection(self.all_passes_retrieved[0])
 		# If >1 password found, prompt user if they want them listed.
 		if len(self.all_passes_retrieved) > 1:
 			# Additional comment added to string if copy_to_selection setting on
@@ -693,74 +4709,86 @@ class PassManager:
 				.format(self.config_dict['selection']) if self.config_dict['copy_to_selection'] else '')
 			print('{} passwords found for {}{}.'
 				.format(len(self.all_passes_retrieved), self.options['application_name'], string_extension))
-			# if always_print toggle is on, print all passwords without prompting user
-			if not self.config_dict['always_print']:				
-				print('Hit Enter to display all passwords or enter anything to quit.', end=' ')
-			# If user just hits Enter (i.e. Enters an empty string) then input() returns '' (falsy).
-			# Note: This conditional short-circuits if self.config_dict['always_print'] is True.
-			if self.config_dict['always_print'] or not input():
+			# If always_print toggle is on, print all passwords without prompting user. If user just hits Enter (i.e.
+			# Enters an empty string) then self.ask() returns '' (falsy).
+			if self.config_dict['always_print'] or not self.ask(
+					'Hit Enter to display all passwords or enter anything to quit. '):
 				print('Passwords found for {}:'.format(self.options['application_name']))
 				# Print all found pwords to console
 				for pword in self.all_passes_retrieved:
 					print(self.hidden_print_colour + pword + self.RESET_ANSI)
 		else:
 			string_extension = ' and copied to {}'.format(self.config_dict['selection']) if self.config_dict['copy_to_selection'] else ''
-			print('1 password found for {}{}.'.format(self.options['application_name'], string_extension))
+			if self.first_match_only():
+				print('Password found for {}{} (-a to retrieve all).'.format(
+					self.options['application_name'], string_extension))
+			else:
+				print('1 password found for {}{}.'.format(self.options['application_name'], string_extension))
 			# Note: If not copying to clipboard must now print pword otherwise user has no means of accessing it!
 			if self.config_dict['always_print'] or not self.config_dict['copy_to_selection']:
 				print(self.hidden_print_colour + self.all_passes_retrieved[0] + self.RESET_ANSI)
 
-	def xclip_copy_to_selection(self, string_to_copy):
-		"""Run an xclip process to send string_to_copy to the X selection given by self.conf_dict['selection']."""
+	def copy_to_selection(self, string_to_copy):
+		"""Copy string_to_copy to the selection given by self.config_dict['selection'] with the clipboard_backend
+		setting (see Clipboard), and have it cleared after selection_timeout seconds. Return True if it was copied. If
+		not, the copy_to_selection setting is turned off for the rest of the run (but not saved), so that passwords are
+		printed instead."""
 		# Verify self.config_dict['selection'] is a valid X selection & assign to 'primary' if it isn't.
-		if self.config_dict['selection'] not in ['primary', 'secondary', 'clipboard']:
+		if self.config_dict['selection'] not in Clipboard.SELECTIONS:
 			# self.config_dict['selection'] is changed below (but not saved), so this warning will only appear once
 			# per runtime
-			logger.warning('{} is not a valid xclip selection - default (primary) will be used).'.format(
+			logger.warning('{} is not a valid selection - default (primary) will be used).'.format(
 				self.config_dict['selection']) + ' Please change or remove the value in {}'.format(
 				self.CONFIG_FILE_NAME))
 			self.config_dict['selection'] = 'primary'
-		xclip_args = ['xclip', '-sel', self.config_dict['selection']]
-		# Have to use the Popen constructor directly (this is created by subprocess.run normally) as need to be
-		# able to write directly to stdin AND close it: The 'input' parameter or subporocess.run is equivalent
-		# to calling subprocess.Popen and then process.communicate(), which WAITs for the process to finish. 
-		# However, xclip will hang until EOF, so the stdin needs to be closed after sending the input! 
-		# Using .close() after .write seems the only and best way to do this, although the docs recommend using 
-		# communicate() where possible. Possibly should just use Popen in self.subprocess_run_wrapper().
-		# OR RENAME self.subprocess_run_wrapper to self.run_7z....
-		process = subprocess.Popen(xclip_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-		universal_newlines=True, stdin=subprocess.PIPE)
-		try:
-			# Write string_to_copy to stdin and then immediately close the stream (xclip waits for EOF).
-			process.stdin.write(string_to_copy)
-			process.stdin.close() # xclip now copies stdin to clipboard
-			# Wait for the process to terminate for up to self.TIMEOUT seconds. If it is still running after this,
-			# raise TimeoutExpired. Note: If the process terminates before then (xclip should take a fraction of
-			# a second), we do not have to wait for the timeout to finish!
-			process.wait(self.TIMEOUT)
-		except subprocess.TimeoutExpired:
-			error_message = '{} process failed to complete after {} seconds.'.format('xclip', self.TIMEOUT)
-			if process.stderr:
-				error_message += ' There were the following errors: {}'.format(process.stderr)
-			error_message += 'Exiting.'
-			logger.error(error_message)
+		try:
+			clipboard = Clipboard(self.config_dict['clipboard_backend'], self.config_dict['selection'],
+				self.runtime_directory())
+			clipboard.copy(string_to_copy)
+		except ClipboardError as err:
+			logger.error('{} Passwords will be printed instead.'.format(err))
+			self.config_dict['copy_to_selection'] = False
+			return False
+		selection_timeout = float(self.config_dict['selection_timeout'])
+		if selection_timeout > 0:
+			clipboard.clear_later(string_to_copy, selection_timeout)
+		return True
 
 	def print_all_applications(self):
 		"""Optionally print list of all applications found in self.PASSWORD_FILENAME of archive."""
 		# Prompt user only if always_print toggle is False
-		if not self.config_dict['always_print']:
-			print('Hit Enter to display all application names for which passwords were found or enter anything to '
-				'quit.', end=' ')
-		if self.config_dict['always_print'] or not input():
+		if self.config_dict['always_print'] or not self.ask('Hit Enter to display all application names for which '
+				'passwords were found or enter anything to quit. '):
 			print('Applications with passwords in {}:'.format(self.config_dict['archive_name']))
 			# sorted() returns an ordered list of the elements of an iterable (wish to print in alphabetical order)
 			sorted_applications = sorted(self.all_applications) 
 			for application_name in sorted_applications:
 				print(application_name)
 
+	def present_batch_results(self):
+		"""Print one line of JSON (or a record, see RecordWriter) for each name in self.options['get'] (in the order
+		requested) giving the passwords found for it in self.batch_results. Names without passwords are reported, and
+		only then make the exit status EXIT_NOT_FOUND. In the nul format, the first password of each name is written
+		(an empty string if there is none), so that the values written correspond to the names."""
+		for name in self.options['get']:
+			passwords = self.batch_results.get(name.lower(), [])
+			record = {'name': name, 'found': bool(passwords), 'passwords': passwords}
+			if not passwords:
+				self.exit_status = self.EXIT_NOT_FOUND
+			if self.record_writer:
+				self.record_writer.write(record, passwords[:1] or [''])
+			else:
+				print(json.dumps(record))
+
 	def present_search_results(self):
 		"""Present result of regular search of application names in archive. Passwords are not shown."""
 		logger.debug('Search result set: {}.'.format(self.search_results))
+		if not self.search_results:
+			self.exit_status = self.EXIT_NOT_FOUND
+		if self.record_writer:
+			for application_name in self.search_results[:self.result_limit]:
+				self.record_writer.write({'name': application_name}, [application_name])
+			return
 		if not self.search_results:
 			print("Case-insensitive search with regular expression '{}'' returned no matches in {}."
 				.format(self.options['search'], self.config_dict['archive_name']))
@@ -769,10 +4797,736 @@ class PassManager:
 			return
 		print('Applications in {} returning a match in a case-insensitive search with regular expression \'{}\':'
 			.format(self.config_dict['archive_name'], self.options['search']))
-		for application_name in self.search_results:
+		for application_name in self.search_results[:self.result_limit]:
 			print(application_name)
+		if self.result_limit and len(self.search_results) > self.result_limit:
+			print('... and {} more.'.format(len(self.search_results) - self.result_limit))
+
+	def present_fuzzy_results(self):
+		"""Print the application names in self.fuzzy_results, best first, one per line and nothing else, so that the
+		output may be piped (or as records, see RecordWriter). If there are none, say so on standard error."""
+		if not self.fuzzy_results:
+			self.exit_status = self.EXIT_NOT_FOUND
+			print('No application names in {} resemble \'{}\'.'.format(self.config_dict['archive_name'],
+				self.options['fuzzy']), file=sys.stderr)
+			return
+		for application_name in self.fuzzy_results:
+			if self.record_writer:
+				self.record_writer.write({'name': application_name}, [application_name])
+			else:
+				print(application_name)
+
+	def run_shell(self):
+		"""Unlock the archive once and run the commands of the interactive shell (see self.SHELL_HELP) until quit,
+		abort or the end of input. Updates and deletions are held in self.vault until the commit command or the end of
+		the session. On a terminal, the matches for the application name being typed are shown as it is typed (see
+		self.read_shell_line). Otherwise commands are read line by line, e.g. from a pipe."""
+		with profiler.phase('getpass'):
+			self.archive_pword = self.read_password('Enter password for {}: '.format(self.config_dict['archive_name']))
+		with profiler.phase('extract'):
+			self.open_vault()
+		search = IncrementalSearch(self.vault.names())
+		print('{} applications in {}. Type help for a list of commands.'.format(len(search.names),
+			self.config_dict['archive_name']))
+		interactive = sys.stdin.isatty() and sys.stdout.isatty()
+		while True:
+			prompt = 'pwmgr> '
+			if self.vault.staged_changes():
+				prompt = 'pwmgr ({} unsaved)> '.format(self.vault.staged_changes())
+			try:
+				line = self.read_shell_line(prompt, search) if interactive else input(prompt)
+			except EOFError:
+				print()
+				line = 'quit'
+			except KeyboardInterrupt:
+				print()
+				continue
+			try:
+				if not self.run_shell_command(line.split(), search):
+					break
+			except KeyboardInterrupt:
+				print()
+		self.vault.close()
+
+	def run_shell_command(self, words, search):
+		"""Run the shell command given by the list of words of a command line. Return False if the session should
+		end."""
+		if not words:
+			return True
+		command, arguments = words[0].lower(), words[1:]
+		if command in {'quit', 'exit'}:
+			if self.vault.staged_changes():
+				self.commit_vault()
+				print('Changes saved.')
+			return False
+		if command == 'abort':
+			if self.vault.staged_changes():
+				print('{} unsaved changes discarded.'.format(self.vault.staged_changes()))
+			return False
+		if command == 'help':
+			print(self.SHELL_HELP)
+		elif command == 'commit':
+			try:
+				self.vault.commit()
+				print('Changes saved.')
+			except PwmgrError as err:
+				print('Update of {} failed ({}). The changes are kept.'.format(self.config_dict['archive_name'], err))
+		elif command == 'rollback':
+			self.vault.rollback()
+			search.__init__(self.vault.names())
+			print('Unsaved changes discarded.')
+		elif command in self.SHELL_COMMANDS:
+			if len(arguments) != 1:
+				print('Usage: {} NAME'.format(command))
+			elif command == 'update':
+				self.shell_update(arguments[0], search)
+			else:
+				name = self.resolve_shell_name(arguments[0], search)
+				if name and command == 'get':
+					self.record_usage(name)
+					for pword in self.vault.get_all(name):
+						print(self.hidden_print_colour + pword + self.RESET_ANSI)
+				elif name and command == 'copy':
+					self.record_usage(name)
+					if self.copy_to_selection(self.vault.get(name)):
+						print('Password for {} copied to {}.'.format(name, self.config_dict['selection']))
+					else:
+						print(self.hidden_print_colour + self.vault.get(name) + self.RESET_ANSI)
+				elif name:
+					self.vault.delete(name)
+					search.remove(name.lower())
+					print('{} deleted (saved on commit or quit).'.format(name))
+		else:
+			# Anything else is a search.
+			matches = search.matches(' '.join(words))
+			for name in matches:
+				print(name)
+			print('{} matches.'.format(len(matches)))
+			if not matches:
+				# Perhaps it is misspelt.
+				suggestions = self.vault.fuzzy_search(' '.join(words), self.SHELL_MATCHES, self.fuzzy_usage())
+				if suggestions:
+					print('Did you mean: {}?'.format(', '.join(suggestions)))
+		return True
+
+	def resolve_shell_name(self, query, search):
+		"""Return the name of the application given by query in a shell command: query itself if it is the name of an
+		application, otherwise its only match. If there is no such application, notify the user and return None."""
+		if query.lower() in search:
+			return query.lower()
+		matches = search.matches(query)
+		if len(matches) == 1:
+			return matches[0]
+		if not matches:
+			print('No application matches {}.'.format(query))
+		else:
+			print('{} applications match {}: {}{}.'.format(len(matches), query, ', '.join(matches[:self.SHELL_MATCHES]),
+				', ...' if len(matches) > self.SHELL_MATCHES else ''))
+		return None
+
+	def shell_update(self, name, search):
+		"""Obtain a new password for the application name from the user and stage it in self.vault."""
+		try:
+			new_pword = self.get_new_pword(name, offer_to_generate_password=True)
+		except SystemExit:
+			# The user entered q.
+			print('Update of {} cancelled.'.format(name))
+			return
+		try:
+			self.vault.upsert(name, new_pword)
+		except ValueError as err:
+			print(err)
+			return
+		search.add(name.lower())
+		print(self.present_new_pword(name, new_pword, 'Password for {} set (saved on commit or quit)'.format(name)))
+
+	@classmethod
+	def shell_query(cls, line):
+		"""Return the word of the shell command line to search for as it is typed: the application name after a
+		command, or a first word which is not a command."""
+		words = line.split(' ')
+		if len(words) == 1:
+			return words[0]
+		if len(words) == 2 and words[0].lower() in cls.SHELL_COMMANDS:
+			return words[1]
+		return ''
+
+	def read_shell_line(self, prompt, search):
+		"""Read a command line from the terminal a keystroke at a time, showing below it up to self.SHELL_MATCHES names
+		matching the word being typed (see self.shell_query and IncrementalSearch) after every keystroke. Tab completes
+		the word to the first match and Ctrl-U clears the line. Raise EOFError on Ctrl-D at the start of a line and
+		KeyboardInterrupt on Ctrl-C."""
+		import termios, tty
+		fd = sys.stdin.fileno()
+		old_attributes = termios.tcgetattr(fd)
+		# No echo and no line buffering, but Ctrl-C still interrupts.
+		tty.setcbreak(fd)
+		line = ''
+		try:
+			while True:
+				query = self.shell_query(line)
+				matches = search.matches(query) if query else []
+				self.render_shell_line(prompt, line, matches)
+				chars = os.read(fd, 64).decode(errors='ignore')
+				if not chars or (chars == '\x04' and not line):
+					raise EOFError
+				# Escape sequences (e.g. arrow keys) are ignored.
+				if chars.startswith('\x1b'):
+					continue
+				for char in chars:
+					if char in '\r\n':
+						sys.stdout.write('\r\x1b[J' + prompt + line + '\n')
+						return line
+					if char in '\x7f\x08':
+						line = line[:-1]
+					elif char == '\x15':
+						line = ''
+					elif char == '\t':
+						if matches:
+							line = line[:len(line) - len(query)] + matches[0]
+					elif char.isprintable():
+						line += char
+		except (EOFError, KeyboardInterrupt):
+			# Remove the matches below the line.
+			sys.stdout.write('\r\x1b[J' + prompt + line)
+			raise
+		finally:
+			sys.stdout.flush()
+			termios.tcsetattr(fd, termios.TCSADRAIN, old_attributes)
+
+	def render_shell_line(self, prompt, line, matches):
+		"""Redraw the command line being edited, with matches (a list of names) on the lines below it."""
+		rows = ['  ' + name for name in matches[:self.SHELL_MATCHES]]
+		if len(matches) > self.SHELL_MATCHES:
+			rows.append('  ... {} more'.format(len(matches) - self.SHELL_MATCHES))
+		# Clear everything from the command line down, draw the matches and move back up to the end of the line.
+		output = '\r\x1b[J' + ''.join('\n' + row for row in rows)
+		if rows:
+			output += '\x1b[{}A'.format(len(rows))
+		sys.stdout.write(output + '\r' + prompt + line)
+		sys.stdout.flush()
+
+	def search_all_archives(self):
+		"""Search the application names in every archive in the pvault directory (see self.list_archives) with the
+		regular expression self.options['search'].
+
+		A single password is asked for and tried on every archive. The user is then prompted for the password of each
+		archive it did not open (enter nothing to skip that archive), and these archives are searched in turn.
+		"""
+		if not self.options['search']:
+			logger.error('The all-archives option may only be used with the search option. Exiting.')
+			sys.exit(1)
+		self.set_user_regex_pattern()
+		archive_names = self.list_archives()
+		if not archive_names:
+			logger.error('No archives found in {}. Exiting.'.format(self.path_pvault_dir))
+			sys.exit(1)
+		# Checks the archive_backend setting once, before any threads are started.
+		self.archive_backend()
+		with profiler.phase('getpass'):
+			shared_pword = self.read_password('Enter password for archives in {}: '.format(self.path_pvault_dir))
+		# (archive name, application name) of every match found.
+		self.search_results = set()
+		if not self.record_writer:
+			print('Applications returning a match in a case-insensitive search with regular expression \'{}\':'.format(
+				self.options['search']), flush=True)
+		archive_pwords = {archive_name: shared_pword for archive_name in archive_names}
+		failed_archives = self.search_archives(archive_pwords)
+		archive_pwords = {}
+		for archive_name in failed_archives:
+			archive_pword = self.read_password('Password not accepted by {}. Enter password for {} (enter nothing to '
+				'skip it): '.format(archive_name, archive_name), default='')
+			if archive_pword:
+				archive_pwords[archive_name] = archive_pword
+		for archive_name in self.search_archives(archive_pwords):
+			logger.error('Could not read {} (incorrect password?).'.format(archive_name))
+		if not self.search_results:
+			self.exit_status = self.EXIT_NOT_FOUND
+			if not self.record_writer:
+				print('No matches found in any archive.')
+
+	def search_archives(self, archive_pwords):
+		"""Search the archives in the pvault directory named by the keys of archive_pwords, opening each with its
+		value, in a pool of up to self.MAX_ARCHIVE_WORKERS threads (each 7z archive is read by 7z processes of its
+		own, see SevenZipBackend). As soon as an archive has been searched, the names of the applications in it which
+		match self.user_regex_pattern are printed (or written as records), tagged with the name of the archive. Return an
+		alphabetically ordered list of the names of the archives which could not be read.
+		"""
+		import concurrent.futures
+		failed_archives = []
+		if not archive_pwords:
+			return failed_archives
+		with concurrent.futures.ThreadPoolExecutor(
+				max_workers=min(len(archive_pwords), self.MAX_ARCHIVE_WORKERS)) as executor:
+			futures = {executor.submit(self.read_application_names, archive_name, archive_pword): archive_name
+				for archive_name, archive_pword in archive_pwords.items()}
+			for future in concurrent.futures.as_completed(futures):
+				archive_name = futures[future]
+				try:
+					application_names = future.result()
+				except (PwmgrError, OSError) as err:
+					logger.debug('Could not read {}: {}'.format(archive_name, err))
+					failed_archives.append(archive_name)
+					continue
+				for application_name in application_names:
+					if self.user_regex_pattern.search(application_name):
+						self.search_results.add((archive_name, application_name))
+						if self.record_writer:
+							self.record_writer.write({'archive': archive_name, 'name': application_name},
+								[archive_name, application_name])
+						else:
+							print('{}: {}'.format(archive_name, application_name), flush=True)
+		return sorted(failed_archives)
+
+	def rekey_archives(self, archive_names):
+		"""Change the password of each archive (or native vault) in the pvault directory named in archive_names (see
+		Vault.rekey), then print which archives succeeded and which failed. Exit with status 1 if any failed.
+
+		The current password is asked for once and tried on every archive, and the new password once for all of them.
+		The archives are re-encrypted at the same time (see self.rekey_pool), and each is replaced atomically once its
+		new copy has been checked. The user is then prompted for the current password of each archive which failed
+		(enter nothing to skip it), and these are tried again. A running agent serving one of the archives is locked.
+		"""
+		if not archive_names:
+			logger.error('No archives found in {}. Exiting.'.format(self.path_pvault_dir))
+			sys.exit(1)
+		# Checks the archive_backend setting once, before any threads are started.
+		self.archive_backend()
+		description = archive_names[0] if len(archive_names) == 1 else 'archives in {}'.format(self.path_pvault_dir)
+		with profiler.phase('getpass'):
+			current_pword = self.read_password('Enter current password for {}: '.format(description))
+		new_pword = self.get_new_pword(description)
+		errors = self.rekey_pool({archive_name: current_pword for archive_name in archive_names}, new_pword)
+		archive_pwords = {}
+		for archive_name in sorted(name for name, error in errors.items() if error):
+			archive_pword = self.read_password('Could not change the password of {} ({}). Enter its current '
+				'password to try again (enter nothing to skip it): '.format(archive_name, errors[archive_name]), default='')
+			if archive_pword:
+				archive_pwords[archive_name] = archive_pword
+		errors.update(self.rekey_pool(archive_pwords, new_pword))
+		# An agent serving one of the archives would go on using the old password.
+		status = self.agent_request({'op': 'status'})
+		if status and not status['locked'] and status['archive'] in {
+				os.path.abspath(os.path.join(self.path_pvault_dir, archive_name)) for archive_name in archive_names}:
+			self.agent_request({'op': 'lock'})
+			logger.info('Agent locked, as the password of the archive it serves has changed.')
+		for archive_name in sorted(errors):
+			print('{}: {}'.format(archive_name, 'failed ({})'.format(errors[archive_name]) if errors[archive_name]
+				else 'password changed'))
+		num_failed = sum(1 for error in errors.values() if error)
+		if len(archive_names) > 1:
+			print('Password changed for {} of {} archives.'.format(len(archive_names) - num_failed, len(archive_names)))
+		if num_failed:
+			sys.exit(1)
+
+	def rekey_pool(self, archive_pwords, new_pword):
+		"""Change the password of the archives in the pvault directory named by the keys of archive_pwords from their
+		values to new_pword, in a pool of up to self.MAX_ARCHIVE_WORKERS threads. Return a dictionary mapping each
+		archive name to None if it succeeded, or otherwise the error."""
+		import concurrent.futures
+		errors = {}
+		if not archive_pwords:
+			return errors
+		with concurrent.futures.ThreadPoolExecutor(
+				max_workers=min(len(archive_pwords), self.MAX_ARCHIVE_WORKERS)) as executor:
+			futures = {executor.submit(self.rekey_archive, archive_name, archive_pword, new_pword): archive_name
+				for archive_name, archive_pword in archive_pwords.items()}
+			for future in concurrent.futures.as_completed(futures):
+				archive_name = futures[future]
+				try:
+					future.result()
+					errors[archive_name] = None
+				except (PwmgrError, OSError) as err:
+					logger.debug('Could not change the password of {}: {}'.format(archive_name, err))
+					errors[archive_name] = str(err) or type(err).__name__
+		return errors
+
+	def rekey_archive(self, archive_name, archive_pword, new_pword):
+		"""Change the password of the archive (or native vault) archive_name in the pvault directory from
+		archive_pword to new_pword. No attributes of self are set, so this may be called from several threads at
+		once."""
+		path_archive = os.path.abspath(os.path.join(self.path_pvault_dir, archive_name))
+		Vault(path_archive, **self.vault_settings()).rekey(archive_pword, new_pword)
+
+	def read_application_names(self, archive_name, archive_pword):
+		"""Return an alphabetically ordered list of the names (lower case) of all applications in the archive (or
+		native vault) archive_name in the pvault directory, opened with archive_pword. Raise ArchiveError, VaultError
+		or OSError if it cannot be read. No attributes of self are set, so this may be called from several threads at
+		once."""
+		path_archive = os.path.abspath(os.path.join(self.path_pvault_dir, archive_name))
+		with Vault(path_archive, **self.vault_settings()) as vault:
+			vault.open(archive_pword)
+			return vault.names()
+
+	def agent_socket_path(self):
+		"""Return the path of the Unix socket used by the agent. In order of precedence, this is given by the
+		self.AGENT_SOCKET_ENV environment variable, the agent_socket setting or a default in the user's runtime
+		directory."""
+		if os.environ.get(self.AGENT_SOCKET_ENV):
+			return os.environ[self.AGENT_SOCKET_ENV]
+		if self.config_dict['agent_socket']:
+			return os.path.abspath(os.path.expanduser(self.config_dict['agent_socket']))
+		return os.path.join(self.runtime_directory(), self.AGENT_SOCKET_NAME)
+
+	@staticmethod
+	def runtime_directory():
+		"""Return the directory for files which should only last as long as the user's session: $XDG_RUNTIME_DIR, or
+		/tmp/pwmgr-uid if it is not set."""
+		return os.environ.get('XDG_RUNTIME_DIR') or os.path.join('/tmp', 'pwmgr-{}'.format(os.getuid()))
+
+	def agent_request(self, request):
+		"""Send request (a dictionary) to the agent listening on self.agent_socket_path() and return its response
+		(also a dictionary). Return None if no agent is listening. Exit if the agent sends no valid response.
+
+		Requests and responses are single lines of JSON. Every response has the key 'ok'; if this is False the
+		key 'error' describes what went wrong. Requests larger than self.AGENT_MAX_REQUEST_SIZE are refused.
+		"""
+		path_socket = self.agent_socket_path()
+		# Without a socket file there can be no agent, and the socket module need not be imported.
+		if not os.path.lexists(path_socket):
+			return None
+		# Never send a request (which may hold the archive password) to a socket another user could have created.
+		problem = self.agent_socket_problem(path_socket)
+		if problem:
+			logger.warning('Ignoring agent socket {}: {}.'.format(path_socket, problem))
+			return None
+		import socket
+		try:
+			with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+				client.connect(path_socket)
+				try:
+					client.sendall(json.dumps(request).encode() + b'\n')
+				except (BrokenPipeError, ConnectionResetError):
+					# The agent stopped reading (e.g. the request is too large), but may have sent a response.
+					pass
+				response = b''
+				while not response.endswith(b'\n'):
+					chunk = client.recv(65536)
+					if not chunk:
+						break
+					response += chunk
+		except (FileNotFoundError, ConnectionRefusedError):
+			return None
+		except OSError as err:
+			logger.error('Could not reach agent at {} ({}). Exiting.'.format(path_socket, err))
+			sys.exit(1)
+		try:
+			response = json.loads(response.decode())
+		except ValueError:
+			response = None
+		if not isinstance(response, dict) or 'ok' not in response:
+			logger.error('Agent at {} sent no valid response to {} request. Exiting.'.format(path_socket,
+				request.get('op')))
+			sys.exit(1)
+		return response
+
+	@staticmethod
+	def agent_socket_problem(path_socket):
+		"""Return a message saying why the agent socket path_socket may not be trusted, or None if it may. Its
+		directory must be a real directory owned by the user with mode 700, and the socket (if it exists) must be
+		owned by the user, so no other user can have put a fake agent in its place to collect archive passwords."""
+		import stat
+		path_dir = os.path.dirname(path_socket) or os.curdir
+		try:
+			dir_stat = os.lstat(path_dir)
+		except OSError as err:
+			return 'cannot inspect {}: {}'.format(path_dir, err.strerror)
+		if not stat.S_ISDIR(dir_stat.st_mode):
+			return '{} is not a directory'.format(path_dir)
+		if dir_stat.st_uid != os.getuid():
+			return '{} is owned by another user'.format(path_dir)
+		if stat.S_IMODE(dir_stat.st_mode) != 0o700:
+			return '{} has mode {:o} rather than 700'.format(path_dir, stat.S_IMODE(dir_stat.st_mode))
+		try:
+			socket_stat = os.lstat(path_socket)
+		except FileNotFoundError:
+			return None
+		except OSError as err:
+			return 'cannot inspect {}: {}'.format(path_socket, err.strerror)
+		if not stat.S_ISSOCK(socket_stat.st_mode):
+			return '{} is not a socket'.format(path_socket)
+		if socket_stat.st_uid != os.getuid():
+			return '{} is owned by another user'.format(path_socket)
+		return None
+
+	def use_agent(self):
+		"""If an agent is serving self.path_archive, use it to retrieve, search or update passwords according to the
+		user's options (unlocking it first if necessary) and return True. Otherwise (or if the batch of -ub is too
+		large to send to an agent) return False, in which case the archive must be extracted as usual."""
+		if self.options['update-batch']:
+			batch_request = {'op': 'update_many', 'passwords': self.batch_new_pwords}
+			if len(json.dumps(batch_request).encode()) >= self.AGENT_MAX_REQUEST_SIZE:
+				logger.info('Batch too large for an agent. Updating the archive directly.')
+				return False
+		status = self.agent_request({'op': 'status'})
+		if status is None:
+			return False
+		if status['archive'] != self.path_archive:
+			logger.info('Agent is serving {}, not {}. Ignoring agent.'.format(status['archive'], self.path_archive))
+			return False
+		if status['locked']:
+			self.unlock_agent()
+		if self.options['application_name']:
+			response = self.agent_request_or_exit({'op': 'get', 'name': self.options['application_name']})
+			self.all_passes_retrieved = response['passwords']
+			self.all_applications = set(response['applications'])
+			self.present_passwords()
+		if self.options['get']:
+			response = self.agent_request_or_exit({'op': 'get_many', 'names': self.options['get']})
+			self.batch_results = response['passwords']
+			self.present_batch_results()
+		if self.options['search']:
+			response = self.agent_request_or_exit({'op': 'search', 'pattern': self.options['search']})
+			self.search_results = response['results']
+			self.all_applications = set(response['applications'])
+			self.present_search_results()
+		if self.options['fuzzy']:
+			response = self.agent_request_or_exit({'op': 'fuzzy', 'query': self.options['fuzzy'],
+				'limit': self.result_limit})
+			self.fuzzy_results = response['results']
+			self.present_fuzzy_results()
+		if self.options['update']:
+			new_pword = self.get_new_pword(self.options['update'], offer_to_generate_password=True)
+			self.agent_request_or_exit({'op': 'update', 'name': self.options['update'], 'password': new_pword})
+			self.present_update(self.options['update'], new_pword)
+		if self.options['update-batch']:
+			response = self.agent_request_or_exit(batch_request)
+			self.present_batch_update(response['actions'])
+		return True
+
+	def agent_request_or_exit(self, request):
+		"""Send request to the agent and return the response. If the agent is not running or reports an error,
+		notify the user and exit (with status EXIT_INCORRECT_PASSWORD if the password given to unlock it was wrong)."""
+		response = self.agent_request(request)
+		if response is None:
+			logger.error('Agent at {} is not running. Exiting.'.format(self.agent_socket_path()))
+			sys.exit(1)
+		if not response['ok']:
+			logger.error('Agent could not complete {} request: {}. Exiting.'.format(request['op'], response['error']))
+			sys.exit(self.EXIT_INCORRECT_PASSWORD if response.get('incorrect_password') else 1)
+		return response
+
+	def unlock_agent(self):
+		"""Prompt the user for the archive password and send it to the agent so it may extract the archive again."""
+		archive_pword = self.read_password('Agent locked. Enter password for {}: '.format(
+			self.config_dict['archive_name']))
+		self.agent_request_or_exit({'op': 'unlock', 'password': archive_pword})
+
+	def control_agent(self):
+		"""Lock, unlock or stop the running agent according to the --lock, --unlock and --stop-agent options."""
+		status = self.agent_request({'op': 'status'})
+		if status is None:
+			print('No agent listening on {}.'.format(self.agent_socket_path()))
+			sys.exit(1)
+		if self.options['lock']:
+			self.agent_request_or_exit({'op': 'lock'})
+			print('Agent locked.')
+		if self.options['unlock']:
+			self.config_dict['archive_name'] = os.path.basename(status['archive'])
+			self.unlock_agent()
+			print('Agent unlocked.')
+		if self.options['stop-agent']:
+			self.agent_request_or_exit({'op': 'stop'})
+			print('Agent (pid {}) stopped.'.format(status['pid']))
+
+	def start_agent(self):
+		"""Extract and index the password file of self.path_archive, then start a background process which keeps it
+		in memory and answers requests from other invocations of this program over a Unix socket (see
+		self.serve_agent). Shell commands to export the socket path are printed (like ssh-agent).
+
+		The socket is created in a directory only accessible by the user (which is checked if it already exists) and
+		is itself only accessible by the user.
+		The agent additionally rejects connections from processes of other users (where the platform allows this to
+		be checked).
+		"""
+		path_socket = self.agent_socket_path()
+		if self.agent_request({'op': 'status'}) is not None:
+			logger.error('An agent is already listening on {}. Exiting.'.format(path_socket))
+			sys.exit(1)
+		self.archive_pword = self.read_password('Enter password for {}: '.format(self.config_dict['archive_name']))
+		# Exits if the password is incorrect, before anything is forked.
+		self.open_vault()
+		# The agent only keeps the vault open (see self.lock_archive).
+		self.archive_pword = None
+		os.makedirs(os.path.dirname(path_socket), mode=0o700, exist_ok=True)
+		# The directory may have existed already (e.g. created by another user in /tmp).
+		problem = self.agent_socket_problem(path_socket)
+		if problem:
+			logger.error('Cannot start agent on {}: {}. Exiting.'.format(path_socket, problem))
+			sys.exit(1)
+		# Remove any socket left behind by an agent which did not exit cleanly (nothing is listening on it).
+		if os.path.lexists(path_socket):
+			os.remove(path_socket)
+		import socket
+		server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		# Restrict permissions before the socket file is created by bind.
+		old_umask = os.umask(0o177)
+		try:
+			server.bind(path_socket)
+		finally:
+			os.umask(old_umask)
+		server.listen()
+		pid = os.fork()
+		if pid:
+			# Parent: notify the user and return (exit).
+			server.close()
+			print('{0}={1}; export {0};'.format(self.AGENT_SOCKET_ENV, path_socket))
+			print('echo Agent pid {};'.format(pid))
+			return
+		# Child: detach from the terminal and serve until stopped.
+		os.setsid()
+		with open(os.devnull, 'r+') as devnull:
+			for stream in (sys.stdin, sys.stdout, sys.stderr):
+				os.dup2(devnull.fileno(), stream.fileno())
+		self.vault.progress = None
+		try:
+			self.serve_agent(server)
+		finally:
+			server.close()
+			if os.path.exists(path_socket):
+				os.remove(path_socket)
+			os._exit(0)
+
+	def lock_archive(self):
+		"""Forget the archive password and everything decrypted from the archive."""
+		self.vault.close()
+
+	def serve_agent(self, server):
+		"""Accept connections on the listening socket server and answer one request per connection until a stop
+		request is received. The agent is locked after self.config_dict['agent_timeout'] seconds without requests."""
+		import socket
+		agent_timeout = float(self.config_dict['agent_timeout'])
+		self.agent_running = True
+		last_request_time = time.monotonic()
+		while self.agent_running:
+			# Only wait for the idle timeout while there is something to forget.
+			if agent_timeout > 0 and self.vault.is_open:
+				server.settimeout(max(0, last_request_time + agent_timeout - time.monotonic()))
+			else:
+				server.settimeout(None)
+			try:
+				connection, _ = server.accept()
+			except socket.timeout:
+				self.lock_archive()
+				continue
+			with connection:
+				if not self.agent_peer_allowed(connection):
+					continue
+				connection.settimeout(self.TIMEOUT)
+				try:
+					self.handle_agent_connection(connection)
+				except (OSError, ValueError):
+					# Broken connection or malformed request. Just drop it.
+					pass
+			# Updates leave compaction to here, once the client has its response.
+			if self.vault.is_open and self.vault.compaction_due():
+				try:
+					self.vault.compact()
+				except PwmgrError as err:
+					# The journal is kept (and compaction tried again after the next request).
+					logger.warning('Compaction failed: {}'.format(err))
+			last_request_time = time.monotonic()
+
+	def agent_peer_allowed(self, connection):
+		"""Return True if the process at the other end of connection belongs to the user running the agent."""
+		import socket, struct
+		if not hasattr(socket, 'SO_PEERCRED'):
+			# Rely on the permissions of the socket and its directory.
+			return True
+		credentials = connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+		_, uid, _ = struct.unpack('3i', credentials)
+		return uid == os.getuid()
+
+	def handle_agent_connection(self, connection):
+		"""Read a single request from connection and send the response."""
+		request = b''
+		while not request.endswith(b'\n'):
+			chunk = connection.recv(4096)
+			if not chunk:
+				return
+			request += chunk
+			if len(request) > self.AGENT_MAX_REQUEST_SIZE:
+				connection.sendall(json.dumps({'ok': False, 'error': 'request too large'}).encode() + b'\n')
+				return
+		response = self.handle_agent_request(json.loads(request.decode()))
+		connection.sendall(json.dumps(response).encode() + b'\n')
+
+	def handle_agent_request(self, request):
+		"""Perform the operation described by request (a dictionary with key 'op') and return the response."""
+		op = request.get('op')
+		if op == 'status':
+			return {'ok': True, 'archive': self.path_archive, 'locked': not self.vault.is_open, 'pid': os.getpid()}
+		if op == 'lock':
+			self.lock_archive()
+			return {'ok': True}
+		if op == 'stop':
+			self.lock_archive()
+			self.agent_running = False
+			return {'ok': True}
+		if op == 'unlock':
+			try:
+				self.vault.open(request['password'])
+			except PwmgrError as err:
+				self.lock_archive()
+				return {'ok': False, 'error': 'extraction failed (incorrect password?)',
+					'incorrect_password': isinstance(err, IncorrectPasswordError)}
+			return {'ok': True}
+		if op not in {'get', 'get_many', 'search', 'fuzzy', 'complete', 'update', 'update_many'}:
+			return {'ok': False, 'error': 'unknown operation {}'.format(op)}
+		if not self.vault.is_open:
+			return {'ok': False, 'error': 'agent is locked'}
+		try:
+			# Answer from the archive as it is now, which another process may have updated.
+			self.vault.refresh()
+		except PwmgrError as err:
+			logger.warning('{} could not be read again: {}'.format(self.path_archive, err))
+			self.lock_archive()
+			return {'ok': False, 'error': 'agent is locked'}
+		if op == 'get':
+			passwords = self.vault.get_all(request['name'])
+			# Names are only needed to offer the list of applications when nothing is found.
+			applications = [] if passwords else self.vault.names()
+			return {'ok': True, 'passwords': passwords, 'applications': applications}
+		if op == 'get_many':
+			return {'ok': True, 'passwords': {name.lower(): self.vault.get_all(name) for name in request['names']}}
+		if op == 'complete':
+			prefix = request['prefix'].lower()
+			return {'ok': True, 'names': [name for name in self.vault.names() if name.startswith(prefix)]}
+		if op == 'search':
+			try:
+				pattern = re.compile(request['pattern'].lower())
+			except re.error as err:
+				return {'ok': False, 'error': '{} is not a valid regular expression ({})'.format(err.pattern, err.msg)}
+			results = self.vault.search(pattern)
+			applications = [] if results else self.vault.names()
+			return {'ok': True, 'results': results, 'applications': applications}
+		if op == 'fuzzy':
+			limit = request.get('limit')
+			if limit is not None and (not isinstance(limit, int) or limit < 1):
+				return {'ok': False, 'error': 'invalid limit {}'.format(limit)}
+			# The trigram index is built by the first fuzzy search and kept until the application names change.
+			return {'ok': True, 'results': self.vault.fuzzy_search(request['query'], limit, self.fuzzy_usage())}
+		# op == 'update' or op == 'update_many'
+		try:
+			if op == 'update':
+				actions = {request['name']: self.vault.upsert(request['name'], request['password'])}
+			else:
+				actions = self.vault.upsert_many(request['passwords'])
+		except ValueError as err:
+			self.vault.rollback()
+			# The client adds its own full stop.
+			return {'ok': False, 'error': str(err).rstrip('.')}
+		try:
+			# Compaction is left to self.serve_agent, once the response has been sent.
+			self.vault.commit(defer_compaction=True)
+		except PwmgrError:
+			self.vault.rollback()
+			return {'ok': False, 'error': 'archive update failed'}
+		return {'ok': True, 'actions': actions}
 
 def main():
+	# Time the run from here (main may be called more than once by the same process).
+	profiler.reset()
 	# Remove first sys.argv, which is always pwmgr.py.
 	del sys.argv[0]
 	# List to hold options (command line arguments) provided by user.
@@ -794,18 +5548,29 @@ def main():
 			stripped_arg = PassManager.OPTION_ABBREVIATIONS[stripped_arg]
 		if arg.startswith('--') and stripped_arg in PassManager.ALLOWED_OPTIONS:
 			options[stripped_arg] = True
+		elif arg.startswith('--') and stripped_arg in PassManager.ALLOWED_OPTIONS_WITH_PARAMETERS:
+			# All following arguments up to the next option are parameters (possibly none).
+			options[stripped_arg] = []
+			while sys.argv and not sys.argv[0].startswith('-'):
+				options[stripped_arg].append(sys.argv.pop(0))
 		elif arg.startswith('--') and stripped_arg in PassManager.ALLOWED_OPTIONS_WITH_PARAMETER:
 			try:
 				# Next argument should be a 'parameter' for the option
 				options[stripped_arg] = sys.argv.pop(0)
 			except IndexError:
 				print('The {} option requires a parameter.'.format(arg.strip('-')))
-				sys.exit(1)
+				sys.exit(PassManager.EXIT_USAGE)
 		else:
 			print('Invalid argument. See -h or --help for usage.')
-			sys.exit(1)
-	# Create anonymous PassManager object. All functionality is dictated by options and occurs from __init__().
-	PassManager(options)
+			sys.exit(PassManager.EXIT_USAGE)
+	# All functionality is dictated by options and occurs from PassManager.__init__().
+	try:
+		pass_manager = PassManager(options)
+	finally:
+		profiler.finish(options)
+	# E.g. nothing was found (errors exit straight away).
+	if pass_manager.exit_status:
+		sys.exit(pass_manager.exit_status)
 
 if __name__ == '__main__':
 	main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""Time reading and committing the password file with each available archive backend of pwmgr.
+
+Usage:
+	bench_backends.py [-n ENTRIES] [-r REPEATS] [--7z PATH] [--json]
+
+For each backend, a new archive holding a password file of ENTRIES synthetic entries is created in a temporary
+directory, then read_member and a commit of an updated password file are timed REPEATS times. The best and mean
+times (seconds) are printed as a table, or as JSON with --json. Backends which cannot be used (7z program or py7zr
+package missing) are reported as unavailable. To time the 7z backend without 7-Zip, pass --7z tools/fake7z.py.
+"""
+import json, os, sys, tempfile, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pwmgr
+
+PASSWORD = 'benchmark'
+
+def password_file_text(entries):
+	return ''.join('application{:07d} password{:07d}\n'.format(i, i) for i in range(entries))
+
+def time_calls(function, repeats):
+	"""Return the best and mean times of repeats calls of function."""
+	times = []
+	for _ in range(repeats):
+		start = time.perf_counter()
+		function()
+		times.append(time.perf_counter() - start)
+	return min(times), sum(times) / len(times)
+
+def bench_backend(name, backend_class, text, repeats, path_7z):
+	result = {'backend': name}
+	with tempfile.TemporaryDirectory() as directory:
+		path_archive = os.path.join(directory, 'bench.7z')
+		try:
+			backend_class.create(path_archive, PASSWORD, pwmgr.PassManager.PASSWORD_FILENAME, path_7z=path_7z)
+			archive = backend_class(path_archive, PASSWORD, path_7z=path_7z)
+			archive.write_member(pwmgr.PassManager.PASSWORD_FILENAME, text)
+			archive.commit()
+		except (pwmgr.ArchiveError, OSError) as err:
+			result['error'] = str(err)
+			return result
+		result['read_best'], result['read_mean'] = time_calls(
+			lambda: archive.read_member(pwmgr.PassManager.PASSWORD_FILENAME), repeats)
+		def commit():
+			archive.write_member(pwmgr.PassManager.PASSWORD_FILENAME, text + 'new password\n')
+			archive.commit()
+		result['commit_best'], result['commit_mean'] = time_calls(commit, repeats)
+	return result
+
+def main():
+	args = sys.argv[1:]
+	entries, repeats, path_7z = 1000, 5, '7z'
+	as_json = '--json' in args
+	for option, value in zip(args, args[1:]):
+		if option == '-n':
+			entries = int(value)
+		elif option == '-r':
+			repeats = int(value)
+		elif option == '--7z':
+			path_7z = value
+	text = password_file_text(entries)
+	results = [bench_backend(name, backend_class, text, repeats, path_7z)
+		for name, backend_class in pwmgr.PassManager.ARCHIVE_BACKENDS.items()]
+	if as_json:
+		print(json.dumps({'entries': entries, 'repeats': repeats, 'results': results}, indent=2))
+		return
+	print('{} entries, {} repeats (seconds)'.format(entries, repeats))
+	print('{:<8} {:>10} {:>10} {:>11} {:>11}'.format('backend', 'read best', 'read mean', 'commit best', 'commit mean'))
+	for result in results:
+		if 'error' in result:
+			print('{:<8} unavailable: {}'.format(result['backend'], result['error']))
+		else:
+			print('{:<8} {:>10.4f} {:>10.4f} {:>11.4f} {:>11.4f}'.format(result['backend'], result['read_best'],
+				result['read_mean'], result['commit_best'], result['commit_mean']))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""Measure how pwmgr scales with the size of the password file.
+
+Usage:
+	benchmark.py [--sizes 1000,10000,100000,1000000] [--repeats N] [--latency SECONDS] [--7z PATH ...]
+		[--setting NAME=VALUE ...] [--pwmgr PATH] [--output FILE]
+	benchmark.py --compare OLD.json NEW.json
+
+For every size, a password file with that many entries (app0000000 to app{size-1}) is generated and stored in a new
+archive with each 7z program. The programs are the real 7z (if it is on the path) and tools/fake7z.py, which sleeps
+for --latency seconds every time it is run, so its results only depend on pwmgr itself. Further 7z programs (or
+stand-ins) may be given with --7z.
+
+Operations are run through pwmgr's main() with the arguments a user would type, with the password prompts answered
+automatically, output discarded and xclip replaced by a stand-in (which also sleeps for --latency seconds, and is
+used as the clipboard backend whether or not there is a display):
+	retrieve_head, retrieve_middle, retrieve_tail
+		pwmgr app..., for the first, middle and last application (only the first password is needed).
+	retrieve_all
+		pwmgr app... -a, for the middle application (the whole password file is parsed).
+	search
+		pwmgr -s REGEX, with a regular expression matching 10 applications.
+	fuzzy
+		pwmgr -f QUERY --limit 10, with a misspelt name of the middle application.
+	update_head, update_middle, update_tail
+		pwmgr -u app..., for a new application sorting before, in the middle of and after all others. The archive is
+		restored after every repeat (outside the timing).
+and directly on the PassManager of the retrieve_all operation:
+	parse
+		Parsing (see PasswordFile) the password file already read by the PassManager's Vault.
+	clipboard
+		PassManager.copy_to_selection, with the xclip backend.
+
+The best and mean of --repeats runs (seconds) of each operation are written as JSON to --output (default: standard
+output), with the pwmgr version and git commit, so that runs of different versions can be compared with --compare.
+--pwmgr selects the pwmgr.py to benchmark (default: the one in the parent directory). It is copied, together with a
+pwmgr_config holding --setting values, to a temporary directory, so no existing configuration or archive is touched.
+"""
+import argparse, builtins, contextlib, getpass, hashlib, importlib.util, io, json, logging, os, platform, shutil
+import stat, subprocess, sys, tempfile, time
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+PASSWORD = 'benchmark'
+NEW_PASSWORD = 'new-password'
+XCLIP_STAND_IN = """#!{}
+import os, sys, time
+time.sleep(float(os.environ.get('FAKEXCLIP_LATENCY', '0')))
+sys.stdin.read()
+""".format(sys.executable)
+
+def password_file_text(entries):
+	"""Return a password file with entries sorted, unique applications."""
+	return ''.join('app{:07d} {}\n'.format(i, hashlib.sha256(str(i).encode()).hexdigest()[:16])
+		for i in range(entries))
+
+def operations(entries):
+	"""Return a list of (name, pwmgr arguments) for the operations run through main()."""
+	middle = entries // 2
+	return [
+		('retrieve_head', ['app0000000']),
+		('retrieve_middle', ['app{:07d}'.format(middle)]),
+		('retrieve_tail', ['app{:07d}'.format(entries - 1)]),
+		('retrieve_all', ['app{:07d}'.format(middle), '-a']),
+		('search', ['-s', '^app000000']),
+		('fuzzy', ['-f', 'apq{:07d}'.format(middle), '--limit', '10']),
+		('update_head', ['-u', 'aaa-new']),
+		('update_middle', ['-u', 'app{:07d}-new'.format(middle)]),
+		('update_tail', ['-u', 'zzz-new']),
+	]
+
+@contextlib.contextmanager
+def user_session():
+	"""Answer password prompts (the archive password, then the new password) and other prompts (with 'q'), and
+	discard everything printed."""
+	answers = [PASSWORD]
+	def fake_getpass(prompt='', stream=None):
+		return answers.pop(0) if answers else NEW_PASSWORD
+	original_getpass, original_input = getpass.getpass, builtins.input
+	getpass.getpass, builtins.input = fake_getpass, lambda prompt='': 'q'
+	try:
+		with contextlib.redirect_stdout(io.StringIO()):
+			yield
+	finally:
+		getpass.getpass, builtins.input = original_getpass, original_input
+
+def run_main(pwmgr, arguments):
+	"""Run pwmgr's main() as for the command line pwmgr arguments. Return an error message, or None on success."""
+	sys.argv = ['pwmgr.py'] + arguments
+	try:
+		with user_session():
+			pwmgr.main()
+	except SystemExit as exit:
+		if exit.code:
+			return 'pwmgr exited with status {}'.format(exit.code)
+	return None
+
+def time_repeats(function, repeats, prepare=None):
+	"""Return (best, mean, error) of repeats timed calls of function, which returns an error message or None. prepare
+	is called (untimed) before every call."""
+	times = []
+	for _ in range(repeats):
+		if prepare:
+			prepare()
+		start = time.perf_counter()
+		error = function()
+		times.append(time.perf_counter() - start)
+		if error:
+			return None, None, error
+	return min(times), sum(times) / len(times), None
+
+class Workspace:
+	"""Temporary directory holding a copy of pwmgr.py, its pwmgr_config, a pvault directory and the xclip stand-in."""
+	def __init__(self, path_pwmgr, settings, latency):
+		self.directory = tempfile.mkdtemp(prefix='pwmgr-benchmark-')
+		self.path_pvault = os.path.join(self.directory, 'pvault')
+		os.mkdir(self.path_pvault)
+		shutil.copy(path_pwmgr, self.directory)
+		self.settings = dict({'copy_to_selection': 'True', 'always_print': 'False', 'check_new_password': 'True',
+			'logging_level': 'ERROR', 'archive_name': 'bench.7z', 'clipboard_backend': 'xclip', 'selection_timeout': '0'},
+			**settings)
+		path_bin = os.path.join(self.directory, 'bin')
+		os.mkdir(path_bin)
+		with open(os.path.join(path_bin, 'xclip'), 'w') as xclip_file:
+			xclip_file.write(XCLIP_STAND_IN)
+		os.chmod(os.path.join(path_bin, 'xclip'), stat.S_IRWXU)
+		os.environ['PATH'] = path_bin + os.pathsep + os.environ['PATH']
+		os.environ['FAKEXCLIP_LATENCY'] = os.environ['FAKE7Z_LATENCY'] = str(latency)
+		# The xclip backend is only used with a display (which the stand-in never opens).
+		os.environ.setdefault('DISPLAY', ':0')
+		# Never talk to a running agent.
+		os.environ.pop('PWMGR_AGENT_SOCK', None)
+		os.environ['XDG_RUNTIME_DIR'] = self.directory
+		spec = importlib.util.spec_from_file_location('pwmgr_benchmarked',
+			os.path.join(self.directory, os.path.basename(path_pwmgr)))
+		self.pwmgr = importlib.util.module_from_spec(spec)
+		spec.loader.exec_module(self.pwmgr)
+		logging.getLogger(self.pwmgr.__name__).setLevel(logging.ERROR)
+
+	def configure(self, path_7z):
+		with open(os.path.join(self.directory, 'pwmgr_config'), 'w') as config_file:
+			for name, value in dict(self.settings, **{'7z_application': path_7z}).items():
+				config_file.write('{} {}\n'.format(name, value))
+
+	def create_archive(self, path_7z, text):
+		"""Create pvault/bench.7z with the password file text using the 7z program path_7z and keep a copy of it."""
+		self.path_archive = os.path.join(self.path_pvault, 'bench.7z')
+		if os.path.exists(self.path_archive):
+			os.remove(self.path_archive)
+		subprocess.run([path_7z, 'a', self.path_archive, '-sipasses', '-mhe', '-p' + PASSWORD], input=text.encode(),
+			stdout=subprocess.DEVNULL, check=True)
+		shutil.copy(self.path_archive, self.path_archive + '.orig')
+
+	def restore_archive(self):
+		shutil.copy(self.path_archive + '.orig', self.path_archive)
+
+	def remove(self):
+		shutil.rmtree(self.directory)
+
+def benchmark(workspace, label, path_7z, entries, repeats):
+	"""Run every operation on an archive of entries entries made with path_7z. Return a list of results."""
+	results = []
+	def record(operation, best, mean, error):
+		result = {'7z': label, 'entries': entries, 'operation': operation, 'best': best, 'mean': mean}
+		if error:
+			result['error'] = error
+		results.append(result)
+		print('{:<8} {:>8} {:<16} {}'.format(label, entries, operation,
+			error or '{:.4f} s (mean {:.4f} s)'.format(best, mean)), file=sys.stderr)
+	workspace.configure(path_7z)
+	workspace.create_archive(path_7z, password_file_text(entries))
+	for operation, arguments in operations(entries):
+		prepare = workspace.restore_archive if operation.startswith('update') else None
+		record(operation, *time_repeats(lambda: run_main(workspace.pwmgr, arguments), repeats, prepare))
+	workspace.restore_archive()
+	# A PassManager which has read the whole password file, for the operations below.
+	options = {'application_name': 'app{:07d}'.format(entries // 2), 'all': True}
+	try:
+		with user_session():
+			manager = workspace.pwmgr.PassManager(options)
+	except SystemExit:
+		return results
+	def parse():
+		workspace.pwmgr.PasswordFile(manager.vault.password_file.text)
+	record('parse', *time_repeats(parse, repeats))
+	def copy():
+		if not manager.copy_to_selection(NEW_PASSWORD):
+			return 'copy failed'
+	record('clipboard', *time_repeats(copy, repeats))
+	return results
+
+def git_commit(path):
+	try:
+		return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(path)),
+			stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip() or None
+	except OSError:
+		return None
+
+def compare(path_old, path_new):
+	"""Print the ratio of the best times of each operation in the results path_new to those in path_old."""
+	with open(path_old) as old_file, open(path_new) as new_file:
+		old, new = json.load(old_file), json.load(new_file)
+	old_best = {(result['7z'], result['entries'], result['operation']): result['best'] for result in old['results']}
+	print('{:<8} {:>8} {:<16} {:>10} {:>10} {:>7}'.format('7z', 'entries', 'operation', 'old', 'new', 'ratio'))
+	for result in new['results']:
+		key = (result['7z'], result['entries'], result['operation'])
+		if result['best'] is None or not old_best.get(key):
+			continue
+		print('{:<8} {:>8} {:<16} {:>10.4f} {:>10.4f} {:>7.2f}'.format(*key, old_best[key], result['best'],
+			result['best'] / old_best[key]))
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark pwmgr on synthetic password files.')
+	parser.add_argument('--sizes', default='1000,10000,100000,1000000',
+		help='comma separated numbers of entries (default: %(default)s)')
+	parser.add_argument('--repeats', type=int, default=3, help='runs of each operation (default: %(default)s)')
+	parser.add_argument('--latency', type=float, default=0.05,
+		help='seconds slept by every run of the 7z and xclip stand-ins (default: %(default)s)')
+	parser.add_argument('--7z', dest='sevenzip', action='append', default=[], metavar='PATH',
+		help='additional 7z program (or stand-in) to benchmark')
+	parser.add_argument('--setting', action='append', default=[], metavar='NAME=VALUE',
+		help='pwmgr_config setting used for every operation')
+	parser.add_argument('--pwmgr', default=os.path.join(os.path.dirname(DIRECTORY), 'pwmgr.py'),
+		help='pwmgr.py to benchmark (default: %(default)s)')
+	parser.add_argument('--output', help='file to write the JSON results to (default: standard output)')
+	parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two JSON result files')
+	args = parser.parse_args()
+	if args.compare:
+		compare(*args.compare)
+		return
+	sevenzips = [('fake7z', os.path.join(DIRECTORY, 'fake7z.py'))]
+	if shutil.which('7z'):
+		sevenzips.append(('7z', shutil.which('7z')))
+	sevenzips.extend((os.path.basename(path), os.path.abspath(path)) for path in args.sevenzip)
+	settings = dict(setting.split('=', 1) for setting in args.setting)
+	workspace = Workspace(args.pwmgr, settings, args.latency)
+	results = []
+	try:
+		for entries in [int(size) for size in args.sizes.split(',')]:
+			for label, path_7z in sevenzips:
+				results.extend(benchmark(workspace, label, path_7z, entries, args.repeats))
+	finally:
+		workspace.remove()
+	report = {'pwmgr_version': getattr(workspace.pwmgr.PassManager, 'VERSION', None), 'git_commit': git_commit(args.pwmgr),
+		'python': platform.python_version(), 'repeats': args.repeats, 'latency': args.latency, 'settings': settings,
+		'results': results}
+	if args.output:
+		with open(args.output, 'w') as output_file:
+			json.dump(report, output_file, indent=1)
+	else:
+		print(json.dumps(report, indent=1))
+
+if __name__ == '__main__':
+	main()
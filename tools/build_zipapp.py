@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""Build pwmgr as a single executable zipapp holding precompiled bytecode.
+
+Usage:
+	build_zipapp.py [-o OUTPUT] [-p INTERPRETER] [--pwmgr PATH]
+
+Running pwmgr.py as a script compiles all of it on every run, since Python never caches the bytecode of the script it
+is given (nor of anything when PYTHONDONTWRITEBYTECODE is set). The zipapp holds pwmgr.py together with its bytecode
+(an unchecked hash-based .pyc, so it is used without comparing timestamps), which is loaded directly by zipimport.
+The source is only compiled if the zipapp is run by a Python version other than the one which built it.
+
+OUTPUT defaults to pwmgr.pyz beside pwmgr.py, and INTERPRETER (written to the shebang line) to /usr/bin/env python3.
+pwmgr_config and the pvault directory are looked for in the directory holding the zipapp, so a zipapp built in place
+uses the same settings and archives as pwmgr.py. Run it with ./pwmgr.pyz or python3 pwmgr.pyz, e.g. from an alias.
+"""
+import os, py_compile, sys, tempfile, zipapp
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+def build(path_pwmgr, path_output, interpreter):
+	with tempfile.TemporaryDirectory() as directory:
+		path_source = os.path.join(directory, 'pwmgr.py')
+		with open(path_pwmgr, 'rb') as source_file, open(path_source, 'wb') as copy_file:
+			copy_file.write(source_file.read())
+		py_compile.compile(path_source, cfile=os.path.join(directory, 'pwmgr.pyc'), doraise=True,
+			invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+		zipapp.create_archive(directory, path_output, interpreter=interpreter, main='pwmgr:main')
+
+def main():
+	args = sys.argv[1:]
+	path_pwmgr = os.path.join(os.path.dirname(DIRECTORY), 'pwmgr.py')
+	path_output, interpreter = None, '/usr/bin/env python3'
+	for option, value in zip(args, args[1:]):
+		if option == '-o':
+			path_output = value
+		elif option == '-p':
+			interpreter = value
+		elif option == '--pwmgr':
+			path_pwmgr = value
+	path_output = path_output or os.path.join(os.path.dirname(os.path.abspath(path_pwmgr)), 'pwmgr.pyz')
+	try:
+		build(path_pwmgr, path_output, interpreter)
+	except (OSError, py_compile.PyCompileError) as err:
+		sys.exit('Failed to build {}: {}'.format(path_output, err))
+	print('Built {} (Python {}.{} bytecode).'.format(path_output, *sys.version_info[:2]))
+
+if __name__ == '__main__':
+	main()
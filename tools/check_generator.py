@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""Check that PasswordGenerator draws valid values for small alphabets and for every n up to and beyond 256.
+
+Usage:
+	check_generator.py [-n PASSWORDS] [--pwmgr PATH]
+
+random_below(n) is called for every n from 1 to 300, often enough that each value below n (up to 256) is expected to
+be drawn many times, and fails if a value is out of range or never drawn. PASSWORDS passwords (default 3000) are then
+generated one at a time and in a batch for each policy in POLICIES, mostly with small alphabets (whose class counts
+are drawn with random_below of numbers between 128 and 256), and each is checked against its policy. The check fails,
+with exit status 1, if anything is wrong or raises an exception.
+"""
+import collections, importlib.util, os, sys, traceback
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+# Policy specs with few characters per class, so the cumulative counts of class_counts are often from 129 to 256.
+POLICIES = [
+	'length=8 symbols=!#$% exclude_ambiguous=true require=digit:0',
+	'length=8 symbols=!# require=symbol:1',
+	'length=8 symbols=!#$%&*+-.:=?@^_~ require=lower:1,upper:1,digit:1,symbol:1',
+	'length=12 require=digit:2',
+	'length=9 exclude_ambiguous=true require=',
+	'length=15 require=lower:1,upper:1,digit:3',
+]
+
+def load_pwmgr(path_pwmgr):
+	"""Import pwmgr.py from path_pwmgr and return the module."""
+	spec = importlib.util.spec_from_file_location('pwmgr', path_pwmgr)
+	pwmgr = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(pwmgr)
+	return pwmgr
+
+def check_random_below(pwmgr):
+	"""Return a list of problems with random_below for n from 1 to 300."""
+	problems = []
+	generator = pwmgr.PasswordGenerator(pwmgr.PasswordPolicy())
+	for n in range(1, 301):
+		draws = 30 * min(n, 256)
+		values = collections.Counter(generator.random_below(n) for _ in range(draws))
+		if min(values) < 0 or max(values) >= n:
+			problems.append('random_below({}) drew {}.'.format(n, min(values) if min(values) < 0 else max(values)))
+		elif n <= 256 and len(values) < n:
+			problems.append('random_below({}) never drew {} of its {} values in {} draws.'.format(n, n - len(values),
+				n, draws))
+	return problems
+
+def password_problem(policy, password):
+	"""Return a message saying why password does not follow policy, or None if it does."""
+	alphabets = policy.alphabets()
+	if len(password) != policy.length:
+		return '{!r} has length {}.'.format(password, len(password))
+	if any(not any(char in characters for characters in alphabets.values()) for char in password):
+		return '{!r} has characters the policy does not allow.'.format(password)
+	for name, count in policy.require.items():
+		if sum(char in alphabets.get(name, '') for char in password) < count:
+			return '{!r} has fewer than {} {} characters.'.format(password, count, name)
+	return None
+
+def check_policies(pwmgr, number):
+	"""Return a list of problems with passwords generated following each of POLICIES."""
+	problems = []
+	for spec in POLICIES:
+		policy = pwmgr.PasswordPolicy().updated(spec)
+		generator = pwmgr.PasswordGenerator(policy)
+		try:
+			passwords = [generator.generate() for _ in range(number)] + generator.generate_many(number)
+		except Exception:
+			problems.append('Generating passwords for {!r} failed:\n{}'.format(spec, traceback.format_exc()))
+			continue
+		problems.extend(filter(None, (password_problem(policy, password) for password in passwords)))
+	return problems
+
+def main():
+	args = sys.argv[1:]
+	number = 3000
+	path_pwmgr = os.path.join(os.path.dirname(DIRECTORY), 'pwmgr.py')
+	for option, value in zip(args, args[1:]):
+		if option == '-n':
+			number = int(value)
+		elif option == '--pwmgr':
+			path_pwmgr = value
+	pwmgr = load_pwmgr(path_pwmgr)
+	try:
+		problems = check_random_below(pwmgr)
+	except Exception:
+		problems = ['random_below failed:\n' + traceback.format_exc()]
+	problems += check_policies(pwmgr, number)
+	print('Checked random_below(n) for n up to 300 and {} passwords for each of {} policies.'.format(2 * number,
+		len(POLICIES)))
+	for problem in problems[:20]:
+		print('FAIL: ' + problem)
+	if problems:
+		sys.exit(1)
+	print('OK')
+
+if __name__ == '__main__':
+	main()
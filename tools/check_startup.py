@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""Check that importing pwmgr stays within a start-up time budget.
+
+Usage:
+	check_startup.py [--budget-ms MILLISECONDS] [-r RUNS] [--pwmgr PATH]
+
+pwmgr is imported RUNS times (default 5) in a new interpreter with python -X importtime, after one run which caches
+its bytecode in a temporary directory (as for a zipapp built by tools/build_zipapp.py, so compiling the source is not
+counted). The check fails, with exit status 1, if the best cumulative import time of pwmgr exceeds the budget (default
+40 ms) or if any of the modules which pwmgr only imports on demand is imported at start-up.
+"""
+import os, subprocess, sys, tempfile
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+# Modules only needed by some features of pwmgr, which must not be imported by every run.
+LAZY_MODULES = ['base64', 'concurrent.futures', 'cryptography', 'csv', 'fnmatch', 'hashlib', 'mmap', 'py7zr', 'shutil',
+	'socket', 'struct', 'urllib.parse']
+
+def import_times(path_pwmgr, path_pycache):
+	"""Import pwmgr once and return a dictionary of the cumulative import times (microseconds) of every module."""
+	environment = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(path_pwmgr)))
+	environment.pop('PYTHONDONTWRITEBYTECODE', None)
+	process = subprocess.run([sys.executable, '-X', 'importtime', '-X', 'pycache_prefix=' + path_pycache, '-c',
+		'import pwmgr'], env=environment, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+	if process.returncode:
+		sys.exit('Failed to import pwmgr:\n' + process.stderr)
+	times = {}
+	for line in process.stderr.splitlines():
+		# import time: self [us] | cumulative | imported package
+		fields = line.split('|')
+		if line.startswith('import time:') and len(fields) == 3 and fields[1].strip().isdigit():
+			times[fields[2].strip()] = int(fields[1])
+	return times
+
+def main():
+	args = sys.argv[1:]
+	budget_ms, runs = 40.0, 5
+	path_pwmgr = os.path.join(os.path.dirname(DIRECTORY), 'pwmgr.py')
+	for option, value in zip(args, args[1:]):
+		if option == '--budget-ms':
+			budget_ms = float(value)
+		elif option == '-r':
+			runs = int(value)
+		elif option == '--pwmgr':
+			path_pwmgr = value
+	with tempfile.TemporaryDirectory() as path_pycache:
+		import_times(path_pwmgr, path_pycache)
+		measurements = [import_times(path_pwmgr, path_pycache) for _ in range(runs)]
+	best_ms = min(times['pwmgr'] for times in measurements) / 1000
+	lazy_imported = sorted(name for name in LAZY_MODULES if name in measurements[0])
+	print('Import of pwmgr: best {:.1f} ms of {} runs (budget {:.1f} ms).'.format(best_ms, runs, budget_ms))
+	failed = False
+	if best_ms > budget_ms:
+		print('FAIL: start-up time exceeds the budget.')
+		failed = True
+	if lazy_imported:
+		print('FAIL: modules imported at start-up instead of on demand: {}.'.format(', '.join(lazy_imported)))
+		failed = True
+	if failed:
+		sys.exit(1)
+	print('OK')
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""Stand-in for the 7z command line program, for trying out pwmgr without 7-Zip (set 7z_application to the path of
+this script in pwmgr_config).
+
+Only the commands and switches used by pwmgr are understood:
+	fake7z.py a|u archive -siNAME [-mhe] [-pPASSWORD]   Add or replace member NAME with the contents of stdin.
+	fake7z.py e archive [NAME ...] -so [-pPASSWORD]     Write the contents of the members to stdout.
+	fake7z.py d archive NAME ... [-pPASSWORD]           Delete members.
+	fake7z.py l archive -slt [-pPASSWORD]               List the members in the technical format of 7z (-slt).
+
+An archive is a JSON file holding a hash of the archive password and the (base64 encoded) members. NOTHING IS
+ENCRYPTED - never store real passwords in one. An incorrect password is reported on stderr with exit status 2, as 7z
+does.
+
+Environment variables
+---------------------
+FAKE7Z_LATENCY : float
+	Seconds to sleep before doing anything (simulates key derivation and I/O of a real archive).
+FAKE7Z_FAIL : string
+	If set to the name of a command (e.g. u), that command fails after reading its input, without writing anything.
+FAKE7Z_BYTES_PER_SECOND : float
+	Read and write archives no faster than this (simulates a large archive on a slow disk).
+
+As 7z does, an existing archive is updated by writing a temporary file beside it (archive.tmp) which is then renamed
+over it. A process stopped with SIGTERM removes the file it was writing, but one killed with SIGKILL leaves it behind.
+"""
+import base64, hashlib, json, os, signal, sys, time
+
+CHUNK_SIZE = 65536
+
+def throttle(num_bytes):
+	"""Take as long to process num_bytes as FAKE7Z_BYTES_PER_SECOND allows."""
+	bytes_per_second = float(os.environ.get('FAKE7Z_BYTES_PER_SECOND') or 0)
+	if bytes_per_second:
+		time.sleep(num_bytes / bytes_per_second)
+
+def archive_path(path, command):
+	"""Apply 7z's naming quirk: a trailing period means 'no extension' and, when an archive is created, a name
+	without an extension has .7z appended."""
+	if path.endswith('.'):
+		return path[:-1]
+	if command in {'a', 'u'} and not os.path.exists(path) and not os.path.splitext(path)[1]:
+		return path + '.7z'
+	return path
+
+def password_hash(password):
+	return hashlib.sha256(password.encode()).hexdigest()
+
+def load_archive(path, password):
+	"""Return the archive at path as a dictionary, exiting with status 2 if password is incorrect."""
+	if not os.path.exists(path):
+		sys.stderr.write('ERROR: {}: cannot find archive\n'.format(path))
+		sys.exit(2)
+	throttle(os.path.getsize(path))
+	with open(path, 'r') as archive_file:
+		archive = json.load(archive_file)
+	if archive['password'] != password_hash(password):
+		sys.stderr.write('ERROR: {}: Wrong password?\n'.format(path))
+		sys.exit(2)
+	return archive
+
+def main():
+	time.sleep(float(os.environ.get('FAKE7Z_LATENCY', '0')))
+	command, arguments = sys.argv[1], sys.argv[2:]
+	password = ''
+	stdin_name = None
+	names = [argument for argument in arguments if not argument.startswith('-')]
+	for argument in arguments:
+		if argument.startswith('-p'):
+			password = argument[2:]
+		elif argument.startswith('-si'):
+			stdin_name = argument[3:]
+	path = archive_path(names.pop(0), command)
+	if command in {'a', 'u'}:
+		if os.path.exists(path):
+			archive = load_archive(path, password)
+		else:
+			archive = {'password': password_hash(password), 'members': {}}
+		archive['members'][stdin_name] = base64.b64encode(sys.stdin.buffer.read()).decode()
+	elif command == 'e':
+		archive = load_archive(path, password)
+		for name in names or list(archive['members']):
+			if name in archive['members']:
+				sys.stdout.buffer.write(base64.b64decode(archive['members'][name]))
+		return
+	elif command == 'l':
+		archive = load_archive(path, password)
+		sys.stdout.write('Listing archive: {0}\n\n--\nPath = {0}\nType = 7z\n\n----------\n'.format(path))
+		for name, data in archive['members'].items():
+			sys.stdout.write('Path = {}\nSize = {}\n\n'.format(name, len(base64.b64decode(data))))
+		return
+	elif command == 'd':
+		archive = load_archive(path, password)
+		for name in names:
+			archive['members'].pop(name, None)
+	else:
+		sys.stderr.write('ERROR: unsupported command {}\n'.format(command))
+		sys.exit(7)
+	if os.environ.get('FAKE7Z_FAIL') == command:
+		sys.stderr.write('ERROR: simulated failure of command {}\n'.format(command))
+		sys.exit(2)
+	write_archive(path, archive)
+
+def write_archive(path, archive):
+	data = json.dumps(archive).encode()
+	path_write = path + '.tmp' if os.path.exists(path) else path
+	def remove_and_exit(signal_number, frame):
+		if os.path.exists(path_write):
+			os.remove(path_write)
+		sys.exit(255)
+	signal.signal(signal.SIGTERM, remove_and_exit)
+	with open(path_write, 'wb') as archive_file:
+		for start in range(0, len(data), CHUNK_SIZE):
+			archive_file.write(data[start:start + CHUNK_SIZE])
+			archive_file.flush()
+			throttle(len(data[start:start + CHUNK_SIZE]))
+	if path_write != path:
+		os.replace(path_write, path)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""Stand-in for the clipboard programs used by pwmgr (xclip, xsel, wl-copy, wl-paste and tmux), for trying out or
+testing the clipboard backends on a machine without them (or without a display).
+
+Usage:
+	fakeclip.py --install DIRECTORY
+	xclip|xsel|wl-copy|wl-paste|tmux ARGS...   (through the links made by --install)
+
+--install makes links named after each program in DIRECTORY pointing to this script, which then behaves as the
+program it is run as, for the options pwmgr uses. Put DIRECTORY first on the PATH (and set DISPLAY, WAYLAND_DISPLAY
+or TMUX, so that the backend is detected). The contents of each selection (and the stack of tmux paste buffers) are
+kept in files in $FAKECLIP_DIR (default /tmp/fakeclip-UID), where a test can read or change them.
+
+If FAKECLIP_SERVE is set to a number of seconds, xclip, xsel and wl-copy leave a background process holding their
+standard output and error open for that long after copying, as the real programs do while they serve the selection.
+"""
+import json, os, sys, time
+
+PROGRAMS = ['xclip', 'xsel', 'wl-copy', 'wl-paste', 'tmux']
+
+def state_path(name):
+	directory = os.environ.get('FAKECLIP_DIR') or '/tmp/fakeclip-{}'.format(os.getuid())
+	os.makedirs(directory, mode=0o700, exist_ok=True)
+	return os.path.join(directory, name)
+
+def read_selection(selection):
+	try:
+		with open(state_path(selection)) as selection_file:
+			return selection_file.read()
+	except FileNotFoundError:
+		return ''
+
+def write_selection(selection, text):
+	with open(state_path(selection), 'w') as selection_file:
+		selection_file.write(text)
+
+def serve():
+	"""Imitate a program which forks to keep serving the selection, holding the output streams open."""
+	seconds = float(os.environ.get('FAKECLIP_SERVE') or 0)
+	if seconds and os.fork() == 0:
+		time.sleep(seconds)
+		os._exit(0)
+
+def xclip(args):
+	selection = args[args.index('-selection') + 1] if '-selection' in args else 'primary'
+	if '-o' in args:
+		sys.stdout.write(read_selection(selection))
+	else:
+		write_selection(selection, sys.stdin.read())
+		serve()
+
+def xsel(args):
+	selection = 'clipboard' if '--clipboard' in args else 'secondary' if '--secondary' in args else 'primary'
+	if '--output' in args:
+		sys.stdout.write(read_selection(selection))
+	elif '--clear' in args:
+		write_selection(selection, '')
+	else:
+		write_selection(selection, sys.stdin.read())
+		serve()
+
+def wl_copy(args):
+	selection = 'primary' if '--primary' in args else 'clipboard'
+	write_selection(selection, '' if '--clear' in args else sys.stdin.read())
+	if '--clear' not in args:
+		serve()
+
+def wl_paste(args):
+	text = read_selection('primary' if '--primary' in args else 'clipboard')
+	sys.stdout.write(text if '--no-newline' in args else text + '\n')
+
+def tmux(args):
+	try:
+		with open(state_path('tmux-buffers')) as buffers_file:
+			buffers = json.load(buffers_file)
+	except FileNotFoundError:
+		buffers = []
+	if args == ['load-buffer', '-']:
+		buffers.insert(0, sys.stdin.read())
+	elif args == ['save-buffer', '-']:
+		if not buffers:
+			sys.exit('no buffers')
+		sys.stdout.write(buffers[0])
+	elif args == ['delete-buffer']:
+		if not buffers:
+			sys.exit('no buffer')
+		buffers.pop(0)
+	else:
+		sys.exit('fakeclip: unsupported tmux command {}'.format(' '.join(args)))
+	with open(state_path('tmux-buffers'), 'w') as buffers_file:
+		json.dump(buffers, buffers_file)
+
+def main():
+	program, args = os.path.basename(sys.argv[0]), sys.argv[1:]
+	if args[:1] == ['--install'] and len(args) == 2:
+		for name in PROGRAMS:
+			path_link = os.path.join(args[1], name)
+			if os.path.lexists(path_link):
+				os.remove(path_link)
+			os.symlink(os.path.abspath(__file__), path_link)
+		print('Linked {} in {} to {}.'.format(', '.join(PROGRAMS), args[1], os.path.abspath(__file__)))
+		return
+	commands = {'xclip': xclip, 'xsel': xsel, 'wl-copy': wl_copy, 'wl-paste': wl_paste, 'tmux': tmux}
+	if program not in commands:
+		sys.exit(__doc__)
+	commands[program](args)
+
+if __name__ == '__main__':
+	main()
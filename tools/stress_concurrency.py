@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""Check that concurrent updates of one archive by several pwmgr processes are neither lost nor seen half done.
+
+Usage:
+	stress_concurrency.py [-w WRITERS] [-u UPDATES] [-r READERS] [--journal-max-size BYTES] [--native] [--7z PATH]
+		[--pwmgr PATH]
+
+An archive is created in a temporary directory (a 7z archive written by tools/fake7z.py, or the 7z program given
+by --7z, or a native vault with --native) and WRITERS processes (default 8) open it at the same time. Each commits
+UPDATES updates (default 10), one at a time: update i of writer w adds the application wNN-IIII and sets wNN-count to
+i + 1 in the same commit. As every writer works from the archive as it opened it, each commit has to take the write
+lock and merge its change with those committed by the others since. A small journal_max_size (default 256 bytes)
+makes many of the commits rewrite the whole password file, and compacts native vaults.
+
+Meanwhile, READERS processes (default 2) open the archive over and over without any lock, and check that every
+snapshot holds, for each writer, exactly its first wNN-count applications, i.e. that no commit is seen in part.
+
+Once all processes have finished, the archive must hold every application added, with every wNN-count equal to
+UPDATES. The check fails, with exit status 1, if any update was lost or any process failed.
+"""
+import os, subprocess, sys, tempfile, time
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+PASSWORD = 'stress'
+
+def import_pwmgr(path_pwmgr):
+	sys.path.insert(0, os.path.dirname(os.path.abspath(path_pwmgr)))
+	import pwmgr
+	return pwmgr
+
+def application_name(writer, update):
+	return 'w{:02d}-{:04d}'.format(writer, update)
+
+def count_name(writer):
+	return 'w{:02d}-count'.format(writer)
+
+def check_snapshot(vault, writers):
+	"""Return a list of problems with the open vault: writers whose applications do not match their count."""
+	names = set(vault.names())
+	problems = []
+	for writer in range(writers):
+		count = int(vault.get(count_name(writer)) or 0)
+		added = sorted(name for name in names if name.startswith('w{:02d}-'.format(writer)) and name[4:].isdigit())
+		if added != [application_name(writer, update) for update in range(count)]:
+			problems.append('writer {}: count {} but {} applications'.format(writer, count, len(added)))
+	return problems
+
+def run_writer(pwmgr, path_archive, settings, writer, updates):
+	with pwmgr.Vault(path_archive, **settings) as vault:
+		vault.open(PASSWORD)
+		for update in range(updates):
+			vault.upsert(application_name(writer, update), 'password-{}-{}'.format(writer, update))
+			vault.upsert(count_name(writer), str(update + 1))
+			vault.commit()
+
+def run_reader(pwmgr, path_archive, settings, writers, path_done):
+	snapshots = 0
+	with pwmgr.Vault(path_archive, **settings) as vault:
+		while not os.path.exists(path_done):
+			vault.open(PASSWORD)
+			problems = check_snapshot(vault, writers)
+			if problems:
+				sys.exit('Inconsistent snapshot: {}.'.format('; '.join(problems)))
+			snapshots += 1
+	print(snapshots)
+
+def main():
+	args = sys.argv[1:]
+	writers, updates, readers, journal_max_size = 8, 10, 2, 256
+	path_7z, path_pwmgr = os.path.join(DIRECTORY, 'fake7z.py'), os.path.join(os.path.dirname(DIRECTORY), 'pwmgr.py')
+	native = '--native' in args
+	for option, value in zip(args, args[1:]):
+		if option == '-w':
+			writers = int(value)
+		elif option == '-u':
+			updates = int(value)
+		elif option == '-r':
+			readers = int(value)
+		elif option == '--journal-max-size':
+			journal_max_size = int(value)
+		elif option == '--7z':
+			path_7z = value
+		elif option == '--pwmgr':
+			path_pwmgr = value
+	pwmgr = import_pwmgr(path_pwmgr)
+	# The new archive is empty until seeded below, which pwmgr warns of.
+	pwmgr.logger.setLevel('ERROR')
+	settings = {'path_7z': path_7z, 'journal_max_size': journal_max_size, 'lock_timeout': 600}
+	if args[:1] == ['--worker']:
+		# Run as one of the processes started below: --worker KIND ARCHIVE NUMBER [DONE_FILE].
+		kind, path_archive, number = args[1], args[2], int(args[3])
+		try:
+			if kind == 'writer':
+				run_writer(pwmgr, path_archive, settings, number, updates)
+			else:
+				run_reader(pwmgr, path_archive, settings, writers, args[4])
+		except pwmgr.PwmgrError as err:
+			sys.exit('{} {} failed: {}'.format(kind, number, err))
+		return
+	with tempfile.TemporaryDirectory() as directory:
+		path_archive = os.path.join(directory, 'stress.pwv' if native else 'stress.7z')
+		path_done = os.path.join(directory, 'done')
+		pwmgr.Vault.create(path_archive, PASSWORD, path_7z=path_7z)
+		with pwmgr.Vault(path_archive, **settings) as vault:
+			vault.open(PASSWORD)
+			vault.upsert('seed', PASSWORD)
+			vault.commit()
+		options = ['-w', str(writers), '-u', str(updates), '--journal-max-size', str(journal_max_size), '--7z', path_7z,
+			'--pwmgr', path_pwmgr]
+		def start(kind, number, *extra):
+			return subprocess.Popen([sys.executable, os.path.abspath(__file__), '--worker', kind, path_archive,
+				str(number), *extra, *options], stdout=subprocess.PIPE, universal_newlines=True)
+		start_time = time.perf_counter()
+		reader_processes = [start('reader', number, path_done) for number in range(readers)]
+		writer_processes = [start('writer', number) for number in range(writers)]
+		failures = sum(1 for process in writer_processes if process.wait())
+		elapsed = time.perf_counter() - start_time
+		open(path_done, 'w').close()
+		snapshots = 0
+		for process in reader_processes:
+			output, _ = process.communicate()
+			if process.returncode:
+				failures += 1
+			else:
+				snapshots += int(output)
+		with pwmgr.Vault(path_archive, **settings) as vault:
+			vault.open(PASSWORD)
+			problems = check_snapshot(vault, writers)
+			problems.extend('writer {}: {} of {} updates'.format(writer, vault.get(count_name(writer)), updates)
+				for writer in range(writers) if vault.get(count_name(writer)) != str(updates))
+	print('{} writers committed {} updates each to a {} in {:.2f} s; {} readers checked {} snapshots.'.format(writers,
+		updates, 'native vault' if native else '7z archive', elapsed, readers, snapshots))
+	if failures or problems:
+		print('FAIL: {} processes failed. {}'.format(failures, ' '.join(problem + '.' for problem in problems)))
+		sys.exit(1)
+	print('OK: no update was lost.')
+
+if __name__ == '__main__':
+	main()